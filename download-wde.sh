@@ -7,3 +7,5 @@
 wget -O "data/input/raw/dewiki-latest-pages-articles-multistream1.xml-p1p297012.bz2" "https://dumps.wikimedia.org/dewiki/latest/dewiki-latest-pages-articles-multistream1.xml-p1p297012.bz2"
 # unpack
 bzip2 -dk "data/input/raw/dewiki-latest-pages-articles-multistream1.xml-p1p297012.bz2"
+# index of the multistream file, needed for parallel parsing
+wget -O "data/input/raw/dewiki-latest-pages-articles-multistream-index1.txt-p1p297012.bz2" "https://dumps.wikimedia.org/dewiki/latest/dewiki-latest-pages-articles-multistream-index1.txt-p1p297012.bz2"
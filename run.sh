@@ -5,6 +5,14 @@ case "$1" in
 		shift
 		python3 src/search_graph.py "$@"
 		;;
+	s)
+		shift
+		python3 src/search_service.py "$@"
+		;;
+	l)
+		shift
+		python3 src/load_test.py "$@"
+		;;
 	e)
 		shift
 		python3 src/encode_text.py "$@"
@@ -13,6 +21,22 @@ case "$1" in
 		shift
 		python3 src/create_graph.py "$@"
 		;;
+	b)
+		shift
+		python3 src/benchmark.py "$@"
+		;;
+	i)
+		shift
+		python3 src/import_report.py "$@"
+		;;
+	p)
+		shift
+		python3 src/page_views.py "$@"
+		;;
+	o)
+		shift
+		python3 src/onnx_backend.py "$@"
+		;;
 	m)
 		# python3 src/model_tests/model_encoding.py
 		python3 src/model_tests/jina.py
@@ -21,6 +45,7 @@ case "$1" in
 		python3 src/wiki_data.py
 		;;
 	*)
-		echo "use m or d"
+		echo "use r (search), s (service), l (load test), e (encode), c (create index), b (benchmark), i (import report),"
+		echo "p (page views), o (onnx), m (model test) or d (wiki data)"
 		;;
 esac
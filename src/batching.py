@@ -0,0 +1,155 @@
+"""
+Batching of texts by token count.
+
+Every batch is padded to its longest text. Sorting a window of texts by their token count and filling each batch up to a
+token budget keeps the padding small and the batches of short texts large.
+"""
+import time
+from dataclasses import dataclass
+from typing import Any, List, Optional, Tuple
+
+import numpy as np
+
+from metrics import METRICS
+from tables import Table
+
+
+def plan_batches(lengths: np.ndarray, max_tokens: int, max_batch_size: int) -> List[np.ndarray]:
+    """
+    Groups texts of similar length into batches. A batch is closed, when its padded size (number of texts times the
+    longest text) would exceed max_tokens, or when it contains max_batch_size texts.
+
+    :returns: A list of index arrays into lengths
+    """
+    batches = []
+    current = []
+    current_max = 0
+    for i in np.argsort(lengths, kind='stable'):
+        new_max = max(current_max, lengths[i])
+        if current and (new_max * (len(current) + 1) > max_tokens or len(current) >= max_batch_size):
+            batches.append(np.array(current))
+            current = []
+            new_max = lengths[i]
+        current.append(i)
+        current_max = new_max
+    if current:
+        batches.append(np.array(current))
+    return batches
+
+
+def plan_fixed_batches(num_texts: int, batch_size: int) -> List[np.ndarray]:
+    """
+    Splits the texts into batches of batch_size in arrival order.
+    """
+    return [np.arange(start, min(start + batch_size, num_texts)) for start in range(0, num_texts, batch_size)]
+
+
+class BatchStats:
+    def __init__(self):
+        self.rows = 0
+        self.batches = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.seconds = 0.0
+
+    def record(self, lengths: np.ndarray):
+        self.rows += len(lengths)
+        self.batches += 1
+        self.tokens += int(lengths.sum())
+        self.padded_tokens += int(lengths.max()) * len(lengths)
+
+    def padding_waste(self) -> float:
+        if self.padded_tokens == 0:
+            return 0.0
+        return 1.0 - self.tokens / self.padded_tokens
+
+    def tokens_per_second(self) -> Optional[float]:
+        if self.seconds == 0.0:
+            return None
+        return self.tokens / self.seconds
+
+
+@dataclass
+class PreparedWindow:
+    num_texts: int
+    # the token counts of the texts, that are encoded. With a cache these are only the misses.
+    lengths: np.ndarray
+    # (indices into lengths, tokens) for every batch
+    batches: List[Tuple[np.ndarray, Any]]
+    # the tokens of the whole window returned by the tokenize_all() of the model
+    tokens: Any
+
+
+class BatchingEncoder:
+    """
+    Encodes windows of texts with a model. If max_tokens is given, the texts of a window are batched by length under
+    this token budget, otherwise they are batched in arrival order in batches of max_batch_size. In both cases the
+    features are returned in the order of the input texts.
+    """
+    def __init__(self, model, max_tokens: Optional[int], max_batch_size: int):
+        self.model = model
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.stats = BatchStats()
+        # padding, that fixed size batches would have produced for the same texts
+        self.fixed_stats = BatchStats()
+
+    def plan(self, lengths: np.ndarray) -> List[np.ndarray]:
+        for batch in plan_fixed_batches(len(lengths), self.max_batch_size):
+            self.fixed_stats.record(lengths[batch])
+        if self.max_tokens:
+            return plan_batches(lengths, self.max_tokens, self.max_batch_size)
+        return plan_fixed_batches(len(lengths), self.max_batch_size)
+
+    def prepare(self, texts: List[str]) -> PreparedWindow:
+        """
+        Tokenizes the texts of a window once, plans the batches from the token counts and pads the tokens of every
+        batch.
+        """
+        with METRICS.timer('encode.tokenize'):
+            lengths, tokens = self.model.tokenize_all(texts)
+            lengths = np.array(lengths, dtype=np.int64)
+            batches = [(batch, self.model.batch_tokens(tokens, batch)) for batch in self.plan(lengths)]
+        return PreparedWindow(len(texts), lengths, batches, tokens)
+
+    def encode(self, prepared: PreparedWindow) -> np.ndarray:
+        """
+        Runs the model on the batches of a prepared window and returns the features in the order of the input texts.
+        """
+        start_time = time.perf_counter()
+        all_batch_features = self.model.encode_batches([tokens for _, tokens in prepared.batches])
+        seconds = time.perf_counter() - start_time
+        self.stats.seconds += seconds
+        METRICS.observe('encode.forward', seconds)
+
+        features = None
+        for (batch, _), batch_features in zip(prepared.batches, all_batch_features):
+            self.stats.record(prepared.lengths[batch])
+            if METRICS.enabled:
+                METRICS.observe('encode.batch_size', len(batch))
+                METRICS.observe('encode.padded_tokens', len(batch) * int(prepared.lengths[batch].max()))
+            if features is None:
+                features = np.empty((len(prepared.lengths), batch_features.shape[1]), dtype=batch_features.dtype)
+            features[batch] = batch_features
+        return self.model.collect_features(prepared.tokens, features)
+
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        return self.encode(self.prepare(texts))
+
+    def report(self) -> Table:
+        table = Table(('Batching', 'Batches', 'Rows', 'Tokens', 'Padded tokens', 'Padding waste', 'Tokens per second'))
+        tokens_per_second = self.stats.tokens_per_second()
+        table.line(
+            batching='token budget {}'.format(self.max_tokens) if self.max_tokens else 'fixed',
+            batches=self.stats.batches, rows=self.stats.rows, tokens=self.stats.tokens,
+            padded_tokens=self.stats.padded_tokens, padding_waste=self.stats.padding_waste(),
+            tokens_per_second=tokens_per_second if tokens_per_second is not None else '-'
+        )
+        if self.max_tokens:
+            table.line(
+                batching='fixed {} (estimated)'.format(self.max_batch_size),
+                batches=self.fixed_stats.batches, rows=self.fixed_stats.rows, tokens=self.fixed_stats.tokens,
+                padded_tokens=self.fixed_stats.padded_tokens, padding_waste=self.fixed_stats.padding_waste(),
+                tokens_per_second='-'
+            )
+        return table
@@ -0,0 +1,212 @@
+"""
+Retrieval benchmark: recall@k against latency.
+
+Encodes a query set, computes the exact nearest neighbours of every query by brute force over features.bin and sweeps
+the search parameter of every index in the output directory (ef for hnsw, eps for deglib). For every setting, recall@10,
+recall@100, the single query latencies and the queries per second with one and with --threads parallel searches are
+reported. Encoding is measured separately, so the search numbers only contain the index search.
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from feature_store import FeatureStore, read_description
+from flat_index import FLAT_FILE, FlatIndex
+from incremental import load_deleted_rows, load_pending_tombstones
+from index_files import INDEX_FILES as GRAPH_INDEX_FILES
+from pq_index import PQ_CODES_FILE
+from load_test import DEFAULT_QUERIES
+from models import BACKENDS, load_model, close_model
+from search_graph import Index, prepare_queries
+from tables import Table
+
+INDEX_FILES = dict(GRAPH_INDEX_FILES, flat=FLAT_FILE, pq=PQ_CODES_FILE)
+RECALL_AT = [10, 100]
+DEFAULT_EF = '50,100,200,400,800,1200'
+DEFAULT_EPS = '0.0,0.05,0.1,0.2,0.3'
+DEFAULT_RERANK = '100,200,500,1000,2000'
+SEARCH_PARAM_NAMES = {'hnsw': 'ef', 'deglib': 'eps', 'flat': '-', 'pq': 'rerank'}
+# below this number of queries, p99 would only be the maximum latency and is not reported
+MIN_P99_SAMPLES = 100
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure recall and latency of the indexes of an output directory.')
+    parser.add_argument('indir', type=str)
+    parser.add_argument(
+        '--queries', type=str, default=None,
+        help='file with one query per line. p99 latencies need at least {} queries'.format(MIN_P99_SAMPLES)
+    )
+    parser.add_argument('--backend', type=str, choices=BACKENDS, default='torch', help='inference backend of the model')
+    parser.add_argument('--ef', type=str, default=DEFAULT_EF, help='comma separated ef values for hnsw')
+    parser.add_argument('--eps', type=str, default=DEFAULT_EPS, help='comma separated eps values for deglib')
+    parser.add_argument(
+        '--rerank', type=str, default=DEFAULT_RERANK, help='comma separated numbers of re-ranked candidates for pq'
+    )
+    parser.add_argument(
+        '--threads', type=int, default=os.cpu_count(), help='number of parallel searches for the multithreaded qps'
+    )
+    parser.add_argument(
+        '--output', type=str, default=None, help='json file for the results. Defaults to <indir>/benchmark.json'
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    description = read_description(args.indir)
+    normalize, quantize = description.get('normalize', False), description.get('quantize', False)
+
+    queries = DEFAULT_QUERIES
+    if args.queries is not None:
+        with open(args.queries, 'r') as f:
+            queries = [line.strip() for line in f if line.strip()]
+    if len(queries) < MIN_P99_SAMPLES:
+        print('only {} queries, p99 latencies are not reported, pass at least {} with --queries'.format(
+            len(queries), MIN_P99_SAMPLES
+        ), flush=True)
+
+    model = load_model(description['model'], backend=args.backend)
+    encoding, query_features = measure_encoding(model, queries)
+    close_model(model)
+    store = FeatureStore.from_dir(args.indir, description)
+    query_features = prepare_queries(query_features, normalize, store.quantizer if quantize else None)
+
+    sweeps = {
+        'hnsw': parse_values(args.ef), 'deglib': parse_values(args.eps), 'flat': [None], 'pq': parse_values(args.rerank)
+    }
+    # the rows of merged deltas, that the indexes do not return, are left out of the ground truth as well
+    deleted = sorted(set(load_deleted_rows(args.indir)).union(load_pending_tombstones(args.indir)))
+    ground_truths = {}
+    results = []
+    for index_type, index_file in INDEX_FILES.items():
+        if not os.path.exists(os.path.join(args.indir, index_file)) and description.get('index_type') != index_type:
+            continue
+        built_index = description.get('index_type') == index_type
+        shards = description.get('shards') if built_index else None
+        num_deleted = description.get('num_deleted', 0) if built_index else 0
+        print('loading {} index... '.format(index_type), end='', flush=True)
+        index = Index(args.indir, index_type, description['dim'], normalize, shards, num_deleted)
+        print('done', flush=True)
+        if index.metric not in ground_truths:
+            print('computing ground truth ({})'.format(index.metric), flush=True)
+            ground_truths[index.metric] = exact_neighbours(
+                store, query_features, max(RECALL_AT), normalize, quantize, index.metric, deleted
+            )
+        for value in sweeps[index_type]:
+            index.set_search_param(value)
+            result = measure_search(index, query_features, ground_truths[index.metric], args.threads)
+            result.update(index_type=index_type, param=SEARCH_PARAM_NAMES[index_type], value=value)
+            results.append(result)
+            print('{} {}={}: recall@10={:.4f} p50={:.2f}ms'.format(
+                index_type, result['param'], value, result['recall@10'], result['p50_ms']
+            ), flush=True)
+
+    table = Table((
+        'Index', 'Param', 'Value', 'Recall at 10', 'Recall at 100', 'Mean ms', 'p50 ms', 'p99 ms', 'QPS', 'QPS threaded'
+    ))
+    for result in results:
+        table.line(
+            index=result['index_type'], param=result['param'], value=result['value'],
+            recall_at_10=result['recall@10'], recall_at_100=result['recall@100'], mean_ms=result['mean_ms'],
+            p50_ms=result['p50_ms'], p99_ms=result['p99_ms'] if result['p99_ms'] is not None else '-',
+            qps=result['qps'], qps_threaded=result['qps_threaded'],
+        )
+    print(table)
+    encoding_p99 = '{:.2f}ms'.format(encoding['p99_ms']) if encoding['p99_ms'] is not None else '-'
+    print('encoding: {:.2f}ms per query (p50 {:.2f}ms, p99 {}), {:.1f} queries/s batched'.format(
+        encoding['mean_ms'], encoding['p50_ms'], encoding_p99, encoding['batched_qps']
+    ))
+
+    output = args.output or os.path.join(args.indir, 'benchmark.json')
+    with open(output, 'w') as f:
+        json.dump({
+            'num_queries': len(queries), 'threads': args.threads, 'encoding': encoding, 'search': results
+        }, f, indent=2)
+    print('results written to {}'.format(output))
+
+
+def parse_values(values: str) -> List[float]:
+    return [float(v) if '.' in v else int(v) for v in values.split(',') if v]
+
+
+def latency_stats(latencies: List[float]) -> Dict[str, Optional[float]]:
+    """
+    p99_ms is None for less than MIN_P99_SAMPLES latencies.
+    """
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        'mean_ms': float(latencies_ms.mean()),
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)) if len(latencies_ms) >= MIN_P99_SAMPLES else None,
+    }
+
+
+def measure_encoding(model, queries: List[str]):
+    """
+    Encodes every query on its own to measure the latency, then all queries in one batch to measure the throughput.
+    """
+    model([queries[0]])  # warm up
+    latencies = []
+    for query in queries:
+        start_time = time.perf_counter()
+        model([query])
+        latencies.append(time.perf_counter() - start_time)
+    start_time = time.perf_counter()
+    query_features = model(queries)
+    batch_time = time.perf_counter() - start_time
+    encoding = latency_stats(latencies)
+    encoding['batched_qps'] = len(queries) / batch_time
+    return encoding, query_features
+
+
+def exact_neighbours(
+        store: FeatureStore, queries: np.ndarray, k: int, normalize: bool, quantize: bool, metric: str,
+        deleted: List[int]
+) -> np.ndarray:
+    """
+    Returns the indices of the k nearest rows of every query, that are not deleted, sorted by distance. The rows are
+    processed like for the index, cosine compares the processed rows after normalizing them again.
+    """
+    flat_index = FlatIndex(store, metric=metric, normalize=normalize, quantize=quantize, deleted=deleted)
+    return flat_index.search(queries, k)[0]
+
+
+def recall(indices: np.ndarray, ground_truth: np.ndarray, k: int) -> float:
+    hits = [len(np.intersect1d(found[:k], truth[:k])) for found, truth in zip(indices, ground_truth)]
+    return float(np.mean(hits)) / k
+
+
+def measure_search(index: Index, queries: np.ndarray, ground_truth: np.ndarray, threads: int) -> dict:
+    k = ground_truth.shape[1]
+    index.search_query(queries[:1], k=k)  # warm up
+
+    latencies = []
+    indices = []
+    start_time = time.perf_counter()
+    for i in range(len(queries)):
+        query_start = time.perf_counter()
+        query_indices, _ = index.search_query(queries[i:i + 1], k=k)
+        latencies.append(time.perf_counter() - query_start)
+        indices.append(np.asarray(query_indices)[0])
+    duration = time.perf_counter() - start_time
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        threaded_start = time.perf_counter()
+        list(executor.map(lambda i: index.search_query(queries[i:i + 1], k=k), range(len(queries))))
+        threaded_duration = time.perf_counter() - threaded_start
+
+    result = {'recall@{}'.format(at): recall(np.array(indices), ground_truth, at) for at in RECALL_AT}
+    result.update(latency_stats(latencies))
+    result['qps'] = len(queries) / duration
+    result['qps_threaded'] = len(queries) / threaded_duration
+    return result
+
+
+if __name__ == '__main__':
+    main()
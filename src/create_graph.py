@@ -1,57 +1,251 @@
 import argparse
-import json
+import dataclasses
+import multiprocessing
 import os
 import time
-from typing import Iterator
+from collections import Counter
+from typing import List, Optional, Sequence, Tuple
 
-import hnswlib
 import numpy as np
-import deglib
-from tqdm import tqdm
-
-from utils import l2_normalize, quantize_data
 
+from feature_store import FeatureStore, read_description, write_description
+from flat_index import FLAT_FILE
+from incremental import (
+    clear_pending_tombstones, load_deleted_rows, load_pending_tombstones, merge_delta, rollback_merge
+)
+from index_files import INDEX_FILES, SHARDED_INDEX_TYPES
+from pq_index import DEFAULT_SUBSPACES, PQ_CODEBOOKS_FILE, PQ_CODES_FILE, encode, train_codebooks
+from quantization import DEFAULT_SAMPLE_SIZE, METHODS, QUANTIZATION_FILE, Quantizer, calibrate
+
+# hnswlib, deglib and tqdm are imported by the functions, that need them, so that --help and the other index types do
+# not pay for their import
 CHUNK_SIZE = 1024
+INDEX_TYPES = ['hnsw', 'deglib', 'flat', 'pq']
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        'index_type', choices=['hnsw', 'deglib'], help='the index type to use. Either "hnsw" or "deglib".'
+        'index_type', choices=INDEX_TYPES + ['append'],
+        help='the index type to use. Either "hnsw", "deglib", "flat" (exact search) or "pq" (product quantization). '
+             '"append" adds the rows, that were added to features.bin since the last build, to the existing hnsw or '
+             'deglib index.'
     )
     parser.add_argument('indir')
     parser.add_argument('--normalize', action='store_true', help='normalize vectors before adding to index')
     parser.add_argument('--quantize', action='store_true', help='quantize vectors before adding to index')
-    return parser.parse_args()
+    parser.add_argument(
+        '--calibrate', type=str, choices=METHODS, default=None,
+        help='calibrate the quantization per dimension instead of using the fixed range [-0.4, 0.4]'
+    )
+    parser.add_argument(
+        '--calibration-sample', type=int, default=DEFAULT_SAMPLE_SIZE, help='number of rows used for calibration'
+    )
+    parser.add_argument(
+        '--pq-subspaces', type=int, default=DEFAULT_SUBSPACES,
+        help='number of bytes per row of the pq index. Has to divide the dimension.'
+    )
+    parser.add_argument(
+        '--threads', type=int, default=os.cpu_count(), help='number of threads used to build the index'
+    )
+    parser.add_argument(
+        '--shards', type=int, default=None,
+        help='split the rows into this many contiguous shards and build one index per shard in parallel'
+    )
+    parser.add_argument(
+        '--shard-workers', type=int, default=None,
+        help='number of shards built at the same time. Defaults to all shards, lower it to reduce peak memory.'
+    )
+    parser.add_argument(
+        '--shard', type=int, default=None, help='only rebuild this shard of an existing sharded index'
+    )
+    parser.add_argument(
+        '--delta', type=str, default=None,
+        help='with append: output directory of "encode_text.py --previous <indir>". Its rows are merged into indir '
+             'first and its tombstones are deleted from the index.'
+    )
+    args = parser.parse_args()
+    if args.delta is not None and args.index_type != 'append':
+        parser.error('--delta is only supported by append')
+    if args.index_type == 'pq' and args.quantize:
+        parser.error('the pq index compresses the vectors itself, --quantize is not supported')
+    if args.calibrate is not None and not args.quantize:
+        parser.error('--calibrate is only supported with --quantize')
+    if (args.shards is not None or args.shard is not None) and args.index_type not in SHARDED_INDEX_TYPES:
+        parser.error('only {} indexes can be sharded'.format(' and '.join(SHARDED_INDEX_TYPES)))
+    if args.shard is not None and (args.shards is not None or args.calibrate is not None):
+        parser.error('--shard rebuilds a shard with the existing layout and quantization')
+    return args
 
 
 def main():
     args = parse_args()
 
-    # read description
-    with open(os.path.join(args.indir, 'description.json'), 'r') as f:
-        description = json.load(f)
+    description = read_description(args.indir)
+    store = FeatureStore.from_dir(args.indir, description)
+
+    print('num_samples={}  dim={}'.format(store.num_samples, store.dim))
+
+    if args.shard is not None:
+        rebuild_shard(args, description, store)
+        return
+    if args.index_type == 'append':
+        append_to_index(args, description)
+        return
+    build_index(args, description, store)
+
+
+def build_index(args, description: dict, store: FeatureStore):
+    """
+    Builds the index of all rows of features.bin, that were not deleted by merged deltas, and updates description.json.
+    """
+    description.pop('quantization', None)
+    store.quantizer = Quantizer.fixed()
+    if args.quantize and args.calibrate is not None:
+        print('calibrating quantization ({})... '.format(args.calibrate), end='', flush=True)
+        store.quantizer = calibrate(store.data, args.normalize, args.calibrate, sample_size=args.calibration_sample)
+        store.quantizer.save(os.path.join(args.indir, QUANTIZATION_FILE))
+        description['quantization'] = QUANTIZATION_FILE
+        print('done', flush=True)
+
+    # the rows deleted by merged deltas are left out of hnsw and deglib, flat and pq skip them while searching
+    deleted = load_deleted_rows(args.indir)
+    description.pop('shards', None)
+    if args.shards is not None:
+        description['shards'] = build_shards(args, store, shard_ranges(store.num_samples, args.shards))
+    elif args.index_type == 'hnsw':
+        index = build_hnsw_index(store, args.normalize, args.quantize, args.threads, deleted=deleted)
+        index.save_index(os.path.join(args.indir, INDEX_FILES['hnsw']))
+    elif args.index_type == 'deglib':
+        index = build_deglib_from_data(store, args.normalize, args.quantize, deleted=deleted)
+        index.save_graph(os.path.join(args.indir, INDEX_FILES['deglib']))
+    elif args.index_type == 'flat':
+        build_flat_index(store, args.normalize, args.quantize, args.indir)
+    elif args.index_type == 'pq':
+        build_pq_index(store, args.normalize, args.pq_subspaces, args.indir)
+
+    description['normalize'] = args.normalize
+    description['quantize'] = args.quantize
+    description['index_type'] = args.index_type
+    description['indexed_samples'] = store.num_samples
+    description['num_deleted'] = len(deleted)
+    write_description(args.indir, description)
+    clear_pending_tombstones(args.indir)
+
+
+def append_to_index(args, description: dict):
+    """
+    Inserts the rows of features.bin, that are not in the index yet, into the existing index and deletes the
+    tombstones of --delta. description.json is updated with the new counts. Without --delta, an earlier append, that
+    failed after merging its delta, is completed.
+    """
+    index_type = description.get('index_type')
+    if index_type not in INDEX_FILES:
+        raise ValueError('append supports only {} indexes, not {}'.format(' and '.join(INDEX_FILES), index_type))
+    if description.get('shards'):
+        raise ValueError('append does not support sharded indexes, rebuild them instead')
+
+    if args.delta is not None:
+        merge_delta(args.indir, args.delta)
+    else:
+        rollback_merge(args.indir)
+    description = read_description(args.indir)
+    tombstones = load_pending_tombstones(args.indir)
+    store = FeatureStore.from_dir(args.indir, description)
+    path = os.path.join(args.indir, INDEX_FILES[index_type])
+    start = description.get('indexed_samples')
+
+    start_time = time.perf_counter()
+    if index_type == 'hnsw':
+        append_hnsw(store, description['normalize'], description['quantize'], path, start, tombstones, args.threads)
+    else:
+        append_deglib(store, description['normalize'], description['quantize'], path, start, tombstones)
+    print('Updated index after {:5.1f}s'.format(time.perf_counter() - start_time), flush=True)
+
+    description['indexed_samples'] = store.num_samples
+    description['num_deleted'] = description.get('num_deleted', 0) + len(tombstones)
+    write_description(args.indir, description)
+    clear_pending_tombstones(args.indir)
+
+
+@dataclasses.dataclass
+class ShardTask:
+    indir: str
+    index_type: str
+    normalize: bool
+    quantize: bool
+    quantizer: Quantizer
+    shard: int
+    start: int
+    end: int
+    num_threads: int
 
-    dim, num_samples = description['dim'], description['num_samples']
 
-    print('num_samples={}  dim={}'.format(num_samples, dim))
+def shard_ranges(num_samples: int, num_shards: int) -> List[Tuple[int, int]]:
+    bounds = np.linspace(0, num_samples, num_shards + 1).astype(np.int64)
+    return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:])]
 
-    if args.index_type == 'hnsw':
+
+def shard_file(index_type: str, shard: int) -> str:
+    name, extension = os.path.splitext(INDEX_FILES[index_type])
+    return '{}.shard{:03d}{}'.format(name, shard, extension)
+
+
+def build_shard(task: ShardTask) -> Tuple[int, float]:
+    """
+    Builds the index of the rows [task.start, task.end) and saves it. Runs in a worker process.
+    """
+    start_time = time.perf_counter()
+    store = FeatureStore.from_dir(task.indir)
+    store.quantizer = task.quantizer
+    deleted = load_deleted_rows(task.indir)
+    path = os.path.join(task.indir, shard_file(task.index_type, task.shard))
+    if task.index_type == 'hnsw':
         index = build_hnsw_index(
-            dim, num_samples, os.path.join(args.indir, 'features.bin'), args.normalize, args.quantize
+            store, task.normalize, task.quantize, task.num_threads, task.start, task.end, deleted
         )
-        index.save_index(os.path.join(args.indir, 'index.hnsw'))
-    elif args.index_type == 'deglib':
-        index = build_deglib_from_data(
-            dim, num_samples, os.path.join(args.indir, 'features.bin'), args.normalize, args.quantize
+        index.save_index(path)
+    else:
+        graph = build_deglib_from_data(store, task.normalize, task.quantize, task.start, task.end, deleted)
+        graph.save_graph(path)
+    return task.shard, time.perf_counter() - start_time
+
+
+def build_shards(args, store: FeatureStore, ranges: List[Tuple[int, int]], shards: Optional[List[int]] = None):
+    """
+    Builds the given shards (all by default) in parallel worker processes and returns the shard entries of
+    description.json. The rows of a shard are numbered from 0, offset is the global row of the first one.
+    """
+    if shards is None:
+        shards = list(range(len(ranges)))
+    num_workers = min(args.shard_workers or len(shards), len(shards))
+    tasks = [
+        ShardTask(
+            args.indir, args.index_type, args.normalize, args.quantize, store.quantizer, shard, *ranges[shard],
+            num_threads=max(1, args.threads // num_workers)
         )
-        index.save_graph(os.path.join(args.indir, 'index.deg'))
-
-    description['normalize'] = args.normalize
-    description['quantize'] = args.quantize
-    description['index_type'] = args.index_type
-    with open(os.path.join(args.indir, 'description.json'), 'w') as f:
-        json.dump(description, f, indent=2)
+        for shard in shards
+    ]
+    print('Building {} shards with {} workers'.format(len(tasks), num_workers), flush=True)
+    with multiprocessing.Pool(num_workers) as pool:
+        for shard, seconds in pool.imap_unordered(build_shard, tasks):
+            print('Shard {} done after {:5.1f}s'.format(shard, seconds), flush=True)
+    return [
+        {'file': shard_file(args.index_type, shard), 'offset': start, 'num_samples': end - start}
+        for shard, (start, end) in enumerate(ranges)
+    ]
+
+
+def rebuild_shard(args, description: dict, store: FeatureStore):
+    shards = description.get('shards')
+    if not shards or description.get('index_type') != args.index_type:
+        raise ValueError('{} has no sharded {} index'.format(args.indir, args.index_type))
+    if args.shard < 0 or args.shard >= len(shards):
+        raise ValueError('shard has to be between 0 and {}'.format(len(shards) - 1))
+    if description['normalize'] != args.normalize or description['quantize'] != args.quantize:
+        raise ValueError('--normalize and --quantize have to match the existing shards')
+    ranges = [(shard['offset'], shard['offset'] + shard['num_samples']) for shard in shards]
+    build_shards(args, store, ranges, [args.shard])
 
 
 def get_num_pages(indir):
@@ -61,61 +255,248 @@ def get_num_pages(indir):
     return len(pages)
 
 
-def iterate_chunks(data_file: str, num_samples: int, dim: int, normalize: bool, quantize: bool) -> Iterator[np.ndarray]:
-    with open(data_file, 'rb') as df:
-        for min_index in range(0, num_samples, CHUNK_SIZE):
-            data_bytes = df.read(dim * CHUNK_SIZE * 4)
-            chunk = np.frombuffer(data_bytes, dtype=np.float32).reshape(-1, dim)
-            if normalize:
-                chunk = l2_normalize(chunk)
-            if quantize:
-                chunk = quantize_data(chunk, max_val=0.4)
+def build_hnsw_index(
+        store: FeatureStore, normalize: bool, quantize: bool, num_threads: int, start: int = 0,
+        end: Optional[int] = None, deleted: Sequence[int] = ()
+):
+    """
+    Builds an index of the rows [start, end). The rows are labeled from 0, the deleted rows are marked as deleted.
+    """
+    import hnswlib
+    from tqdm import tqdm
 
-            yield chunk
-
-
-def build_hnsw_index(dim, num_samples, data_file: str, normalize: bool, quantize: bool):
+    if end is None:
+        end = store.num_samples
+    dim, num_samples = store.dim, end - start
     metric = 'cosine' if normalize else 'l2'
     index = hnswlib.Index(space=metric, dim=dim)
     index.init_index(max_elements=num_samples, ef_construction=400, M=24)
-    index.set_num_threads(6)
+    index.set_num_threads(num_threads)
 
     n_chunks = num_samples // CHUNK_SIZE + 1
 
     start_time = time.perf_counter()
-    for chunk in tqdm(iterate_chunks(data_file, num_samples, dim, normalize, quantize), total=n_chunks):
+    for chunk in tqdm(store.iterate_chunks(CHUNK_SIZE, normalize, quantize, start, end), total=n_chunks):
         index.add_items(chunk)
     print('Added {} data points after {:5.1f}s\n'.format(num_samples, time.perf_counter() - start_time), flush=True)
+    for row in deleted:
+        if start <= row < end:
+            index.mark_deleted(row - start)
 
     return index
 
 
+def append_hnsw(
+        store: FeatureStore, normalize: bool, quantize: bool, path: str, start: Optional[int], tombstones: List[int],
+        num_threads: int
+):
+    import hnswlib
+    from tqdm import tqdm
+
+    index = hnswlib.Index(space='cosine' if normalize else 'l2', dim=store.dim)
+    index.load_index(path)
+    if start is None:
+        start = index.get_current_count()
+    if store.num_samples > index.get_max_elements():
+        index.resize_index(store.num_samples)
+    index.set_num_threads(num_threads)
+
+    print('Adding {} rows, deleting {} rows'.format(store.num_samples - start, len(tombstones)), flush=True)
+    n_chunks = (store.num_samples - start) // CHUNK_SIZE + 1
+    chunks = store.iterate_chunks(CHUNK_SIZE, normalize, quantize, start)
+    for chunk_index, chunk in enumerate(tqdm(chunks, total=n_chunks)):
+        min_index = start + chunk_index * CHUNK_SIZE
+        index.add_items(chunk, np.arange(min_index, min_index + len(chunk)))
+    for row in tombstones:
+        try:
+            index.mark_deleted(row)
+        except RuntimeError:
+            # already deleted by an earlier append, that saved the index but failed before updating description.json
+            pass
+    index.save_index(path)
+
+
+def append_deglib(
+        store: FeatureStore, normalize: bool, quantize: bool, path: str, start: Optional[int], tombstones: List[int]
+):
+    import deglib
+    from tqdm import tqdm
+
+    # the graph is loaded with room for all rows, the builder extends it and removes the tombstones
+    graph = load_mutable_deglib(path, store.num_samples)
+    # the labels are the row numbers. Rows, that an earlier failed append has already added, are skipped.
+    next_row = max((graph.get_external_label(i) for i in range(graph.size())), default=-1) + 1
+    start = next_row if start is None else max(start, next_row)
+    # tombstones, that an earlier failed append has already removed, are skipped
+    tombstones = [row for row in tombstones if row >= start or graph.has_vertex(row)]
+    print('Adding {} rows, deleting {} rows'.format(store.num_samples - start, len(tombstones)), flush=True)
+    if start >= store.num_samples and not tombstones:
+        return
+    builder = create_deglib_builder(graph)
+    n_chunks = (store.num_samples - start) // CHUNK_SIZE + 1
+    chunks = store.iterate_chunks(CHUNK_SIZE, normalize, quantize, start)
+    for chunk_index, chunk in enumerate(tqdm(chunks, total=n_chunks)):
+        min_index = start + chunk_index * CHUNK_SIZE
+        builder.add_entry(np.arange(min_index, min_index + len(chunk), dtype=np.uint32), chunk)
+    for row in tombstones:
+        builder.remove_entry(row)
+    builder.build(callback='progress')
+    del builder
+
+    graph.remove_non_mrng_edges()
+    graph.save_graph(path)
+
+
+def load_mutable_deglib(path: str, capacity: int) -> 'deglib.graph.SizeBoundedGraph':
+    """
+    Loads a saved graph into a SizeBoundedGraph with room for capacity vertices. deglib only loads read only graphs, so
+    the vertices and edges are copied and the edge weights (the distances to the neighbours) are recomputed.
+    """
+    import deglib
+
+    readonly = deglib.graph.load_readonly_graph(path)
+    size = readonly.size()
+    space = readonly.get_feature_space()
+    graph = deglib.graph.SizeBoundedGraph.create_empty(
+        max(capacity, size), space.dim(), readonly.get_edges_per_vertex(), space.metric()
+    )
+    features = np.stack([readonly.get_feature_vector(i, copy=True) for i in range(size)])
+    for i in range(size):
+        graph.add_vertex(readonly.get_external_label(i), features[i])
+    for start in range(0, size, CHUNK_SIZE):
+        vertices = np.arange(start, min(start + CHUNK_SIZE, size))
+        neighbours = np.stack([readonly.get_neighbor_indices(int(i), copy=True) for i in vertices])
+        differences = features[neighbours].astype(np.float32) - features[vertices, None].astype(np.float32)
+        weights = (differences ** 2).sum(axis=-1)
+        for i, vertex_neighbours, vertex_weights in zip(vertices, neighbours, weights):
+            graph.change_edges(int(i), vertex_neighbours, vertex_weights)
+    reconnect_pruned_edges(graph, features)
+    return graph
+
+
+def reconnect_pruned_edges(graph: 'deglib.graph.SizeBoundedGraph', features: np.ndarray, eps: float = 0.1, k: int = 64):
+    """
+    remove_non_mrng_edges replaces every pruned edge by an edge of the vertex to itself and the builder of deglib 0.1
+    crashes, when it removes vertices next to these edges. Each of these free edges is connected to the nearest vertex
+    with a free edge, the remaining free edges are connected with each other.
+    """
+    free = Counter()
+    for i in range(graph.size()):
+        num_free = int((np.asarray(graph.get_neighbor_indices(i, copy=True)) == i).sum())
+        if num_free:
+            free[i] = num_free
+
+    def connect(vertex: int, other: int):
+        weight = float(((features[vertex].astype(np.float32) - features[other].astype(np.float32)) ** 2).sum())
+        graph.change_edge(vertex, vertex, other, weight)
+        graph.change_edge(other, other, vertex, weight)
+        free[vertex] -= 1
+        free[other] -= 1
+
+    for vertex in sorted(free, key=free.get, reverse=True):
+        if free[vertex] == 0:
+            continue
+        labels, _ = graph.search(features[vertex][None], eps, k)
+        for label in labels[0]:
+            other = graph.get_internal_index(int(label))
+            if free[vertex] == 0:
+                break
+            if other != vertex and free[other] > 0 and not graph.has_edge(vertex, other):
+                connect(vertex, other)
+
+    remaining = [vertex for vertex, num_free in free.items() for _ in range(num_free)]
+    while len(remaining) > 1:
+        vertex = remaining.pop()
+        position = next(
+            (j for j in range(len(remaining) - 1, -1, -1)
+             if remaining[j] != vertex and not graph.has_edge(vertex, remaining[j])),
+            None
+        )
+        if position is None:
+            break
+        connect(vertex, remaining.pop(position))
+
+
+def build_flat_index(store: FeatureStore, normalize: bool, quantize: bool, outdir: str):
+    """
+    The flat index scans the rows directly. If they have to be normalized or quantized, the processed rows are written
+    to index.flat once, so that searching does not have to process them again.
+    """
+    from tqdm import tqdm
+
+    flat_file = os.path.join(outdir, FLAT_FILE)
+    if not normalize and not quantize:
+        if os.path.exists(flat_file):
+            os.remove(flat_file)
+        print('Searching features.bin directly', flush=True)
+        return
+
+    start_time = time.perf_counter()
+    n_chunks = store.num_samples // CHUNK_SIZE + 1
+    with open(flat_file, 'wb') as f:
+        for chunk in tqdm(store.iterate_chunks(CHUNK_SIZE, normalize, quantize), total=n_chunks):
+            f.write(chunk.tobytes())
+    print('Wrote {} rows after {:5.1f}s\n'.format(store.num_samples, time.perf_counter() - start_time), flush=True)
+
+
+def build_pq_index(store: FeatureStore, normalize: bool, num_subspaces: int, outdir: str):
+    from tqdm import tqdm
+
+    print('Training {} codebooks... '.format(num_subspaces), end='', flush=True)
+    start_time = time.perf_counter()
+    codebooks = train_codebooks(store.data, normalize, num_subspaces)
+    np.save(os.path.join(outdir, PQ_CODEBOOKS_FILE), codebooks)
+    print('done after {:5.1f}s'.format(time.perf_counter() - start_time), flush=True)
+
+    start_time = time.perf_counter()
+    n_chunks = store.num_samples // CHUNK_SIZE + 1
+    with open(os.path.join(outdir, PQ_CODES_FILE), 'wb') as f:
+        for chunk in tqdm(store.iterate_chunks(CHUNK_SIZE, normalize), total=n_chunks):
+            f.write(encode(codebooks, chunk).tobytes())
+    print('Encoded {} rows after {:5.1f}s\n'.format(store.num_samples, time.perf_counter() - start_time), flush=True)
+
+
 def build_deglib_from_data(
-        dim: int, num_samples: int, data_file: str, normalize: bool, quantize: bool
-) -> deglib.graph.SizeBoundedGraph:
+        store: FeatureStore, normalize: bool, quantize: bool, start: int = 0, end: Optional[int] = None,
+        deleted: Sequence[int] = ()
+) -> 'deglib.graph.SizeBoundedGraph':
+    """
+    Builds a graph of the rows [start, end) without the deleted rows. The rows are labeled from 0.
+    """
+    import deglib
+    from tqdm import tqdm
+
+    if end is None:
+        end = store.num_samples
+    dim, num_samples = store.dim, end - start
     metric = deglib.Metric.L2_Uint8 if quantize else deglib.Metric.L2
     graph = deglib.graph.SizeBoundedGraph.create_empty(num_samples, dim, 24, metric)
-    builder = deglib.builder.EvenRegularGraphBuilder(
-        graph, rng=None, lid=deglib.builder.LID.High, extend_k=32, extend_eps=0.1, improve_k=0
-    )
+    builder = create_deglib_builder(graph)
 
     print(f"Start adding {num_samples} data points to builder", flush=True)
     start_time = time.perf_counter()
     labels = np.arange(num_samples, dtype=np.uint32)
+    keep = np.ones(num_samples, dtype=bool)
+    deleted = np.asarray(deleted, dtype=np.int64)
+    keep[deleted[(deleted >= start) & (deleted < end)] - start] = False
     n_chunks = num_samples // CHUNK_SIZE + 1
 
     for chunk_index, chunk in enumerate(
-            tqdm(iterate_chunks(data_file, num_samples, dim, normalize, quantize), total=n_chunks)
+            tqdm(store.iterate_chunks(CHUNK_SIZE, normalize, quantize, start, end), total=n_chunks)
     ):
         min_index = chunk_index * CHUNK_SIZE
         max_index = min(min_index + CHUNK_SIZE, num_samples)
 
-        builder.add_entry(
-            labels[min_index:max_index],
-            chunk
-        )
+        chunk_keep = keep[min_index:max_index]
+        if chunk_keep.any():
+            builder.add_entry(
+                labels[min_index:max_index][chunk_keep],
+                chunk[chunk_keep]
+            )
 
-    print('Added {} data points after {:5.1f}s\n'.format(num_samples, time.perf_counter() - start_time), flush=True)
+    print('Added {} data points after {:5.1f}s\n'.format(
+        int(keep.sum()), time.perf_counter() - start_time
+    ), flush=True)
 
     print('Start building graph:', flush=True)
     builder.build(callback='progress')
@@ -129,5 +510,12 @@ def build_deglib_from_data(
     return graph
 
 
+def create_deglib_builder(graph: 'deglib.graph.SizeBoundedGraph') -> 'deglib.builder.EvenRegularGraphBuilder':
+    import deglib
+    return deglib.builder.EvenRegularGraphBuilder(
+        graph, rng=None, lid=deglib.builder.LID.High, extend_k=32, extend_eps=0.1, improve_k=0
+    )
+
+
 if __name__ == '__main__':
     main()
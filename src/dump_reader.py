@@ -0,0 +1,169 @@
+"""
+Reads the pages of a multistream wikipedia dump in parallel.
+
+A multistream dump is a concatenation of independent bz2 streams, each containing about 100 pages. The accompanying
+index file lists "offset:page_id:title" for every page, where offset is the byte offset of the stream containing the
+page. The first stream of the dump contains only the xml header with the siteinfo, the last one the closing tag.
+"""
+import bz2
+import io
+import multiprocessing
+from typing import Iterator, List, Optional, Tuple
+
+import mwxml
+
+MEDIAWIKI_END_TAG = '</mediawiki>'
+PARSE_BATCH_SIZE = 256
+# number of pages, that could not be parsed, in the report at the end
+MAX_REPORTED_FAILURES = 10
+# number of characters of the error message of a page in the report
+MAX_ERROR_LENGTH = 200
+
+ParsedPage = Tuple[str, List[Tuple[int, str]]]
+# title and error message of a page, that could not be parsed
+ParseFailure = Tuple[str, str]
+
+
+def read_stream_offsets(index_file: str) -> List[int]:
+    """
+    Returns the sorted, unique stream offsets listed in the given multistream index file.
+    """
+    offsets = set()
+    with bz2.open(index_file, 'rt', encoding='utf-8') as f:
+        for line in f:
+            offset, _ = line.split(':', 1)
+            offsets.add(int(offset))
+    return sorted(offsets)
+
+
+def read_header(dump_file: str, first_offset: int) -> str:
+    with open(dump_file, 'rb') as f:
+        header_bytes = f.read(first_offset)
+    return bz2.decompress(header_bytes).decode('utf-8')
+
+
+def iterate_blocks(dump_file: str, offsets: List[int]) -> Iterator[bytes]:
+    """
+    Yields the compressed bytes of every stream starting at one of the given offsets.
+    """
+    with open(dump_file, 'rb') as f:
+        for start, end in zip(offsets, offsets[1:] + [None]):
+            f.seek(start)
+            yield f.read(end - start) if end is not None else f.read()
+
+
+class ParseFailures:
+    """
+    Counts the pages, that wiki_parser could not parse. They are yielded with empty parts and reported at the end of the
+    run with the titles and error messages of some of them.
+    """
+    def __init__(self):
+        self.num_pages = 0
+        self.num_failed = 0
+        self.examples: List[ParseFailure] = []
+
+    def add(self, num_pages: int, failed: List[ParseFailure]):
+        self.num_pages += num_pages
+        self.num_failed += len(failed)
+        self.examples.extend(failed[:MAX_REPORTED_FAILURES - len(self.examples)])
+
+    def report(self):
+        if self.num_failed == 0:
+            return
+        print('{} of {} pages could not be parsed, e.g.:'.format(self.num_failed, self.num_pages), flush=True)
+        for title, error in self.examples:
+            print('  {}: {}'.format(title, error[:MAX_ERROR_LENGTH]), flush=True)
+
+
+def to_pages(
+        titles: List[str], results: List[Tuple[Optional[list], Optional[str]]]
+) -> Tuple[List[ParsedPage], List[ParseFailure]]:
+    """
+    Pairs the titles with the (parts, error) results of wiki_parser.parse_wiki_batch.
+
+    :returns: The pages and the titles and error messages of the pages, that could not be parsed
+    """
+    failed = [(title, error) for title, (parts, error) in zip(titles, results) if parts is None]
+    return [(title, parts or []) for title, (parts, _) in zip(titles, results)], failed
+
+
+def parse_pages(header: str, block: bytes) -> Tuple[List[ParsedPage], List[ParseFailure]]:
+    """
+    Decompresses one stream and parses all pages in it.
+
+    :returns: A list of (title, parts) tuples, where parts is the result of wiki_parser.parse_wiki, and the titles and
+              error messages of the pages, that could not be parsed
+    """
+    import wiki_parser
+
+    text = bz2.decompress(block).decode('utf-8').replace(MEDIAWIKI_END_TAG, '')
+    dump = mwxml.Dump.from_file(io.StringIO(header + text + MEDIAWIKI_END_TAG))
+    titles = []
+    texts = []
+    for page in dump:
+        revision = next(page)
+        titles.append(page.title)
+        texts.append(revision.text or '')
+    # the pool already uses all cores, so parse with a single thread per worker
+    return to_pages(titles, wiki_parser.parse_wiki_batch(texts, num_threads=1))
+
+
+def _parse_pages_worker(args: Tuple[str, bytes]) -> Tuple[List[ParsedPage], List[ParseFailure]]:
+    header, block = args
+    return parse_pages(header, block)
+
+
+def iterate_parsed_pages(dump_file: str, index_file: str, num_workers: int) -> Iterator[ParsedPage]:
+    """
+    Parses the pages of a multistream dump with a pool of num_workers processes. Pages are yielded in the order in
+    which they appear in the dump. At most two streams per worker are read ahead of the consumer.
+    Pages that could not be parsed are yielded with empty parts and reported at the end.
+    """
+    offsets = read_stream_offsets(index_file)
+    header = read_header(dump_file, offsets[0])
+    tasks = ((header, block) for block in iterate_blocks(dump_file, offsets))
+    failures = ParseFailures()
+    try:
+        with multiprocessing.Pool(num_workers) as pool:
+            pending = []
+            for task in tasks:
+                pending.append(pool.apply_async(_parse_pages_worker, (task,)))
+                if len(pending) >= 2 * num_workers:
+                    yield from _collect(pending.pop(0).get(), failures)
+            for result in pending:
+                yield from _collect(result.get(), failures)
+    finally:
+        failures.report()
+
+
+def _collect(result: Tuple[List[ParsedPage], List[ParseFailure]], failures: ParseFailures) -> List[ParsedPage]:
+    pages, failed = result
+    failures.add(len(pages), failed)
+    return pages
+
+
+def iterate_parsed_pages_serial(dump_file: str, num_threads: Optional[int] = None) -> Iterator[ParsedPage]:
+    """
+    Reads the pages of any (multistream or not) dump in a single process. Pages are parsed in batches of
+    PARSE_BATCH_SIZE by wiki_parser.parse_wiki_batch, which uses num_threads threads.
+    Pages that could not be parsed are yielded with empty parts and reported at the end.
+    """
+    import wiki_parser
+
+    failures = ParseFailures()
+    try:
+        with bz2.open(dump_file, 'rt') as f:
+            dump = mwxml.Dump.from_file(f)
+            titles = []
+            texts = []
+            for page in dump:
+                revision = next(page)
+                titles.append(page.title)
+                texts.append(revision.text or '')
+                if len(texts) >= PARSE_BATCH_SIZE:
+                    yield from _collect(to_pages(titles, wiki_parser.parse_wiki_batch(texts, num_threads)), failures)
+                    titles = []
+                    texts = []
+            yield from _collect(to_pages(titles, wiki_parser.parse_wiki_batch(texts, num_threads)), failures)
+    finally:
+        failures.report()
@@ -0,0 +1,274 @@
+"""
+Persistent cache for text embeddings.
+
+The cache of one model lives in <cache_dir>/<model name>-<backend>/, because the backends do not produce exactly the
+same embeddings, and consists of:
+- keys.bin: 16 byte blake2b digests of the normalized texts, one per entry
+- vectors.bin: the float32 embeddings, one row per entry
+- ticks.npy: the time of the last access for every entry, used for LRU eviction
+- info.json: the dimension of the embeddings
+
+keys.bin and vectors.bin are only appended to, so entries written before a crash stay valid. If the cache grows beyond
+max_entries, the least recently used entries are removed by rewriting both files. This happens when the cache is closed
+and, during a run, whenever it grows EVICTION_SLACK beyond max_entries, so that the files are not rewritten on every
+put.
+"""
+import hashlib
+import json
+import os
+import threading
+from typing import List, Optional
+
+import numpy as np
+
+KEY_SIZE = 16
+KEY_FILE = 'keys.bin'
+VECTOR_FILE = 'vectors.bin'
+TICK_FILE = 'ticks.npy'
+INFO_FILE = 'info.json'
+MISS_BATCH_SIZE = 256
+# fraction of max_entries, by which the cache may grow during a run before it is evicted
+EVICTION_SLACK = 0.1
+
+
+def text_key(text: str) -> bytes:
+    normalized = ' '.join(text.split())
+    return hashlib.blake2b(normalized.encode('utf-8'), digest_size=KEY_SIZE).digest()
+
+
+class EmbeddingCache:
+    def __init__(self, cache_dir: str, model_name: str, backend: str, max_entries: Optional[int] = None):
+        self.directory = os.path.join(cache_dir, '{}-{}'.format(model_name, backend))
+        os.makedirs(self.directory, exist_ok=True)
+        self.max_entries = max_entries
+        self.dim: Optional[int] = None
+        self.rows = {}
+        self.ticks = np.zeros(0, dtype=np.int64)
+        self.tick = 0
+        self._vectors = None
+        self._key_file = None
+        self._vector_file = None
+        # lookup and put are called from different pipeline stages
+        self._lock = threading.Lock()
+        self._load()
+
+    def _path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def _load(self):
+        if not os.path.exists(self._path(INFO_FILE)):
+            return
+        with open(self._path(INFO_FILE), 'r') as f:
+            self.dim = json.load(f)['dim']
+        keys = b''
+        if os.path.exists(self._path(KEY_FILE)):
+            with open(self._path(KEY_FILE), 'rb') as f:
+                keys = f.read()
+        num_keys = len(keys) // KEY_SIZE
+        num_vectors = 0
+        if os.path.exists(self._path(VECTOR_FILE)):
+            num_vectors = os.path.getsize(self._path(VECTOR_FILE)) // (self.dim * 4)
+        # entries written partially before a crash are ignored
+        num_entries = min(num_keys, num_vectors)
+        self.rows = {keys[i * KEY_SIZE:(i + 1) * KEY_SIZE]: i for i in range(num_entries)}
+
+        self.ticks = np.zeros(num_entries, dtype=np.int64)
+        if os.path.exists(self._path(TICK_FILE)):
+            ticks = np.load(self._path(TICK_FILE))[:num_entries]
+            self.ticks[:len(ticks)] = ticks
+        self.tick = int(self.ticks.max(initial=0)) + 1
+        _truncate(self._path(KEY_FILE), num_entries * KEY_SIZE)
+        _truncate(self._path(VECTOR_FILE), num_entries * self.dim * 4)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _get_vectors(self) -> np.ndarray:
+        if self._vectors is None or self._vectors.shape[0] < len(self.rows):
+            if self._vector_file is not None:
+                self._vector_file.flush()
+            self._vectors = np.memmap(
+                self._path(VECTOR_FILE), dtype=np.float32, mode='r', shape=(len(self.rows), self.dim)
+            )
+        return self._vectors
+
+    def lookup(self, keys: List[bytes]):
+        """
+        Looks up the given keys.
+
+        :returns: A tuple (features, missing). features is a float32 array with one row per key, missing is a list of
+                  indices into keys, that are not cached. The rows of missing keys are undefined.
+        """
+        with self._lock:
+            return self._lookup(keys)
+
+    def _lookup(self, keys: List[bytes]):
+        rows = [self.rows.get(key, -1) for key in keys]
+        missing = [i for i, row in enumerate(rows) if row < 0]
+        if self.dim is None:
+            return None, missing
+        features = np.empty((len(keys), self.dim), dtype=np.float32)
+        hit_indices = np.array([i for i, row in enumerate(rows) if row >= 0], dtype=np.int64)
+        if len(hit_indices):
+            hit_rows = np.array([rows[i] for i in hit_indices], dtype=np.int64)
+            features[hit_indices] = self._get_vectors()[hit_rows]
+            self.ticks[hit_rows] = self.tick
+            self.tick += 1
+        return features, missing
+
+    def put(self, keys: List[bytes], features: np.ndarray):
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        with self._lock:
+            self._put(keys, features)
+
+    def _put(self, keys: List[bytes], features: np.ndarray):
+        if self.dim is None:
+            self.dim = features.shape[1]
+            with open(self._path(INFO_FILE), 'w') as f:
+                json.dump({'dim': self.dim}, f)
+        if self._key_file is None:
+            self._key_file = open(self._path(KEY_FILE), 'ab')
+            self._vector_file = open(self._path(VECTOR_FILE), 'ab')
+
+        new_ticks = []
+        for key, feature in zip(keys, features):
+            if key in self.rows:
+                continue
+            self.rows[key] = len(self.rows)
+            self._key_file.write(key)
+            self._vector_file.write(feature.tobytes())
+            new_ticks.append(self.tick)
+        self.ticks = np.concatenate([self.ticks, np.array(new_ticks, dtype=np.int64)])
+        self.tick += 1
+        if self.max_entries is not None and len(self.rows) > self.max_entries * (1 + EVICTION_SLACK):
+            self._close_files()
+            self._evict()
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        self._close_files()
+        if self.max_entries is not None and len(self.rows) > self.max_entries:
+            self._evict()
+        if self.dim is not None:
+            np.save(self._path(TICK_FILE), self.ticks)
+
+    def _close_files(self):
+        if self._key_file is not None:
+            self._key_file.close()
+            self._vector_file.close()
+            self._key_file = None
+            self._vector_file = None
+
+    def _evict(self):
+        """
+        Keeps only the max_entries most recently used entries.
+        """
+        keep = np.sort(np.argsort(self.ticks, kind='stable')[-self.max_entries:])
+        vectors = self._get_vectors()
+        keys = [None] * len(self.rows)
+        for key, row in self.rows.items():
+            keys[row] = key
+
+        with open(self._path(KEY_FILE + '.tmp'), 'wb') as f:
+            for row in keep:
+                f.write(keys[row])
+        with open(self._path(VECTOR_FILE + '.tmp'), 'wb') as f:
+            for start in range(0, len(keep), 4096):
+                f.write(np.ascontiguousarray(vectors[keep[start:start + 4096]]).tobytes())
+        self._vectors = None
+        del vectors
+        os.replace(self._path(KEY_FILE + '.tmp'), self._path(KEY_FILE))
+        os.replace(self._path(VECTOR_FILE + '.tmp'), self._path(VECTOR_FILE))
+
+        self.rows = {keys[row]: i for i, row in enumerate(keep)}
+        self.ticks = self.ticks[keep]
+        print('evicted {} entries from embedding cache'.format(len(keys) - len(keep)), flush=True)
+
+
+class CachedModelPipeline:
+    """
+    Wraps a ModelPipeline. Texts are first looked up in the cache, only the misses are encoded by the model.
+    """
+    def __init__(self, model, cache: EmbeddingCache, miss_batch_size: int = MISS_BATCH_SIZE):
+        self.model = model
+        self.cache = cache
+        self.miss_batch_size = miss_batch_size
+
+    def __getattr__(self, item):
+        return getattr(self.model, item)
+
+    def __call__(self, texts):
+        if isinstance(texts, str):
+            texts = [texts]
+        keys = [text_key(text) for text in texts]
+        features, missing = self.cache.lookup(keys)
+        if not missing:
+            return features
+
+        # encode every missing text only once
+        missing_indices = {}
+        for i in missing:
+            missing_indices.setdefault(keys[i], []).append(i)
+        missing_keys = list(missing_indices.keys())
+        for start in range(0, len(missing_keys), self.miss_batch_size):
+            batch_keys = missing_keys[start:start + self.miss_batch_size]
+            batch_texts = [texts[missing_indices[key][0]] for key in batch_keys]
+            batch_features = np.asarray(self.model(batch_texts), dtype=np.float32).reshape(len(batch_keys), -1)
+            self.cache.put(batch_keys, batch_features)
+            if features is None:
+                features = np.empty((len(texts), batch_features.shape[1]), dtype=np.float32)
+            for key, feature in zip(batch_keys, batch_features):
+                features[missing_indices[key]] = feature
+        return features
+
+    def tokenize_all(self, texts):
+        """
+        Looks up the texts in the cache and tokenizes the unique misses, which are the only texts, that are encoded.
+        The token counts and the batches refer to the misses.
+        """
+        keys = [text_key(text) for text in texts]
+        features, missing = self.cache.lookup(keys)
+        missing_indices = {}
+        for i in missing:
+            missing_indices.setdefault(keys[i], []).append(i)
+        if not missing_indices:
+            return [], (features, missing_indices, None, len(texts))
+        lengths, tokens = self.model.tokenize_all([texts[indices[0]] for indices in missing_indices.values()])
+        return lengths, (features, missing_indices, tokens, len(texts))
+
+    def batch_tokens(self, prepared, indices: np.ndarray):
+        return self.model.batch_tokens(prepared[2], indices)
+
+    def collect_features(self, prepared, miss_features: Optional[np.ndarray]) -> np.ndarray:
+        """
+        Stores the features of the misses in the cache and returns the features of all texts.
+        """
+        features, missing_indices, tokens, num_texts = prepared
+        if tokens is None:
+            return features
+        miss_features = self.model.collect_features(tokens, miss_features)
+        return self._fill_misses(features, missing_indices, miss_features, num_texts)
+
+    def _fill_misses(self, features, missing_indices, batch_features, num_texts):
+        batch_keys = list(missing_indices.keys())
+        batch_features = np.asarray(batch_features, dtype=np.float32).reshape(len(batch_keys), -1)
+        self.cache.put(batch_keys, batch_features)
+        if features is None:
+            features = np.empty((num_texts, batch_features.shape[1]), dtype=np.float32)
+        for key, feature in zip(batch_keys, batch_features):
+            features[missing_indices[key]] = feature
+        return features
+
+    def close(self):
+        self.cache.close()
+        if hasattr(self.model, 'close'):
+            self.model.close()
+
+
+def _truncate(path: str, size: int):
+    if os.path.exists(path) and os.path.getsize(path) > size:
+        with open(path, 'r+b') as f:
+            f.truncate(size)
@@ -1,18 +1,26 @@
 import argparse
-import bz2
-import json
 import os
 from dataclasses import dataclass
-from typing import Iterator, List
+from functools import partial
+from typing import List, Optional, Tuple
 
-import blingfire
+import numpy as np
 
 from tqdm import tqdm
 
-from models import load_model, get_models
-from utils import load_title_to_page_info, normalize_title
+from batching import BatchingEncoder, PreparedWindow
+from feature_store import read_description
+from feature_writer import FeatureWriter, is_finished
+from incremental import DeltaTracker, content_hash
+from metrics import METRICS, add_arguments, instrument, requested
+from models import BACKENDS, load_model, get_models, close_model
+from page_views import PAGE_VIEWS_DIR, RAW_PAGE_VIEWS_FILE, PageViews, load_page_views
+from pipeline import Pipeline
+from summary_reader import DEFAULT_NUM_WORKERS, ArticleSummary, iterate_articles, load_manifest, reader_pool
 
 BATCH_SIZE = 256
+WINDOW_SIZE = 4096
+DEFAULT_MAX_TOKENS = 32768
 MIN_WORDS_PER_PART = 20
 DEFAULT_MODEL = 'jina_clip'
 
@@ -30,48 +38,100 @@ def parse_args():
     parser.add_argument('data', type=str)
     parser.add_argument('outdir', type=str)
     parser.add_argument('--model', type=str, choices=list(get_models().keys()), default='jina_clip')
+    parser.add_argument('--backend', type=str, choices=BACKENDS, default='torch', help='inference backend of the model')
     parser.add_argument('--dry', '-d', action='store_true')
     parser.add_argument('-n', type=int, default=0)
+    parser.add_argument('--resume', action='store_true', help='continue from the last checkpoint in outdir')
+    parser.add_argument(
+        '--previous', type=str, default=None,
+        help='output directory of a previous build. If given, only new and changed articles are encoded into a delta.'
+    )
+    parser.add_argument(
+        '--max-tokens', type=int, default=DEFAULT_MAX_TOKENS,
+        help='token budget of a batch including padding. Use 0 to disable length bucketing and encode fixed size '
+             'batches of {} texts in arrival order.'.format(BATCH_SIZE)
+    )
+    parser.add_argument(
+        '--window', type=int, default=WINDOW_SIZE, help='number of texts, that are sorted by length for batching'
+    )
+    parser.add_argument(
+        '--queue-size', type=int, default=4, help='number of windows, that can wait between two pipeline stages'
+    )
+    parser.add_argument(
+        '--page-views', type=str, default=PAGE_VIEWS_DIR,
+        help='directory of the compiled page views. It is compiled from {} if it does not exist.'.format(
+            RAW_PAGE_VIEWS_FILE
+        )
+    )
+    parser.add_argument('--cache-dir', type=str, default=None, help='directory of the persistent embedding cache')
+    parser.add_argument(
+        '--max-cache-entries', type=int, default=None,
+        help='maximal number of embeddings kept in the cache. During a run, the cache may exceed it by 10%%.'
+    )
+    parser.add_argument(
+        '--checkpoint-every', type=int, default=50000, help='number of articles between two checkpoints'
+    )
+    parser.add_argument(
+        '--index-file', type=str, default=None,
+        help='multistream index of the dump file. If given, the dump is parsed in parallel.'
+    )
+    parser.add_argument(
+        '--parse-workers', type=int, default=None,
+        help='number of parser processes, or parser threads if no index file is given. Defaults to the number of '
+             'cores. For summary files the number of reader processes, defaults to {}.'.format(DEFAULT_NUM_WORKERS)
+    )
+    parser.add_argument(
+        '--workers', type=int, default=1, help='number of model replicas, that run in separate processes'
+    )
+    parser.add_argument(
+        '--threads-per-worker', type=int, default=None,
+        help='number of intra-op threads of every model replica. Defaults to the number of cores divided by workers.'
+    )
+    add_arguments(parser)
     return parser.parse_args()
 
 
-# noinspection PyUnresolvedReferences
+def iterate_dump_pages(args):
+    from dump_reader import iterate_parsed_pages, iterate_parsed_pages_serial
+    num_workers = args.parse_workers or os.cpu_count()
+    if args.index_file is not None:
+        return iterate_parsed_pages(args.data, args.index_file, num_workers)
+    return iterate_parsed_pages_serial(args.data, num_threads=num_workers)
+
+
 def encode_dump_file():
-    import mwxml
-    import wiki_parser
     args = parse_args()
     model = None
     if not args.dry:
-        model = load_model(args.model)
+        model = load_model(
+            args.model, cache_dir=args.cache_dir, max_cache_entries=args.max_cache_entries, workers=args.workers,
+            threads_per_worker=args.threads_per_worker, backend=args.backend
+        )
 
     links = []
     all_features = []
     current_batch = []
-    with bz2.open(args.data, 'rt') as f:
-        dump = mwxml.Dump.from_file(f)
-        for site_index, site in tqdm(enumerate(dump)):
-            if args.n and site_index == args.n:
-                break
-            current_title = site.title
-
-            # those articles discuss remove candidates
-            if 'Löschkandidaten' in current_title:
-                continue
-            current_link = get_link(current_title, None)
-            revision = next(site)
-            result = wiki_parser.parse_wiki(revision.text)
-            for heading, part in result:
-                if heading == 1:
-                    current_link = get_link(current_title, part)
-                else:
-                    if len(part.split()) > MIN_WORDS_PER_PART:
-                        links.append(current_link)
-                        current_batch.append(part)
-                        if len(current_batch) >= BATCH_SIZE:
-                            extract_features(all_features, current_batch, model)
-                            current_batch = []
+    for site_index, (current_title, result) in tqdm(enumerate(iterate_dump_pages(args))):
+        if args.n and site_index == args.n:
+            break
+
+        # those articles discuss remove candidates
+        if 'Löschkandidaten' in current_title:
+            continue
+        current_link = get_link(current_title, None)
+        for heading, part in result:
+            if heading == 1:
+                current_link = get_link(current_title, part)
+            else:
+                if len(part.split()) > MIN_WORDS_PER_PART:
+                    links.append(current_link)
+                    current_batch.append(part)
+                    if len(current_batch) >= BATCH_SIZE:
+                        extract_features(all_features, current_batch, model)
+                        current_batch = []
 
     extract_features(all_features, current_batch, model)
+    close_model(model)
 
     if not args.dry:
         output_file = os.path.join(args.outdir, 'features.bin')
@@ -85,118 +145,168 @@ def encode_dump_file():
     print('num links={}  num_features={}'.format(len(links), sum(f.shape[0] for f in all_features)))
 
 
-def count_articles(data_path):
-    return sum(1 for _ in tqdm(iterate_summary_files(data_path, fast=True), desc='counting articles'))
-
-
 def encode_summaries():
     args = parse_args()
+    num_workers = args.parse_workers or DEFAULT_NUM_WORKERS
+    # the reader processes are forked before the metrics, the model and the pipeline start their threads
+    with reader_pool(num_workers, requested(args)) as pool, instrument(args):
+        run_encode_summaries(args, num_workers, pool)
+
 
+def run_encode_summaries(args, num_workers: int, pool):
     if not os.path.exists(args.outdir):
         os.makedirs(args.outdir)
 
+    delta_tracker = None
+    if args.previous is not None:
+        if args.resume:
+            raise ValueError('--resume can not be combined with --previous')
+        delta_tracker = DeltaTracker(args.previous)
+    if args.resume and not args.dry and is_finished(args.outdir):
+        # checked before the model is loaded, FeatureWriter refuses to resume a finished run as well
+        print('{} already contains a finished run, nothing to resume'.format(args.outdir), flush=True)
+        return
+
     model = None
+    encoder = None
+    writer = None
+    start_article = 0
     if not args.dry:
-        model = load_model(args.model)
+        model = load_model(
+            args.model, cache_dir=args.cache_dir, max_cache_entries=args.max_cache_entries, workers=args.workers,
+            threads_per_worker=args.threads_per_worker, backend=args.backend
+        )
+        encoder = BatchingEncoder(model, args.max_tokens, BATCH_SIZE)
+        writer = FeatureWriter(args.outdir, args.model, resume=args.resume)
+        start_article = writer.articles
+    window_size = args.window if args.max_tokens else BATCH_SIZE
+
+    manifest = load_manifest(args.data)
+    end_article = min(args.n, manifest.num_articles) if args.n else manifest.num_articles
+
+    page_views = load_page_views(args.page_views)
+
+    articles = tqdm(
+        iterate_articles(manifest, start_article, end_article, num_workers=num_workers, pool=pool),
+        total=end_article, initial=start_article
+    )
+    window_builder = WindowBuilder(window_size, page_views, delta_tracker)
+    pipeline = Pipeline(queue_size=args.queue_size, consumer_name='write')
+    pipeline.source('read', enumerate(articles, start=start_article))
+    pipeline.stage('prepare', window_builder.add, flush=window_builder.flush)
+    if encoder is not None:
+        if getattr(model, 'separate_tokenization', True):
+            pipeline.stage('tokenize', partial(tokenize_window, encoder))
+            pipeline.stage('infer', partial(infer_window, encoder))
+        else:
+            # tokenize() only passes the texts through, a separate thread would just add a queue
+            pipeline.stage('encode', partial(encode_window, encoder))
+
+    num_rows = 0
+    last_checkpoint = start_article
+    for window in pipeline.run():
+        num_rows += len(window.texts)
+        METRICS.count('encode.rows', len(window.texts))
+        if writer is not None:
+            with METRICS.timer('encode.write'):
+                writer.append(window.features, window.meta, window.hashes)
+            if window.articles_end - last_checkpoint >= args.checkpoint_every:
+                with METRICS.timer('encode.checkpoint'):
+                    writer.checkpoint(window.articles_end)
+                last_checkpoint = window.articles_end
+
+    print(pipeline.report())
+    close_model(model)
+    if encoder is not None:
+        print(encoder.report())
+    num_features = 0
+    if writer is not None:
+        if delta_tracker is not None and writer.dim is None:
+            # no article was encoded, the empty delta keeps the layout of the previous build, so that it can be merged
+            previous = read_description(args.previous)
+            writer.dim, writer.dtype = previous['dim'], previous['dtype']
+        writer.close()
+        num_features = writer.num_rows
+        if delta_tracker is not None:
+            delta_tracker.write(args.outdir)
+
+    print('num links={}  num_features={}'.format(num_rows, num_features))
 
-    n_articles = count_articles(args.data)
 
-    title_to_views = load_title_to_page_info()
+@dataclass
+class Window:
+    texts: List[str]
+    meta: List[dict]
+    hashes: List[Tuple[str, str, int]]
+    # number of articles, that are completely contained in this and all previous windows
+    articles_end: int
+    prepared: Optional[PreparedWindow] = None
+    features: Optional[np.ndarray] = None
 
-    all_features = []
-    current_batch = []
-    meta_info = []
-    for index, article in enumerate(tqdm(iterate_summary_files(args.data), total=n_articles)):
-        if args.n and index == args.n:
-            break
-        link = get_link(article.title)
 
-        page_id = -1
-        views = 0
-        normed_title = normalize_title(article.title)
-        if normed_title in title_to_views:
-            page_id = title_to_views[normed_title].page_id
-            views = title_to_views[normed_title].views
+class WindowBuilder:
+    """
+    Turns articles into rows and collects the rows of consecutive articles into windows of at least window_size texts.
+    The page ids and views of all rows of a window are looked up at once, when the window is flushed.
+    """
+    def __init__(self, window_size: int, page_views: PageViews, delta_tracker: Optional[DeltaTracker]):
+        self.window_size = window_size
+        self.page_views = page_views
+        self.delta_tracker = delta_tracker
+        self.window = Window([], [], [], 0)
+
+    def add(self, indexed_article: Tuple[int, ArticleSummary]) -> Optional[Window]:
+        index, article = indexed_article
+        self.window.articles_end = index + 1
+
+        summary = article.summary[0] if article.summary else None
+        article_hash = content_hash(article.title, summary or '')
+        if self.delta_tracker is not None and not self.delta_tracker.needs_encoding(article.title, article_hash):
+            return None
+        link = get_link(article.title)
 
         # add title
-        meta_info.append({'link': link, 'title': article.title, 'page_id': page_id, 'views': views})
-        current_batch = add_to_batch(article.title, current_batch, model, all_features)
+        self.window.meta.append({'link': link, 'title': article.title, 'page_id': -1, 'views': 0})
+        self.window.texts.append(article.title)
 
         # add summary
-        if article.summary:
-            meta_info.append({'link': link, 'title': article.title, 'page_id': page_id, 'views': views})
-            current_batch = add_to_batch(article.summary[0], current_batch, model, all_features)
-
-    extract_features(all_features, current_batch, model)
-
-    if not args.dry:
-        dump_results(args.outdir, all_features, meta_info, args.model)
-
-    print('num links={}  num_features={}'.format(len(meta_info), sum(f.shape[0] for f in all_features)))
+        if summary:
+            self.window.meta.append({'link': link, 'title': article.title, 'page_id': -1, 'views': 0})
+            self.window.texts.append(summary)
 
+        self.window.hashes.append((article.title, article_hash, 2 if summary else 1))
 
-def dump_results(outdir, all_features, meta_info, model):
-    output_file = os.path.join(outdir, 'features.bin')
-    dump_vectors_to_binary(output_file, all_features)
-    print(f'Features saved to {output_file}')
+        if len(self.window.texts) >= self.window_size:
+            return self.flush()
+        return None
 
-    meta_file = os.path.join(outdir, 'meta.json')
-    with open(meta_file, 'w') as f:
-        json.dump(meta_info, f)
+    def flush(self) -> Optional[Window]:
+        window = self.window
+        self.window = Window([], [], [], window.articles_end)
+        if not window.texts:
+            return None
+        with METRICS.timer('encode.page_views'):
+            page_ids, views = self.page_views.lookup([meta['title'] for meta in window.meta])
+        for meta, page_id, row_views in zip(window.meta, page_ids.tolist(), views.tolist()):
+            meta['page_id'] = page_id
+            meta['views'] = row_views
+        return window
 
-    description = {
-        'dim': all_features[0].shape[1],
-        'num_samples': len(meta_info),
-        'model': model,
-    }
-    with open(os.path.join(outdir, 'description.json'), 'w') as f:
-        json.dump(description, f, indent=2)
 
+def tokenize_window(encoder: BatchingEncoder, window: Window) -> Window:
+    window.prepared = encoder.prepare(window.texts)
+    return window
 
-def add_to_batch(text, current_batch, model, all_features):
-    current_batch.append(text)
-    if len(current_batch) >= BATCH_SIZE:
-        extract_features(all_features, current_batch, model)
-        current_batch = []
-    return current_batch
 
+def encode_window(encoder: BatchingEncoder, window: Window) -> Window:
+    window.features = encoder(window.texts)
+    return window
 
-@dataclass
-class ArticleSummary:
-    title: str
-    summary: List[str]
-
-
-def iterate_summary_files(summary_dir, fast=False) -> Iterator[ArticleSummary]:
-    for input_file in sorted(os.listdir(summary_dir)):
-        if not input_file.endswith('.txt'):
-            continue
-        input_file = os.path.join(summary_dir, input_file)
-
-        with open(input_file, 'r') as f:
-            content = f.readlines()
-
-        current_title = None
-        current_content = []
-        for line in content:
-            line: str = line.strip()
-            if not line:
-                continue
-
-            if line.startswith('[[') and line.endswith(']]'):
-                if current_title is not None:
-                    yield ArticleSummary(current_title, current_content)
-                    current_content = []
-                current_title = line[2:-2]
-            else:
-                if fast:
-                    current_content.append(line)
-                else:
-                    sentences = blingfire.text_to_sentences(line).split('\n')
-                    current_content.extend(sentences)
 
-        if current_content:
-            yield ArticleSummary(current_title, current_content)
+def infer_window(encoder: BatchingEncoder, window: Window) -> Window:
+    window.features = encoder.encode(window.prepared)
+    window.prepared = None
+    return window
 
 
 def extract_features(all_features, batch, model):
@@ -215,7 +325,7 @@ def dump_vectors_to_binary(filename, vector_list):
         vector_list (list of numpy.ndarray): List of numpy arrays to save.
     """
     print(vector_list[0].shape, vector_list[0].dtype)
-    with open(filename, 'wb') as f:
+    with open(filename, 'wb') as f, METRICS.timer('encode.write'):
         for i, vector in enumerate(vector_list):
             data = vector.tobytes()
             f.write(data)
@@ -0,0 +1,111 @@
+import json
+import os
+from typing import Iterator, Optional
+
+import numpy as np
+
+from quantization import Quantizer, load_quantizer
+from utils import l2_normalize
+
+FEATURE_FILE = 'features.bin'
+DESCRIPTION_FILE = 'description.json'
+DEFAULT_DTYPE = 'float32'
+
+
+class FeatureStore:
+    """
+    Read only view of the features.bin file of an output directory. The file is memory mapped, so rows are only read
+    from disk, when they are accessed. Rows are quantized with quantizer, which defaults to the fixed quantization.
+    """
+    def __init__(
+            self, data_file: str, num_samples: int, dim: int, dtype: str = DEFAULT_DTYPE,
+            quantizer: Optional[Quantizer] = None
+    ):
+        self.data_file = data_file
+        self.num_samples = num_samples
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.data = np.memmap(data_file, dtype=self.dtype, mode='r', shape=(num_samples, dim))
+        self.quantizer = quantizer or Quantizer.fixed()
+
+    @staticmethod
+    def from_dir(indir: str, description: Optional[dict] = None) -> 'FeatureStore':
+        if description is None:
+            description = read_description(indir)
+        return FeatureStore(
+            os.path.join(indir, FEATURE_FILE), description['num_samples'], description['dim'],
+            description.get('dtype', DEFAULT_DTYPE), load_quantizer(indir, description)
+        )
+
+    def __len__(self):
+        return self.num_samples
+
+    def rows(self, start: int, end: int) -> np.ndarray:
+        """
+        Returns the rows [start, end) without copying them.
+        """
+        return self.data[start:end]
+
+    def read_rows(self, start: int, end: int, normalize: bool = False, quantize: bool = False, out=None):
+        """
+        Returns a processed copy of the rows [start, end).
+
+        :param start: The first row to read
+        :param end: The row after the last row to read
+        :param normalize: Whether to l2 normalize the rows
+        :param quantize: Whether to quantize the rows to uint8
+        :param out: Preallocated float32 buffer with at least end - start rows. Used as scratch space, if quantize is
+                    set.
+        """
+        n_rows = end - start
+        if out is None:
+            out = np.empty((n_rows, self.dim), dtype=np.float32)
+        buffer = out[:n_rows]
+        buffer[...] = self.data[start:end]
+        if normalize:
+            l2_normalize(buffer, out=buffer)
+        if quantize:
+            return self.quantizer(buffer, out=np.empty(buffer.shape, dtype=np.uint8))
+        return buffer
+
+    def iterate_chunks(
+            self, chunk_size: int, normalize: bool = False, quantize: bool = False, start: int = 0,
+            end: Optional[int] = None
+    ) -> Iterator[np.ndarray]:
+        """
+        Iterates over the rows [start, end) in chunks of chunk_size rows. The yielded arrays are reused between
+        iterations, so consumers have to copy them, if they need them after the next iteration. Without normalize and
+        quantize, the yielded chunks are views into the memory map.
+        """
+        if end is None:
+            end = self.num_samples
+        if not normalize and not quantize:
+            for min_index in range(start, end, chunk_size):
+                yield self.rows(min_index, min(min_index + chunk_size, end))
+            return
+
+        float_buffer = np.empty((chunk_size, self.dim), dtype=np.float32)
+        quantize_buffer = np.empty((chunk_size, self.dim), dtype=np.uint8) if quantize else None
+        for min_index in range(start, end, chunk_size):
+            max_index = min(min_index + chunk_size, end)
+            n_rows = max_index - min_index
+            chunk = float_buffer[:n_rows]
+            chunk[...] = self.data[min_index:max_index]
+            if normalize:
+                l2_normalize(chunk, out=chunk)
+            if quantize:
+                chunk = self.quantizer(chunk, out=quantize_buffer[:n_rows])
+            yield chunk
+
+
+def read_description(indir: str) -> dict:
+    with open(os.path.join(indir, DESCRIPTION_FILE), 'r') as f:
+        return json.load(f)
+
+
+def write_description(indir: str, description: dict):
+    # written to a temporary file first, so that description.json is never partially written
+    path = os.path.join(indir, DESCRIPTION_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(description, f, indent=2)
+    os.replace(path + '.tmp', path)
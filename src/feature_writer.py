@@ -0,0 +1,143 @@
+import json
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from feature_store import DESCRIPTION_FILE, FEATURE_FILE, write_description
+from incremental import HASH_FILE, format_hash_line
+from meta_store import MetaWriter
+
+CHECKPOINT_FILE = 'checkpoint.json'
+
+
+class FeatureWriter:
+    """
+    Appends features and meta information to the output directory as soon as they are produced.
+
+    features.bin is written row by row and the meta information is written to the columnar MetaStore in meta/. The
+    content hashes of the articles are written to hashes.tsv. Calling checkpoint() flushes all files and records their
+    sizes in checkpoint.json. With resume=True the writer truncates the files to the last checkpoint and continues from
+    there. close() writes description.json and removes the checkpoint, a finished run can not be resumed.
+    """
+    def __init__(self, outdir: str, model: str, resume: bool = False):
+        self.outdir = outdir
+        self.model = model
+        self.features_path = os.path.join(outdir, FEATURE_FILE)
+        self.hash_path = os.path.join(outdir, HASH_FILE)
+        self.checkpoint_path = os.path.join(outdir, CHECKPOINT_FILE)
+        self.dim: Optional[int] = None
+        self.dtype: Optional[str] = None
+        self.num_rows = 0
+        self.articles = 0
+
+        if resume and is_finished(outdir):
+            raise ValueError('The run in {} is already finished, start it again without --resume'.format(outdir))
+        checkpoint = self._load_checkpoint() if resume else None
+        if checkpoint is not None:
+            if checkpoint['model'] != model:
+                raise ValueError('Checkpoint was created with model "{}", but model "{}" was given'.format(
+                    checkpoint['model'], model
+                ))
+            self.dim = checkpoint['dim']
+            self.dtype = checkpoint['dtype']
+            self.num_rows = checkpoint['rows']
+            self.articles = checkpoint['articles']
+            self._features_file = _open_truncated(self.features_path, checkpoint['features_offset'], 'r+b')
+            self._meta_writer = MetaWriter(outdir, checkpoint['meta_offsets'])
+            self._hash_file = _open_truncated(self.hash_path, checkpoint['hash_offset'], 'r+b')
+            print('resuming after {} articles and {} rows'.format(self.articles, self.num_rows), flush=True)
+        else:
+            # the description of an earlier run would mark this run as finished
+            description_path = os.path.join(outdir, DESCRIPTION_FILE)
+            if os.path.exists(description_path):
+                os.remove(description_path)
+            self._features_file = open(self.features_path, 'wb')
+            self._meta_writer = MetaWriter(outdir)
+            self._hash_file = open(self.hash_path, 'wb')
+
+    def _load_checkpoint(self) -> Optional[dict]:
+        if not os.path.exists(self.checkpoint_path):
+            print('no checkpoint found in {}, starting from scratch'.format(self.outdir), flush=True)
+            return None
+        with open(self.checkpoint_path, 'r') as f:
+            return json.load(f)
+
+    def append(self, features: np.ndarray, meta_records: List[dict], article_hashes: List[Tuple[str, str, int]]):
+        """
+        Appends the features and their meta records.
+
+        :param features: The encoded rows
+        :param meta_records: One meta record per row
+        :param article_hashes: (title, content hash, number of rows) for every article in this batch, in row order
+        """
+        if features.shape[0] != len(meta_records):
+            raise ValueError('Got {} features but {} meta records'.format(features.shape[0], len(meta_records)))
+        row = self.num_rows
+        for title, article_hash, num_rows in article_hashes:
+            self._hash_file.write(format_hash_line(title, article_hash, row, num_rows).encode('utf-8'))
+            row += num_rows
+        if self.dim is None:
+            self.dim = features.shape[1]
+            self.dtype = str(features.dtype)
+        self._features_file.write(features.tobytes())
+        self._meta_writer.append(meta_records)
+        self.num_rows += len(meta_records)
+
+    def checkpoint(self, articles: int):
+        """
+        Persists the current state. articles is the number of input articles, whose rows are completely written.
+        """
+        self.articles = articles
+        self._features_file.flush()
+        self._hash_file.flush()
+        os.fsync(self._features_file.fileno())
+        os.fsync(self._hash_file.fileno())
+        self._meta_writer.flush()
+        checkpoint = {
+            'articles': articles,
+            'rows': self.num_rows,
+            'features_offset': self._features_file.tell(),
+            'meta_offsets': self._meta_writer.offsets(),
+            'hash_offset': self._hash_file.tell(),
+            'dim': self.dim,
+            'dtype': self.dtype,
+            'model': self.model,
+        }
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f, indent=2)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def close(self):
+        self._features_file.close()
+        self._meta_writer.close()
+        self._hash_file.close()
+
+        description = {
+            'dim': self.dim,
+            'num_samples': self.num_rows,
+            'dtype': self.dtype,
+            'model': self.model,
+        }
+        write_description(self.outdir, description)
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        print(f'Features saved to {self.features_path}')
+
+
+def is_finished(outdir: str) -> bool:
+    """
+    Whether a FeatureWriter was closed in outdir, i.e. description.json was written and the checkpoint removed.
+    """
+    return (
+        os.path.exists(os.path.join(outdir, DESCRIPTION_FILE))
+        and not os.path.exists(os.path.join(outdir, CHECKPOINT_FILE))
+    )
+
+
+def _open_truncated(path: str, size: int, mode: str):
+    f = open(path, mode)
+    f.truncate(size)
+    f.seek(size)
+    return f
@@ -0,0 +1,159 @@
+"""
+Exact nearest neighbour search by scanning all rows.
+
+The rows are read in blocks of BLOCK_SIZE rows, the distances of all queries to a block are computed with one matrix
+product and the k best rows are kept with argpartition. The squared norms of the rows are computed once, when the
+index is loaded. By default, the blocks are scanned by the calling thread and the matrix products use the threads of
+BLAS. With num_threads, the row range is split between the threads of an executor, that is kept for all searches. Every
+thread keeps its own top-k and the results are merged at the end. BLAS should then be limited to one thread (e.g. with
+OMP_NUM_THREADS=1), so that the threads do not oversubscribe the cpu. Deleted rows get an infinite distance.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+from feature_store import FeatureStore, read_description
+from incremental import load_deleted_rows
+from utils import l2_normalize
+
+FLAT_FILE = 'index.flat'
+BLOCK_SIZE = 4096
+
+
+class FlatIndex:
+    def __init__(
+            self, store: FeatureStore, metric: str = 'l2', normalize: bool = False, quantize: bool = False,
+            block_size: int = BLOCK_SIZE, num_threads: Optional[int] = None, deleted: Sequence[int] = ()
+    ):
+        """
+        :param store: The rows to search
+        :param metric: "l2" (squared euclidean distance) or "cosine" (1 - cosine similarity)
+        :param normalize: Whether to l2 normalize the rows while reading them
+        :param quantize: Whether to quantize the rows while reading them. Rows of an uint8 store are used as they are.
+        :param block_size: Number of rows per matrix product
+        :param num_threads: Number of threads, that scan the rows. Defaults to one, the matrix products are
+                            parallelized by BLAS.
+        :param deleted: Rows, that are never returned
+        """
+        if metric not in ('l2', 'cosine'):
+            raise ValueError('Unknown metric: {}'.format(metric))
+        self.store = store
+        self.metric = metric
+        self.normalize = normalize
+        self.quantize = quantize
+        self.block_size = block_size
+        self.num_threads = num_threads or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.num_threads) if self.num_threads > 1 else None
+        self.deleted = np.unique(np.asarray(deleted, dtype=np.int64))
+        self.row_norms = self._compute_row_norms()
+
+    @staticmethod
+    def from_dir(indir: str, description: Optional[dict] = None) -> 'FlatIndex':
+        """
+        Uses the processed rows of index.flat written by create_graph.py. Without normalize and quantize, no such file
+        is needed and features.bin is scanned directly. The rows deleted by merged deltas are skipped.
+        """
+        if description is None:
+            description = read_description(indir)
+        deleted = load_deleted_rows(indir)
+        flat_file = os.path.join(indir, FLAT_FILE)
+        if os.path.exists(flat_file):
+            dtype = 'uint8' if description.get('quantize') else 'float32'
+            store = FeatureStore(flat_file, description['num_samples'], description['dim'], dtype)
+            return FlatIndex(store, deleted=deleted)
+        return FlatIndex(
+            FeatureStore.from_dir(indir, description), normalize=description.get('normalize', False),
+            quantize=description.get('quantize', False), deleted=deleted
+        )
+
+    def __len__(self):
+        return self.store.num_samples
+
+    def _read_block(self, start: int, end: int, buffer: np.ndarray) -> np.ndarray:
+        if self.normalize or self.quantize:
+            block = self.store.read_rows(start, end, self.normalize, self.quantize, out=buffer)
+        else:
+            block = self.store.rows(start, end)
+        return block.astype(np.float32, copy=False)
+
+    def _compute_row_norms(self) -> np.ndarray:
+        """
+        Returns the squared l2 norm of every row, as it is searched.
+        """
+        row_norms = np.empty(len(self), dtype=np.float32)
+        buffer = np.empty((self.block_size, self.store.dim), dtype=np.float32)
+        for start in range(0, len(self), self.block_size):
+            end = min(start + self.block_size, len(self))
+            block = self._read_block(start, end, buffer)
+            row_norms[start:end] = np.einsum('ij,ij->i', block, block)
+        return row_norms
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the indices and distances of the k nearest rows of every query, sorted by distance.
+        """
+        queries = np.atleast_2d(queries).astype(np.float32)
+        if self.metric == 'cosine':
+            queries = l2_normalize(queries)
+        k = min(k, len(self) - len(self.deleted))
+
+        num_blocks = (len(self) + self.block_size - 1) // self.block_size
+        blocks_per_thread = max(1, (num_blocks + self.num_threads - 1) // self.num_threads)
+        ranges = [
+            (block * self.block_size, min((block + blocks_per_thread) * self.block_size, len(self)))
+            for block in range(0, num_blocks, blocks_per_thread)
+        ]
+        if self.executor is None or len(ranges) == 1:
+            results = [self._search_range(queries, k, start, end) for start, end in ranges]
+        else:
+            results = list(self.executor.map(lambda r: self._search_range(queries, k, *r), ranges))
+
+        indices = np.concatenate([r[0] for r in results], axis=1)
+        distances = np.concatenate([r[1] for r in results], axis=1)
+        indices, distances = top_k(indices, distances, k)
+        order = np.argsort(distances, axis=1)
+        return np.take_along_axis(indices, order, axis=1), np.take_along_axis(distances, order, axis=1)
+
+    def _search_range(self, queries: np.ndarray, k: int, start: int, end: int) -> Tuple[np.ndarray, np.ndarray]:
+        query_norms = (queries ** 2).sum(axis=1, keepdims=True)
+        buffer = np.empty((self.block_size, self.store.dim), dtype=np.float32)
+        best_indices = np.zeros((len(queries), 0), dtype=np.int64)
+        best_distances = np.zeros((len(queries), 0), dtype=np.float32)
+        for block_start in range(start, end, self.block_size):
+            block_end = min(block_start + self.block_size, end)
+            block = self._read_block(block_start, block_end, buffer)
+            row_norms = self.row_norms[block_start:block_end]
+
+            products = queries @ block.T
+            if self.metric == 'cosine':
+                distances = 1 - products / np.maximum(np.sqrt(row_norms), 1e-12)
+            else:
+                distances = query_norms - 2 * products + row_norms
+            mask_deleted(distances, self.deleted, block_start, block_end)
+            indices = np.broadcast_to(np.arange(block_start, block_end, dtype=np.int64), distances.shape)
+
+            best_indices = np.concatenate([best_indices, indices], axis=1)
+            best_distances = np.concatenate([best_distances, distances.astype(np.float32, copy=False)], axis=1)
+            best_indices, best_distances = top_k(best_indices, best_distances, k)
+        return best_indices, best_distances
+
+
+def mask_deleted(distances: np.ndarray, deleted: np.ndarray, start: int, end: int):
+    """
+    Sets the distances of the sorted deleted rows in [start, end) to infinity. distances has one column per row.
+    """
+    first, last = np.searchsorted(deleted, [start, end])
+    if first < last:
+        distances[:, deleted[first:last] - start] = np.inf
+
+
+def top_k(indices: np.ndarray, distances: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Keeps the k smallest distances of every row, unsorted.
+    """
+    if distances.shape[1] <= k:
+        return indices, distances
+    keep = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(indices, keep, axis=1), np.take_along_axis(distances, keep, axis=1)
@@ -0,0 +1,96 @@
+"""
+Import time report of the entry points.
+
+Imports every entry point in a fresh interpreter with "-X importtime" and reports its total import time and the heavy
+dependencies, that were imported on the way. An entry point must not import the dependencies listed as forbidden for
+it at module level, they are only needed by some of its backends. The report exits with status 1 on such a regression:
+
+    python src/import_report.py
+"""
+import argparse
+import os
+import subprocess
+import sys
+from typing import List, Tuple
+
+from tables import Table
+
+MODEL_DEPENDENCIES = ['torch', 'transformers', 'open_clip', 'onnxruntime']
+INDEX_DEPENDENCIES = ['hnswlib', 'deglib']
+HEAVY_MODULES = MODEL_DEPENDENCIES + INDEX_DEPENDENCIES + ['onnx', 'tqdm', 'mwxml', 'blingfire']
+# entry point -> modules, that it must not import at module level
+ENTRY_POINTS = {
+    'create_graph': MODEL_DEPENDENCIES + INDEX_DEPENDENCIES + ['tqdm'],
+    'search_graph': MODEL_DEPENDENCIES + INDEX_DEPENDENCIES,
+    'search_service': MODEL_DEPENDENCIES + INDEX_DEPENDENCIES,
+    'benchmark': MODEL_DEPENDENCIES + INDEX_DEPENDENCIES,
+    'encode_text': MODEL_DEPENDENCIES + INDEX_DEPENDENCIES,
+    'meta_store': MODEL_DEPENDENCIES + INDEX_DEPENDENCIES + ['tqdm'],
+    'quantization': MODEL_DEPENDENCIES + INDEX_DEPENDENCIES + ['tqdm'],
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Report the import time of the entry points.')
+    parser.add_argument('modules', nargs='*', default=list(ENTRY_POINTS), help='entry points to check')
+    parser.add_argument('--top', type=int, default=0, help='also print the slowest top level imports of every module')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    table = Table(('Entry point', 'Import ms', 'Heavy imports', 'Forbidden imports'))
+    failed = False
+    for module in args.modules:
+        try:
+            imports = import_times(module)
+        except RuntimeError as e:
+            print(e)
+            table.line(entry_point=module, import_ms='-', heavy_imports='-', forbidden_imports='import failed')
+            failed = True
+            continue
+        packages = {name.split('.')[0] for name, _, _ in imports}
+        forbidden = sorted(packages.intersection(ENTRY_POINTS.get(module, [])))
+        failed = failed or bool(forbidden)
+        # the interpreter startup (site, encodings) is not part of the import of the entry point
+        total_ms = sum(cumulative for name, cumulative, level in imports if name == module and level == 0) / 1000
+        table.line(
+            entry_point=module, import_ms=total_ms,
+            heavy_imports=', '.join(sorted(packages.intersection(HEAVY_MODULES))) or '-',
+            forbidden_imports=', '.join(forbidden) or '-',
+        )
+        if args.top > 0:
+            top_level = sorted((i for i in imports if i[2] == 0), key=lambda i: i[1], reverse=True)[:args.top]
+            print('{}: {}'.format(module, ', '.join(
+                '{} {:.1f}ms'.format(name, cumulative / 1000) for name, cumulative, _ in top_level
+            )))
+    print(table)
+    sys.exit(1 if failed else 0)
+
+
+def import_times(module: str) -> List[Tuple[str, int, int]]:
+    """
+    Imports module in a new interpreter and returns (name, cumulative microseconds, nesting level) of every import.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError('importing {} failed:\n{}'.format(module, result.stderr.strip().splitlines()[-1]))
+    return parse_import_times(result.stderr)
+
+
+def parse_import_times(output: str) -> List[Tuple[str, int, int]]:
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), int(cumulative), level))
+    return imports
+
+
+if __name__ == '__main__':
+    main()
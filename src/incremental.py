@@ -0,0 +1,262 @@
+"""
+Support for encoding only the articles that changed since a previous build.
+
+Every build stores a content hash for each article in hashes.tsv next to meta.json. The columns are title, content hash,
+first row and number of rows of the article in features.bin. An incremental build compares the new corpus against these
+hashes, encodes only new and changed articles and writes a delta. The delta is a normal output directory with two
+additional files:
+- tombstones.json: the sorted rows of the previous build, that belong to changed or deleted articles
+- delta.json: the path of the previous build and some statistics
+
+merge_delta appends a delta to its previous build, so that the index of the previous build can be updated with
+"create_graph.py append". The merged deltas are recorded in description.json, so a delta can only be merged once. The
+sizes of features.bin and of the meta files before the merge are written to merge.json and the files, that the merge
+rewrites, are copied to <name>.premerge. Both are removed after the merge. If merge.json still exists, the last merge
+failed and it is rolled back before the next merge, unless description.json already records the delta. Then only the
+clean up was interrupted and the merge is completed. The tombstones of merged deltas, that were not yet removed from
+the index, are kept in pending_tombstones.json. The tombstones of all merged deltas are kept in deleted.json, so that a
+full build of the index leaves them out as well.
+"""
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from typing import Dict, List, Set, Tuple
+
+from feature_store import FEATURE_FILE, read_description, write_description
+from meta_store import META_DIR, MetaStore, MetaWriter
+
+HASH_FILE = 'hashes.tsv'
+TOMBSTONE_FILE = 'tombstones.json'
+DELTA_FILE = 'delta.json'
+DELETED_FILE = 'deleted.json'
+MERGE_JOURNAL_FILE = 'merge.json'
+PENDING_TOMBSTONE_FILE = 'pending_tombstones.json'
+# files, that are rewritten by a merge and restored by a rollback
+REWRITTEN_FILES = [HASH_FILE, DELETED_FILE, PENDING_TOMBSTONE_FILE]
+BACKUP_SUFFIX = '.premerge'
+MERGE_BATCH_SIZE = 4096
+
+
+def content_hash(title: str, summary: str) -> str:
+    return hashlib.blake2b('{}\n{}'.format(title, summary).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def format_hash_line(title: str, article_hash: str, first_row: int, num_rows: int) -> str:
+    return '{}\t{}\t{}\t{}\n'.format(title, article_hash, first_row, num_rows)
+
+
+def load_hashes(build_dir: str) -> Dict[str, Tuple[str, int, int]]:
+    """
+    Returns a dict mapping titles to (content hash, first row, number of rows) for the build in build_dir.
+    """
+    hashes = {}
+    with open(os.path.join(build_dir, HASH_FILE), 'r', encoding='utf-8') as f:
+        for line in f:
+            title, article_hash, first_row, num_rows = line.rstrip('\n').split('\t')
+            hashes[title] = (article_hash, int(first_row), int(num_rows))
+    return hashes
+
+
+class DeltaTracker:
+    """
+    Decides which articles of a new corpus have to be encoded and collects the rows of the previous build, that have to
+    be removed.
+    """
+    def __init__(self, previous_dir: str):
+        self.previous_dir = os.path.abspath(previous_dir)
+        self.previous = load_hashes(previous_dir)
+        self.seen: Set[str] = set()
+        self.tombstones: List[int] = []
+        self.num_new = 0
+        self.num_changed = 0
+        self.num_unchanged = 0
+
+    def needs_encoding(self, title: str, article_hash: str) -> bool:
+        self.seen.add(title)
+        previous = self.previous.get(title)
+        if previous is None:
+            self.num_new += 1
+            return True
+        previous_hash, first_row, num_rows = previous
+        if previous_hash == article_hash:
+            self.num_unchanged += 1
+            return False
+        self.num_changed += 1
+        self.tombstones.extend(range(first_row, first_row + num_rows))
+        return True
+
+    def write(self, outdir: str):
+        num_deleted = 0
+        for title, (_, first_row, num_rows) in self.previous.items():
+            if title not in self.seen:
+                self.tombstones.extend(range(first_row, first_row + num_rows))
+                num_deleted += 1
+
+        with open(os.path.join(outdir, TOMBSTONE_FILE), 'w') as f:
+            json.dump(sorted(self.tombstones), f)
+
+        delta = {
+            'id': uuid.uuid4().hex,
+            'base': self.previous_dir,
+            'num_new': self.num_new,
+            'num_changed': self.num_changed,
+            'num_unchanged': self.num_unchanged,
+            'num_deleted': num_deleted,
+            'num_tombstones': len(self.tombstones),
+        }
+        with open(os.path.join(outdir, DELTA_FILE), 'w') as f:
+            json.dump(delta, f, indent=2)
+        print('new={}  changed={}  unchanged={}  deleted={}'.format(
+            self.num_new, self.num_changed, self.num_unchanged, num_deleted
+        ))
+
+
+def delta_id(delta_dir: str, delta: dict) -> str:
+    # deltas written before ids were introduced are identified by their path
+    return delta.get('id', os.path.abspath(delta_dir))
+
+
+def rollback_merge(base_dir: str):
+    """
+    Restores features.bin, the meta files and the rewritten files to their state before a merge, that did not finish.
+    A merge, that was interrupted after description.json was written, is completed instead.
+    """
+    journal_path = os.path.join(base_dir, MERGE_JOURNAL_FILE)
+    if not os.path.exists(journal_path):
+        return
+    with open(journal_path, 'r') as f:
+        journal = json.load(f)
+    if journal['delta'] in read_description(base_dir).get('merged_deltas', []):
+        _remove_backups(base_dir, journal['existing_files'])
+        os.remove(journal_path)
+        print('completed the interrupted merge of {}'.format(journal['delta']), flush=True)
+        return
+    with open(os.path.join(base_dir, FEATURE_FILE), 'r+b') as f:
+        f.truncate(journal['feature_bytes'])
+    MetaWriter(base_dir, journal['meta_offsets']).close()
+    for filename in REWRITTEN_FILES:
+        path = os.path.join(base_dir, filename)
+        if filename in journal['existing_files']:
+            os.replace(path + BACKUP_SUFFIX, path)
+        elif os.path.exists(path):
+            os.remove(path)
+    os.remove(journal_path)
+    print('rolled back the unfinished merge of {}'.format(journal['delta']), flush=True)
+
+
+def load_pending_tombstones(base_dir: str) -> List[int]:
+    return _load_rows(os.path.join(base_dir, PENDING_TOMBSTONE_FILE))
+
+
+def load_deleted_rows(base_dir: str) -> List[int]:
+    """
+    Returns the sorted rows of features.bin, that were deleted by merged deltas.
+    """
+    return _load_rows(os.path.join(base_dir, DELETED_FILE))
+
+
+def _load_rows(path: str) -> List[int]:
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def clear_pending_tombstones(base_dir: str):
+    path = os.path.join(base_dir, PENDING_TOMBSTONE_FILE)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _remove_backups(base_dir: str, filenames: List[str]):
+    for filename in filenames:
+        path = os.path.join(base_dir, filename + BACKUP_SUFFIX)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _write_json(path: str, data):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+
+def merge_delta(base_dir: str, delta_dir: str) -> List[int]:
+    """
+    Appends the features, meta information and hashes of a delta to its previous build and returns the tombstones,
+    that have to be removed from the index, including those of earlier merges, that did not reach the index.
+    The rows of the delta get the row numbers following the rows of the previous build. The tombstones of all merged
+    deltas are collected in deleted.json of the previous build.
+    """
+    with open(os.path.join(delta_dir, DELTA_FILE), 'r') as f:
+        delta = json.load(f)
+    if os.path.abspath(delta['base']) != os.path.abspath(base_dir):
+        raise ValueError('{} is a delta of {}, not of {}'.format(delta_dir, delta['base'], base_dir))
+    rollback_merge(base_dir)
+    base_description = read_description(base_dir)
+    merged_deltas = base_description.get('merged_deltas', [])
+    if delta_id(delta_dir, delta) in merged_deltas:
+        raise ValueError('{} was already merged into {}'.format(delta_dir, base_dir))
+    delta_description = read_description(delta_dir)
+    for key in ('dim', 'dtype', 'model'):
+        if base_description.get(key) != delta_description.get(key):
+            raise ValueError('{} of the delta ({}) does not match the previous build ({})'.format(
+                key, delta_description.get(key), base_description.get(key)
+            ))
+    with open(os.path.join(delta_dir, TOMBSTONE_FILE), 'r') as f:
+        tombstones = json.load(f)
+    base_rows = base_description['num_samples']
+    delta_rows = delta_description['num_samples']
+
+    base_meta = MetaStore(os.path.join(base_dir, META_DIR))
+    meta_offsets = base_meta.writer_offsets()
+    existing_files = [name for name in REWRITTEN_FILES if os.path.exists(os.path.join(base_dir, name))]
+    for filename in existing_files:
+        shutil.copyfile(os.path.join(base_dir, filename), os.path.join(base_dir, filename + BACKUP_SUFFIX))
+    _write_json(os.path.join(base_dir, MERGE_JOURNAL_FILE), {
+        'delta': delta_id(delta_dir, delta),
+        'feature_bytes': os.path.getsize(os.path.join(base_dir, FEATURE_FILE)),
+        'meta_offsets': meta_offsets,
+        'existing_files': existing_files,
+    })
+
+    with open(os.path.join(delta_dir, FEATURE_FILE), 'rb') as src, \
+            open(os.path.join(base_dir, FEATURE_FILE), 'ab') as dst:
+        shutil.copyfileobj(src, dst)
+
+    delta_meta = MetaStore(os.path.join(delta_dir, META_DIR))
+    meta_writer = MetaWriter(base_dir, meta_offsets)
+    for start in range(0, delta_rows, MERGE_BATCH_SIZE):
+        meta_writer.append([delta_meta[row] for row in range(start, min(start + MERGE_BATCH_SIZE, delta_rows))])
+    meta_writer.close()
+
+    deleted_rows = set(tombstones)
+    hashes = {
+        title: value for title, value in load_hashes(base_dir).items() if value[1] not in deleted_rows
+    }
+    for title, (article_hash, first_row, num_rows) in load_hashes(delta_dir).items():
+        hashes[title] = (article_hash, first_row + base_rows, num_rows)
+    tmp_path = os.path.join(base_dir, HASH_FILE + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for title, (article_hash, first_row, num_rows) in sorted(hashes.items(), key=lambda item: item[1][1]):
+            f.write(format_hash_line(title, article_hash, first_row, num_rows))
+    os.replace(tmp_path, os.path.join(base_dir, HASH_FILE))
+
+    deleted_path = os.path.join(base_dir, DELETED_FILE)
+    if os.path.exists(deleted_path):
+        with open(deleted_path, 'r') as f:
+            deleted_rows.update(json.load(f))
+    _write_json(deleted_path, sorted(deleted_rows))
+    pending = sorted(set(load_pending_tombstones(base_dir)).union(tombstones))
+    _write_json(os.path.join(base_dir, PENDING_TOMBSTONE_FILE), pending)
+
+    base_description['num_samples'] = base_rows + delta_rows
+    base_description['merged_deltas'] = merged_deltas + [delta_id(delta_dir, delta)]
+    # replacing description.json commits the merge, an interruption after it is completed by rollback_merge
+    write_description(base_dir, base_description)
+    _remove_backups(base_dir, existing_files)
+    os.remove(os.path.join(base_dir, MERGE_JOURNAL_FILE))
+    print('merged {} rows and {} tombstones into {}'.format(delta_rows, len(tombstones), base_dir), flush=True)
+    return pending
@@ -0,0 +1,7 @@
+"""
+File names of the graph indexes in an output directory, shared by the scripts, that build, search and benchmark them.
+The flat and pq indexes define their file names in their own modules.
+"""
+INDEX_FILES = {'hnsw': 'index.hnsw', 'deglib': 'index.deg'}
+# index types, that can be split into shards by "create_graph.py --shards"
+SHARDED_INDEX_TYPES = list(INDEX_FILES)
@@ -0,0 +1,133 @@
+"""
+Runs several replicas of a model in separate processes, for machines without gpu.
+
+The worker processes are started with "spawn" and load their own replica of the model. Forking a process, in which
+torch already created its thread pools, can deadlock the children. The main process only loads the tokenizer to count
+the tokens of the texts, so the weights are held once per worker. Each worker uses a fixed number of intra-op threads,
+so the workers together do not oversubscribe the cpu.
+"""
+import multiprocessing
+import os
+import queue
+from typing import Any, Callable, List, Optional, Tuple
+
+import numpy as np
+
+# seconds between two checks, whether the workers are still alive, while waiting for results
+RESULT_POLL_INTERVAL = 5.0
+
+
+class InferencePool:
+    # the workers tokenize themselves
+    separate_tokenization = False
+
+    def __init__(
+            self, model, load_model: Callable[[], Any], num_workers: int, threads_per_worker: Optional[int] = None
+    ):
+        """
+        :param model: The pipeline of this process without weights, used for the tokenizer and the attributes of the
+                      model
+        :param load_model: Picklable function, that loads the replica of a worker
+        """
+        if threads_per_worker is None:
+            threads_per_worker = max(1, os.cpu_count() // num_workers)
+        self.model = model
+        context = multiprocessing.get_context('spawn')
+        self.task_queues = [context.Queue() for _ in range(num_workers)]
+        self.result_queue = context.Queue()
+        self.workers = [
+            context.Process(
+                target=_run_worker, args=(load_model, threads_per_worker, task_queue, self.result_queue), daemon=True
+            )
+            for task_queue in self.task_queues
+        ]
+        for worker in self.workers:
+            worker.start()
+        # the number of characters, that are currently queued per worker
+        self.load = np.zeros(num_workers, dtype=np.int64)
+
+    def __getattr__(self, item):
+        return getattr(self.model, item)
+
+    def tokenize(self, texts: List[str]) -> List[str]:
+        # the workers tokenize themselves
+        return texts
+
+    def tokenize_all(self, texts: List[str]) -> Tuple[List[int], List[str]]:
+        # only the token counts are computed here, the workers tokenize the batches themselves
+        return self.model.count_tokens(texts), texts
+
+    def batch_tokens(self, texts: List[str], indices: np.ndarray) -> List[str]:
+        return [texts[i] for i in indices]
+
+    def collect_features(self, _texts: List[str], features: np.ndarray) -> np.ndarray:
+        return features
+
+    def encode_tokens(self, texts: List[str]) -> np.ndarray:
+        return self.encode_batches([texts])[0]
+
+    def encode_batches(self, batches: List[List[str]]) -> List[Any]:
+        """
+        Sends every batch to the worker with the least queued characters and returns the features in the order of
+        the batches.
+        """
+        owners = []
+        costs = []
+        for task_id, texts in enumerate(batches):
+            worker_index = int(np.argmin(self.load))
+            cost = sum(len(text) for text in texts)
+            self.load[worker_index] += cost
+            owners.append(worker_index)
+            costs.append(cost)
+            self.task_queues[worker_index].put((task_id, texts))
+
+        results = [None] * len(batches)
+        for _ in range(len(batches)):
+            task_id, features, error = self._get_result()
+            if error is not None:
+                raise RuntimeError('Inference worker failed: {}'.format(error))
+            self.load[owners[task_id]] -= costs[task_id]
+            results[task_id] = features
+        return results
+
+    def _get_result(self):
+        """
+        Waits for the next result and raises, if a worker died, so that a crashed worker does not block forever.
+        """
+        while True:
+            try:
+                return self.result_queue.get(timeout=RESULT_POLL_INTERVAL)
+            except queue.Empty:
+                for worker in self.workers:
+                    if not worker.is_alive():
+                        raise RuntimeError(
+                            'Inference worker {} exited with code {}'.format(worker.name, worker.exitcode)
+                        )
+
+    def __call__(self, texts: List[str]):
+        return self.encode_tokens(texts)
+
+    def close(self):
+        for task_queue in self.task_queues:
+            task_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+def _run_worker(load_model: Callable[[], Any], num_threads: int, task_queue, result_queue):
+    import torch
+    torch.set_num_threads(num_threads)
+    try:
+        model = load_model()
+    except Exception as e:
+        result_queue.put((None, None, 'loading the model failed: {!r}'.format(e)))
+        return
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        task_id, texts = task
+        try:
+            result_queue.put((task_id, model(texts), None))
+        except Exception as e:
+            result_queue.put((task_id, None, repr(e)))
@@ -0,0 +1,116 @@
+"""
+Load generator for search_service.py.
+
+Opens --concurrency keep-alive connections, each sending one query after the other for --duration seconds, and reports
+the client side latency percentiles and queries per second together with the /stats of the service.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import List, Optional
+from urllib.parse import quote
+
+import numpy as np
+
+from tables import Table
+
+DEFAULT_QUERIES = [
+    'dax steigt',
+    'probleme mit knieschmerzen',
+    'raubtier auf der jagd',
+    'alter der erde',
+    'wie alt ist unser planet?',
+    'wodurch ist der tyrannosaurus ausgestorben',
+    'hauptstadt von frankreich',
+    'erfinder des buchdrucks',
+    'höchster berg der alpen',
+    'sinfonie von bruckner',
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--concurrency', '-c', type=int, default=16, help='number of parallel connections')
+    parser.add_argument('--duration', '-d', type=float, default=30.0, help='duration of the test in seconds')
+    parser.add_argument('--queries', type=str, default=None, help='file with one query per line')
+    parser.add_argument('-n', type=int, default=20, help='number of results per query')
+    return parser.parse_args()
+
+
+async def request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, target: str) -> dict:
+    writer.write('GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n'.format(target).encode('latin-1'))
+    await writer.drain()
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed by server')
+    content_length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, value = line.decode('latin-1').split(':', 1)
+        if key.strip().lower() == 'content-length':
+            content_length = int(value)
+    return json.loads(await reader.readexactly(content_length))
+
+
+async def run_client(args, queries: List[str], end_time: float, latencies: List[float], errors: List[str]):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    try:
+        while time.perf_counter() < end_time:
+            query = random.choice(queries)
+            start_time = time.perf_counter()
+            response = await request(reader, writer, '/search?q={}&n={}'.format(quote(query), args.n))
+            if 'error' in response:
+                errors.append(response['error'])
+            else:
+                latencies.append(time.perf_counter() - start_time)
+    finally:
+        writer.close()
+
+
+async def fetch_stats(args) -> Optional[dict]:
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    try:
+        return await request(reader, writer, '/stats')
+    finally:
+        writer.close()
+
+
+async def run(args):
+    queries = DEFAULT_QUERIES
+    if args.queries is not None:
+        with open(args.queries, 'r') as f:
+            queries = [line.strip() for line in f if line.strip()]
+
+    latencies = []
+    errors = []
+    start_time = time.perf_counter()
+    end_time = start_time + args.duration
+    await asyncio.gather(*(
+        run_client(args, queries, end_time, latencies, errors) for _ in range(args.concurrency)
+    ))
+    duration = time.perf_counter() - start_time
+
+    latencies_ms = np.array(latencies) * 1000
+    table = Table(('Concurrency', 'Requests', 'Errors', 'QPS', 'p50 ms', 'p99 ms', 'Mean ms'))
+    table.line(
+        concurrency=args.concurrency, requests=len(latencies), errors=len(errors), qps=len(latencies) / duration,
+        p50_ms=float(np.percentile(latencies_ms, 50)) if len(latencies) else '-',
+        p99_ms=float(np.percentile(latencies_ms, 99)) if len(latencies) else '-',
+        mean_ms=float(latencies_ms.mean()) if len(latencies) else '-',
+    )
+    print(table)
+    print('service stats: {}'.format(json.dumps(await fetch_stats(args), indent=2)))
+
+
+def main():
+    asyncio.run(run(parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+"""
+Columnar, memory mapped storage of the meta information of an output directory.
+
+Consecutive rows with the same title and link (the title and the summary of an article) share one page entry. The files
+in <outdir>/meta/ are:
+- row_page.bin: uint32, the page of every row
+- page_id.bin, views.bin: int64, the wikipedia page id and the page views of every page
+- titles.bin, links.bin: the utf-8 encoded titles and links of all pages, concatenated
+- title_offsets.bin, link_offsets.bin: uint64, the end offset of every title/link in titles.bin/links.bin, preceded by
+  a zero
+
+Running this file converts the meta.json of an older output directory.
+"""
+import argparse
+import json
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+
+META_DIR = 'meta'
+ROW_PAGE_FILE = 'row_page.bin'
+PAGE_ID_FILE = 'page_id.bin'
+VIEWS_FILE = 'views.bin'
+TITLES_FILE = 'titles.bin'
+TITLE_OFFSETS_FILE = 'title_offsets.bin'
+LINKS_FILE = 'links.bin'
+LINK_OFFSETS_FILE = 'link_offsets.bin'
+META_FILES = [
+    ROW_PAGE_FILE, PAGE_ID_FILE, VIEWS_FILE, TITLES_FILE, TITLE_OFFSETS_FILE, LINKS_FILE, LINK_OFFSETS_FILE
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Convert the meta.json of an output directory to the columnar format.')
+    parser.add_argument('indir', type=str)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with open(os.path.join(args.indir, 'meta.json'), 'r') as f:
+        meta_info = json.load(f)
+    writer = MetaWriter(args.indir)
+    writer.append(meta_info)
+    writer.close()
+    store = MetaStore(os.path.join(args.indir, META_DIR))
+    print('converted {} rows with {} pages'.format(len(store), store.num_pages))
+
+
+class MetaWriter:
+    """
+    Writes the meta information row by row. If offsets is given, the files are truncated to these offsets (as returned
+    by offsets()) and the writer continues from there.
+    """
+    def __init__(self, outdir: str, offsets: Optional[Dict] = None):
+        self.directory = os.path.join(outdir, META_DIR)
+        os.makedirs(self.directory, exist_ok=True)
+        self._files = {}
+        if offsets is None:
+            for filename in META_FILES:
+                self._files[filename] = open(self._path(filename), 'wb')
+            self._files[TITLE_OFFSETS_FILE].write(np.zeros(1, dtype=np.uint64).tobytes())
+            self._files[LINK_OFFSETS_FILE].write(np.zeros(1, dtype=np.uint64).tobytes())
+            self.num_pages = 0
+            self.last_page = None
+            self.title_end = 0
+            self.link_end = 0
+        else:
+            for filename in META_FILES:
+                f = open(self._path(filename), 'r+b')
+                f.truncate(offsets['files'][filename])
+                f.seek(offsets['files'][filename])
+                self._files[filename] = f
+            self.num_pages = offsets['num_pages']
+            self.last_page = tuple(offsets['last_page']) if offsets['last_page'] is not None else None
+            self.title_end = offsets['files'][TITLES_FILE]
+            self.link_end = offsets['files'][LINKS_FILE]
+
+    def _path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    def append(self, records: List[dict]):
+        row_pages = np.empty(len(records), dtype=np.uint32)
+        for i, record in enumerate(records):
+            page = (record['title'], record['link'])
+            if page != self.last_page:
+                self._add_page(record)
+                self.last_page = page
+            row_pages[i] = self.num_pages - 1
+        self._files[ROW_PAGE_FILE].write(row_pages.tobytes())
+
+    def _add_page(self, record: dict):
+        title = record['title'].encode('utf-8')
+        link = record['link'].encode('utf-8')
+        self.title_end += len(title)
+        self.link_end += len(link)
+        self._files[TITLES_FILE].write(title)
+        self._files[LINKS_FILE].write(link)
+        self._files[TITLE_OFFSETS_FILE].write(np.array([self.title_end], dtype=np.uint64).tobytes())
+        self._files[LINK_OFFSETS_FILE].write(np.array([self.link_end], dtype=np.uint64).tobytes())
+        self._files[PAGE_ID_FILE].write(np.array([record['page_id']], dtype=np.int64).tobytes())
+        self._files[VIEWS_FILE].write(np.array([record['views']], dtype=np.int64).tobytes())
+        self.num_pages += 1
+
+    def flush(self):
+        for f in self._files.values():
+            f.flush()
+            os.fsync(f.fileno())
+
+    def offsets(self) -> Dict:
+        return {
+            'files': {filename: f.tell() for filename, f in self._files.items()},
+            'num_pages': self.num_pages,
+            'last_page': self.last_page,
+        }
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+
+
+class MetaStore:
+    """
+    Read only access to the meta information. store[i] returns the same dict as the i-th entry of meta.json.
+    """
+    def __init__(self, directory: str):
+        self.row_page = _map(os.path.join(directory, ROW_PAGE_FILE), np.uint32)
+        self.page_id = _map(os.path.join(directory, PAGE_ID_FILE), np.int64)
+        self.views = _map(os.path.join(directory, VIEWS_FILE), np.int64)
+        self.titles = _map(os.path.join(directory, TITLES_FILE), np.uint8)
+        self.title_offsets = _map(os.path.join(directory, TITLE_OFFSETS_FILE), np.uint64)
+        self.links = _map(os.path.join(directory, LINKS_FILE), np.uint8)
+        self.link_offsets = _map(os.path.join(directory, LINK_OFFSETS_FILE), np.uint64)
+        self.num_pages = len(self.page_id)
+
+    def __len__(self):
+        return len(self.row_page)
+
+    def title(self, page: int) -> str:
+        return _read_string(self.titles, self.title_offsets, page)
+
+    def link(self, page: int) -> str:
+        return _read_string(self.links, self.link_offsets, page)
+
+    def __getitem__(self, row: int) -> dict:
+        page = int(self.row_page[row])
+        return {
+            'link': self.link(page),
+            'title': self.title(page),
+            'page_id': int(self.page_id[page]),
+            'views': int(self.views[page]),
+        }
+
+    def row_views(self) -> np.ndarray:
+        """
+        Returns the page views of every row.
+        """
+        return self.views[self.row_page]
+
+    def writer_offsets(self) -> Dict:
+        """
+        Returns the offsets for a MetaWriter, that appends rows to this store.
+        """
+        last_page = None
+        if self.num_pages > 0:
+            last_page = (self.title(self.num_pages - 1), self.link(self.num_pages - 1))
+        sizes = {
+            ROW_PAGE_FILE: self.row_page, PAGE_ID_FILE: self.page_id, VIEWS_FILE: self.views, TITLES_FILE: self.titles,
+            TITLE_OFFSETS_FILE: self.title_offsets, LINKS_FILE: self.links, LINK_OFFSETS_FILE: self.link_offsets,
+        }
+        return {
+            'files': {filename: int(array.nbytes) for filename, array in sizes.items()},
+            'num_pages': self.num_pages,
+            'last_page': last_page,
+        }
+
+
+def load_meta(indir: str):
+    """
+    Returns the MetaStore of an output directory. Falls back to the full meta.json for output directories, that were
+    not converted yet.
+    """
+    meta_dir = os.path.join(indir, META_DIR)
+    if os.path.exists(meta_dir):
+        return MetaStore(meta_dir)
+    print('(no columnar meta data found, use "python src/meta_store.py {}" to convert) '.format(indir), end='')
+    with open(os.path.join(indir, 'meta.json'), 'r') as f:
+        return json.load(f)
+
+
+def _map(path: str, dtype) -> np.ndarray:
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+def _read_string(data: np.ndarray, offsets: np.ndarray, index: int) -> str:
+    return data[int(offsets[index]):int(offsets[index + 1])].tobytes().decode('utf-8')
+
+
+if __name__ == '__main__':
+    main()
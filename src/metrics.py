@@ -0,0 +1,344 @@
+"""
+Lightweight timers, counters and histograms for the encode and search pipelines.
+
+All instrumented code records into the module level registry METRICS, which is disabled by default. A disabled timer is
+a shared no-op context manager, so the instrumentation costs one attribute lookup per call. Entry points add the
+arguments of add_arguments() and wrap their run into instrument(args), which enables the registry if --metrics or
+--profile is given:
+- --metrics <file>: snapshots with histograms, rates and the RSS are appended to <file> as json lines every
+  --metrics-interval seconds and at the end of the run. If the file ends with .prom, it is overwritten with the latest
+  snapshot in the Prometheus text format instead.
+- --profile <file>: "sample" (the default) samples the stacks of all threads every few milliseconds and writes them in
+  the collapsed format ("frame;frame;frame count"), which can be read by flamegraph.pl or speedscope, like the output
+  of py-spy. "cprofile" profiles only the main thread with cProfile and writes a pstats file. The encode pipeline runs
+  its stages in other threads, so "cprofile" is only useful for the search scripts.
+
+Histograms use fixed power of two buckets, so their percentiles are upper bounds with a factor of two resolution.
+"""
+import argparse
+import bisect
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, Iterator, Optional
+
+from tables import Table
+from utils import rss_mb
+
+# upper bounds of the buckets, from about 8 microseconds (or 1/131072 of any unit) to 65536
+BUCKETS = [2.0 ** exponent for exponent in range(-17, 17)]
+PERCENTILES = [50, 90, 99]
+DEFAULT_INTERVAL = 60.0
+PROFILE_MODES = ['cprofile', 'sample']
+SAMPLE_INTERVAL = 0.005
+
+
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+
+    def merge(self, other: 'Histogram'):
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def percentile(self, percentile: float) -> float:
+        """
+        Returns the upper bound of the bucket containing the given percentile, at most the maximum.
+        """
+        rank = self.count * percentile / 100
+        seen = 0
+        for bound, bucket_count in zip(BUCKETS + [self.max], self.buckets):
+            seen += bucket_count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self, uptime: float) -> dict:
+        result = {
+            'count': self.count, 'sum': self.sum, 'mean': self.sum / self.count if self.count else 0.0,
+            'min': self.min if self.count else 0.0, 'max': self.max,
+            'per_second': self.count / uptime if uptime > 0 else 0.0,
+        }
+        for percentile in PERCENTILES:
+            result['p{}'.format(percentile)] = self.percentile(percentile) if self.count else 0.0
+        return result
+
+
+class _Timer:
+    def __init__(self, metrics: 'Metrics', name: str):
+        self.metrics = metrics
+        self.name = name
+        self.start_time = 0.0
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start_time)
+        return False
+
+
+_NO_TIMER = contextlib.nullcontext()
+
+
+class Metrics:
+    """
+    Registry of named counters and histograms. Timers record seconds into the histogram of their name.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.counters: Dict[str, float] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self.start_time = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.reset()
+        self.enabled = True
+
+    def reset(self):
+        """
+        Drops all values and restarts the uptime, that the rates are computed from.
+        """
+        self.take()
+        self.start_time = time.perf_counter()
+
+    def timer(self, name: str):
+        if not self.enabled:
+            return _NO_TIMER
+        return _Timer(self, name)
+
+    def count(self, name: str, value: float = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def take(self) -> dict:
+        """
+        Returns and resets all values. Worker processes return this to the main process, which calls merge().
+        """
+        with self._lock:
+            state = {'counters': self.counters, 'histograms': self.histograms}
+            self.counters = {}
+            self.histograms = {}
+        return state
+
+    def merge(self, state: dict):
+        if not self.enabled:
+            return
+        with self._lock:
+            for name, value in state['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, histogram in state['histograms'].items():
+                self.histograms.setdefault(name, Histogram()).merge(histogram)
+
+    def snapshot(self) -> dict:
+        uptime = time.perf_counter() - self.start_time
+        with self._lock:
+            return {
+                'time': time.time(),
+                'uptime_s': uptime,
+                'rss_mb': rss_mb(),
+                'counters': {
+                    name: {'value': value, 'per_second': value / uptime if uptime > 0 else 0.0}
+                    for name, value in sorted(self.counters.items())
+                },
+                'histograms': {name: h.as_dict(uptime) for name, h in sorted(self.histograms.items())},
+            }
+
+    def write(self, path: str):
+        snapshot = self.snapshot()
+        if path.endswith('.prom'):
+            # written to a temporary file first, so that a scraper never reads a partial file
+            with open(path + '.tmp', 'w') as f:
+                f.write(format_prometheus(snapshot))
+            os.replace(path + '.tmp', path)
+        else:
+            with open(path, 'a') as f:
+                f.write(json.dumps(snapshot) + '\n')
+
+
+METRICS = Metrics()
+
+
+def init_worker(enabled: bool):
+    """
+    Initializer of pool processes, which return METRICS.take() with their results. Depending on the start method, a
+    worker inherits the values of the main process or not, so they are dropped and enabled is set explicitly.
+    """
+    METRICS.take()
+    METRICS.enabled = enabled
+
+
+def _metric_name(name: str) -> str:
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+def format_prometheus(snapshot: dict) -> str:
+    lines = [
+        '# TYPE process_resident_memory_mb gauge', 'process_resident_memory_mb {}'.format(snapshot['rss_mb']),
+        '# TYPE uptime_seconds gauge', 'uptime_seconds {}'.format(snapshot['uptime_s']),
+    ]
+    for name, counter in snapshot['counters'].items():
+        name = _metric_name(name)
+        lines.append('# TYPE {}_total counter'.format(name))
+        lines.append('{}_total {}'.format(name, counter['value']))
+    for name, histogram in snapshot['histograms'].items():
+        name = _metric_name(name)
+        lines.append('# TYPE {} summary'.format(name))
+        for percentile in PERCENTILES:
+            lines.append('{}{{quantile="{}"}} {}'.format(name, percentile / 100, histogram['p{}'.format(percentile)]))
+        lines.append('{}_sum {}'.format(name, histogram['sum']))
+        lines.append('{}_count {}'.format(name, histogram['count']))
+    return '\n'.join(lines) + '\n'
+
+
+class StackSampler:
+    """
+    Samples the python stacks of all threads in a background thread and counts the collapsed stacks.
+    """
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+                    frame = frame.f_back
+                frames.append(names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(frames))] += 1
+
+    def stop(self, path: str):
+        self._stop.set()
+        self._thread.join()
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+
+def summary() -> Table:
+    """
+    Returns a table with the statistics of all histograms.
+    """
+    snapshot = METRICS.snapshot()
+    table = Table(('Metric', 'Count', 'Mean', 'P50', 'P99', 'Max', 'Per second'))
+    for name, histogram in snapshot['histograms'].items():
+        table.line(
+            metric=name, count=histogram['count'], mean=histogram['mean'], p50=histogram['p50'],
+            p99=histogram['p99'], max=histogram['max'], per_second=histogram['per_second']
+        )
+    return table
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        '--metrics', type=str, default=None,
+        help='file for metrics snapshots, json lines or Prometheus text format if it ends with .prom'
+    )
+    parser.add_argument(
+        '--metrics-interval', type=float, default=DEFAULT_INTERVAL, help='seconds between two metrics snapshots'
+    )
+    parser.add_argument('--profile', type=str, default=None, help='file for the profile of the whole run')
+    parser.add_argument(
+        '--profile-mode', type=str, choices=PROFILE_MODES, default='sample',
+        help='"sample" samples the stacks of all threads, "cprofile" profiles only the main thread, so it does not see '
+             'the stages of the encode pipeline'
+    )
+
+
+def requested(args) -> bool:
+    """
+    Returns whether instrument(args) enables the metrics.
+    """
+    return args.metrics is not None or args.profile is not None
+
+
+@contextlib.contextmanager
+def instrument(args) -> Iterator[None]:
+    """
+    Enables the metrics and the profiler requested by the arguments of add_arguments() for the duration of the block.
+    """
+    if not requested(args):
+        yield
+        return
+    METRICS.enable()
+    stop_export = threading.Event()
+    exporter = None
+    if args.metrics is not None:
+        def export():
+            while not stop_export.wait(args.metrics_interval):
+                METRICS.write(args.metrics)
+        exporter = threading.Thread(target=export, name='metrics-export', daemon=True)
+        exporter.start()
+
+    profiler: Optional[cProfile.Profile] = None
+    sampler: Optional[StackSampler] = None
+    if args.profile is not None and args.profile_mode == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif args.profile is not None:
+        sampler = StackSampler()
+        sampler.start()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+        if sampler is not None:
+            sampler.stop(args.profile)
+        if sampler is not None or profiler is not None:
+            print('profile written to {}'.format(args.profile), flush=True)
+        if exporter is not None:
+            stop_export.set()
+            exporter.join()
+            METRICS.write(args.metrics)
+            print(summary())
+            print('metrics written to {}'.format(args.metrics), flush=True)
+
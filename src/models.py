@@ -1,12 +1,22 @@
+"""
+The model pipelines. torch, transformers and open_clip are only imported, when a model is created, so that importing
+this module (e.g. for BACKENDS or the model names) stays cheap.
+"""
+import functools
 import os
-from typing import List
+from typing import Any, List, Tuple
 
-import torch
-import open_clip
-from transformers import AutoTokenizer, AutoModel
+import numpy as np
+
+
+BACKENDS = ['torch', 'onnx', 'onnx-int8']
 
 
 def get_models():
+    """
+    Returns the registry of all models, mapping their names to factories. Nothing is imported until a factory is
+    called. With load_weights=False, the factories return a pipeline, that only has the tokenizer.
+    """
     return {
         'e5_base': ModelPipeline.create_e5_base_sts_en_de,
         'jina': ModelPipeline.create_jina_embeddings_v3,
@@ -16,68 +26,217 @@ def get_models():
 
 
 class ModelPipeline:
-    def __init__(self, name, tokenizer, model):
+    def __init__(self, name, tokenizer, model=None):
+        """
+        :param model: The torch model. Without it, the pipeline can only tokenize.
+        """
         self.name = name
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.tokenizer = tokenizer
-        self.model = model.to(self.device)
+        self.device = None
+        self.model = None
+        if model is not None:
+            import torch
+            self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+            self.model = model.to(self.device)
 
     @staticmethod
-    def create_e5_base_sts_en_de():
+    def create_e5_base_sts_en_de(load_weights: bool = True):
+        from transformers import AutoTokenizer, AutoModel
         tokenizer = AutoTokenizer.from_pretrained("danielheinz/e5-base-sts-en-de")
+        if not load_weights:
+            return ModelPipeline('e5-base', tokenizer)
         model = AutoModel.from_pretrained("danielheinz/e5-base-sts-en-de")
         return ModelPipeline('e5-base', tokenizer, model)
 
     @staticmethod
-    def create_jina_embeddings_v3():
+    def create_jina_embeddings_v3(load_weights: bool = True):
+        from transformers import AutoTokenizer, AutoModel
         tokenizer = AutoTokenizer.from_pretrained("jinaai/jina-embeddings-v3")
+        if not load_weights:
+            return ModelPipeline('jina', tokenizer)
         model = AutoModel.from_pretrained("jinaai/jina-embeddings-v3", trust_remote_code=True)
         return ModelPipeline('jina', tokenizer, model)
 
     @staticmethod
-    def create_jina_clip_v2():
+    def create_jina_clip_v2(load_weights: bool = True):
+        from transformers import AutoTokenizer, AutoModel
         tokenizer = AutoTokenizer.from_pretrained("jinaai/jina-clip-v2")
+        if not load_weights:
+            return ModelPipeline('jina_clip', tokenizer)
         model = AutoModel.from_pretrained("jinaai/jina-clip-v2", trust_remote_code=True)
         return ModelPipeline('jina_clip', tokenizer, model)
 
     @staticmethod
-    def create_mcip_vit_l14():
+    def create_mcip_vit_l14(load_weights: bool = True):
+        import open_clip
+        import torch
+        name = "ViT-L-14-336"
+        tokenizer = open_clip.get_tokenizer(name)
+        if not load_weights:
+            return ModelPipeline('mcip_vit_l14', tokenizer)
+
         model_path = os.environ.get('MCIP_VIT_L14_PATH')
         if model_path is None:
             raise ValueError('Environment variable MCIP_VIT_L14_PATH is not set')
-        name = "ViT-L-14-336"
         model, _, transform = open_clip.create_model_and_transforms(name, pretrained="openai")
 
-        tokenizer = open_clip.get_tokenizer(name)
-
         mcip_state_dict = torch.load(model_path)
         model.load_state_dict(mcip_state_dict, strict=True)
 
         return ModelPipeline('mcip_vit_l14', tokenizer, model)
 
-    def __call__(self, texts: List[str]):
+    @property
+    def separate_tokenization(self) -> bool:
+        """
+        Whether tokenize() does the tokenization, so that it pays off to run it in its own pipeline stage.
+        """
+        # jina clip tokenizes inside encode_text
+        return self.name != 'jina_clip'
+
+    def count_tokens(self, texts: List[str]) -> List[int]:
+        """
+        Returns the number of tokens of every text after truncation, without padding.
+        """
+        if self.name == 'mcip_vit_l14':
+            # open_clip always pads to the context length, padding tokens are zero
+            return (self.tokenizer(texts) != 0).sum(dim=1).tolist()
+        return [len(ids) for ids in self.tokenizer(texts, truncation=True)['input_ids']]
+
+    def tokenize(self, texts: List[str]):
+        """
+        Prepares the texts for encode_tokens(). This is separated from the forward pass, so both can run in different
+        threads.
+        """
+        if self.name == 'jina_clip':
+            # jina clip tokenizes inside encode_text
+            return texts
+        if self.name == 'mcip_vit_l14':
+            return self.tokenizer(texts)
+        return self.tokenizer(texts, padding=True, truncation=True, return_tensors="pt")
+
+    def tokenize_all(self, texts: List[str]) -> Tuple[List[int], Any]:
+        """
+        Tokenizes the texts without padding. Returns the number of tokens of every text after truncation and the tokens,
+        from which batch_tokens() takes the padded batches, so that batches can be planned without a second
+        tokenization.
+        """
+        if self.name == 'jina_clip':
+            # jina clip tokenizes inside encode_text
+            return self.count_tokens(texts), texts
+        if self.name == 'mcip_vit_l14':
+            tokens = self.tokenizer(texts)
+            return (tokens != 0).sum(dim=1).tolist(), tokens
+        encoding = self.tokenizer(texts, truncation=True)
+        return [len(ids) for ids in encoding['input_ids']], encoding
+
+    def batch_tokens(self, tokens, indices: np.ndarray):
+        """
+        Returns the input of encode_tokens() for the texts at indices of tokenize_all().
+        """
+        if self.name == 'jina_clip':
+            return [tokens[i] for i in indices]
+        if self.name == 'mcip_vit_l14':
+            import torch
+            return tokens[torch.from_numpy(np.asarray(indices, dtype=np.int64))]
+        return self.tokenizer.pad(
+            {key: [values[i] for i in indices] for key, values in tokens.items()}, return_tensors="pt"
+        )
+
+    def collect_features(self, _tokens, features: np.ndarray) -> np.ndarray:
+        """
+        Returns the features of all texts of tokenize_all() from the features of the encoded texts.
+        """
+        return features
+
+    def encode_tokens(self, tokens):
+        import torch
         with torch.no_grad():
             if self.name == 'jina_clip':
-                return self.model.encode_text(texts)
+                return self.model.encode_text(tokens)
             if self.name == 'mcip_vit_l14':
-                tokens = self.tokenizer(texts).to(self.device)
-                return self.model.encode_text(tokens).cpu().numpy()
-            tokens = self.tokenizer(texts, padding=True, truncation=True, return_tensors="pt")
+                return self.model.encode_text(tokens.to(self.device)).cpu().numpy()
             tokens = {key: val.to(self.device) for key, val in tokens.items()}
             result = self.model(**tokens)
             result = result.last_hidden_state.detach().mean(dim=1)
             result = result.to(torch.float32)
             return result.cpu().numpy()
 
+    def encode_batches(self, batches: List[Any]) -> List[np.ndarray]:
+        """
+        Encodes a list of tokenized batches.
+        """
+        return [self.encode_tokens(tokens) for tokens in batches]
 
-def load_model(model, verbose=True):
+    def __call__(self, texts: List[str]):
+        return self.encode_tokens(self.tokenize(texts))
+
+
+def load_model(
+        model, verbose=True, cache_dir=None, max_cache_entries=None, workers=1, threads_per_worker=None,
+        backend='torch'
+):
+    """
+    Loads the model with the given name. backend is one of BACKENDS. The onnx backends run the model with ONNX Runtime,
+    "onnx-int8" uses a dynamically quantized version. If workers is greater than one, the model is run by an
+    InferencePool with this number of processes, which load their own replica, and this process only loads the
+    tokenizer. If cache_dir is given, the model is wrapped into a CachedModelPipeline, that stores all embeddings in
+    cache_dir.
+    """
     if verbose:
         print('loading model... ', end='', flush=True)
-    models = get_models()
-    if model in models:
-        loaded_model = models[model]()
+    if workers > 1:
+        from inference_pool import InferencePool
+        loaded_model = InferencePool(
+            load_tokenizer(model, backend), functools.partial(load_backend_model, model, backend), workers,
+            threads_per_worker
+        )
     else:
-        raise ValueError('Unknown model: {}'.format(model))
+        loaded_model = load_backend_model(model, backend)
+    if cache_dir is not None:
+        from embedding_cache import CachedModelPipeline, EmbeddingCache
+        loaded_model = CachedModelPipeline(
+            loaded_model, EmbeddingCache(cache_dir, model, backend, max_cache_entries)
+        )
     if verbose:
         print('done', flush=True)
     return loaded_model
+
+
+def load_backend_model(model: str, backend: str):
+    """
+    Loads the model with the given name for one of BACKENDS.
+    """
+    models = get_models()
+    if model not in models:
+        raise ValueError('Unknown model: {}'.format(model))
+    if backend == 'torch':
+        return models[model]()
+    if backend in ('onnx', 'onnx-int8'):
+        from onnx_backend import load_onnx_model
+        return load_onnx_model(model, quantize=backend == 'onnx-int8')
+    raise ValueError('Unknown backend: {}'.format(backend))
+
+
+def load_tokenizer(model: str, backend: str):
+    """
+    Loads a pipeline of the model with the given name for one of BACKENDS, that only has the tokenizer. The onnx
+    backends export the model first, if it is not yet cached, so that the workers of an InferencePool do not export it
+    at the same time.
+    """
+    models = get_models()
+    if model not in models:
+        raise ValueError('Unknown model: {}'.format(model))
+    if backend == 'torch':
+        return models[model](load_weights=False)
+    if backend in ('onnx', 'onnx-int8'):
+        from onnx_backend import load_onnx_tokenizer
+        return load_onnx_tokenizer(model, quantize=backend == 'onnx-int8')
+    raise ValueError('Unknown backend: {}'.format(backend))
+
+
+def close_model(model):
+    """
+    Persists the embedding cache and stops the worker processes of the model, if it has them.
+    """
+    if model is not None and hasattr(model, 'close'):
+        model.close()
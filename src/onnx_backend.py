@@ -0,0 +1,211 @@
+"""
+ONNX Runtime backend for the text encoders in models.py.
+
+The text encoder of a model is exported to ONNX once and cached on disk together with its tokenizer. Optionally the
+exported model is quantized to int8 with dynamic quantization. Running this file compares the embeddings of the ONNX
+backend with the PyTorch embeddings on a sample of texts.
+"""
+import argparse
+import os
+import time
+from typing import Any, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from models import get_models
+
+DEFAULT_ONNX_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'wikipedia_search', 'onnx')
+OPSET_VERSION = 17
+SAMPLE_TEXTS = [
+    'Der Gepard jagt seine Beute.',
+    'Die Entstehung der Erde ist 4,5 Milliarden Jahre her.',
+    'Anton Bruckner komponierte seine 7. Sinfonie in E-Dur in den Jahren 1881 bis 1883.',
+    'Das historische Zentrum liegt auf mehr als 100 Inseln in der Lagune von Venedig.',
+    'Berlin',
+    'Liste der Baudenkmäler in Hamburg-Altstadt',
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare the ONNX backend of a model with its PyTorch version.')
+    parser.add_argument('model', type=str, choices=list(get_models().keys()))
+    parser.add_argument('--quantize', action='store_true', help='use the int8 quantized ONNX model')
+    parser.add_argument('--texts', type=str, default=None, help='file with one sample text per line')
+    parser.add_argument('--onnx-dir', type=str, default=DEFAULT_ONNX_DIR)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    texts = SAMPLE_TEXTS
+    if args.texts is not None:
+        with open(args.texts, 'r') as f:
+            texts = [line.strip() for line in f if line.strip()]
+
+    torch_model = get_models()[args.model]()
+    onnx_model = load_onnx_model(args.model, quantize=args.quantize, onnx_dir=args.onnx_dir)
+
+    torch_features, torch_seconds = _timed_encode(torch_model, texts)
+    onnx_features, onnx_seconds = _timed_encode(onnx_model, texts)
+    similarities = cosine_agreement(torch_features, onnx_features)
+
+    print('texts={}'.format(len(texts)))
+    print('cosine similarity: mean={:.5f}  min={:.5f}'.format(similarities.mean(), similarities.min()))
+    print('pytorch: {:.3f}s ({:.1f} texts/s)'.format(torch_seconds, len(texts) / torch_seconds))
+    print('onnx{}: {:.3f}s ({:.1f} texts/s)'.format(
+        '-int8' if args.quantize else '', onnx_seconds, len(texts) / onnx_seconds
+    ))
+
+
+def _timed_encode(model, texts: List[str], batch_size: int = 64):
+    start_time = time.perf_counter()
+    features = np.concatenate([
+        np.asarray(model(texts[start:start + batch_size]), dtype=np.float32)
+        for start in range(0, len(texts), batch_size)
+    ])
+    return features, time.perf_counter() - start_time
+
+
+def cosine_agreement(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Returns the cosine similarity of corresponding rows of a and b.
+    """
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return (a * b).sum(axis=1)
+
+
+class OnnxModelPipeline:
+    def __init__(self, name: str, tokenizer, session=None):
+        """
+        :param session: The ONNX Runtime session. Without it, the pipeline can only tokenize.
+        """
+        self.name = name
+        self.tokenizer = tokenizer
+        self.session = session
+        self.input_names = [i.name for i in session.get_inputs()] if session is not None else []
+
+    def count_tokens(self, texts: List[str]) -> List[int]:
+        return [len(ids) for ids in self.tokenizer(texts, truncation=True)['input_ids']]
+
+    def tokenize(self, texts: List[str]):
+        return self.tokenizer(texts, padding=True, truncation=True, return_tensors='np')
+
+    def tokenize_all(self, texts: List[str]) -> Tuple[List[int], Any]:
+        encoding = self.tokenizer(texts, truncation=True)
+        return [len(ids) for ids in encoding['input_ids']], encoding
+
+    def batch_tokens(self, tokens, indices: np.ndarray):
+        return self.tokenizer.pad(
+            {key: [values[i] for i in indices] for key, values in tokens.items()}, return_tensors='np'
+        )
+
+    def collect_features(self, _tokens, features: np.ndarray) -> np.ndarray:
+        return features
+
+    def encode_tokens(self, tokens) -> np.ndarray:
+        inputs = {name: tokens[name].astype(np.int64) for name in self.input_names}
+        return self.session.run(None, inputs)[0]
+
+    def encode_batches(self, batches: List[Any]) -> List[np.ndarray]:
+        return [self.encode_tokens(tokens) for tokens in batches]
+
+    def __call__(self, texts: List[str]):
+        return self.encode_tokens(self.tokenize(texts))
+
+
+def load_onnx_model(model: str, quantize: bool = False, onnx_dir: Optional[str] = None) -> OnnxModelPipeline:
+    """
+    Loads the ONNX version of a model. The model is exported (and quantized), if it is not yet cached in onnx_dir.
+    """
+    import onnxruntime
+    from transformers import AutoTokenizer
+
+    model_path = onnx_model_path(model, quantize, onnx_dir)
+    tokenizer = AutoTokenizer.from_pretrained(os.path.dirname(model_path))
+    session = onnxruntime.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+    return OnnxModelPipeline(model, tokenizer, session)
+
+
+def load_onnx_tokenizer(model: str, quantize: bool = False, onnx_dir: Optional[str] = None) -> OnnxModelPipeline:
+    """
+    Loads a pipeline, that only has the tokenizer of the ONNX version of a model. The model is exported (and
+    quantized), if it is not yet cached in onnx_dir.
+    """
+    from transformers import AutoTokenizer
+
+    model_path = onnx_model_path(model, quantize, onnx_dir)
+    return OnnxModelPipeline(model, AutoTokenizer.from_pretrained(os.path.dirname(model_path)))
+
+
+def onnx_model_path(model: str, quantize: bool = False, onnx_dir: Optional[str] = None) -> str:
+    """
+    Returns the path of the cached ONNX model and exports (and quantizes) it first, if needed.
+    """
+    if onnx_dir is None:
+        onnx_dir = DEFAULT_ONNX_DIR
+    model_dir = os.path.join(onnx_dir, model)
+    model_path = os.path.join(model_dir, 'model.onnx')
+    if not os.path.exists(model_path):
+        export_onnx_model(model, model_dir)
+    if quantize:
+        quantized_path = os.path.join(model_dir, 'model-int8.onnx')
+        if not os.path.exists(quantized_path):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            print('quantizing {}... '.format(model), end='', flush=True)
+            quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8, use_external_data_format=True)
+            print('done', flush=True)
+        model_path = quantized_path
+    return model_path
+
+
+def export_onnx_model(model: str, model_dir: str):
+    """
+    Exports the text encoder of the given model to model_dir/model.onnx and saves its tokenizer next to it.
+    """
+    if model == 'mcip_vit_l14':
+        raise ValueError('The ONNX backend does not support model {}'.format(model))
+
+    print('exporting {} to onnx... '.format(model), end='', flush=True)
+    pipeline = get_models()[model]()
+    encoder = TextEncoder(pipeline.model.to('cpu'), model == 'jina_clip').eval()
+    os.makedirs(model_dir, exist_ok=True)
+
+    dummy = pipeline.tokenizer(['Ein Beispiel', 'Noch ein etwas längeres Beispiel'], padding=True, return_tensors='pt')
+    input_names = ['input_ids', 'attention_mask']
+    with torch.no_grad():
+        torch.onnx.export(
+            encoder, (dummy['input_ids'], dummy['attention_mask']), os.path.join(model_dir, 'model.onnx'),
+            input_names=input_names, output_names=['embedding'],
+            dynamic_axes={
+                'input_ids': {0: 'batch', 1: 'sequence'},
+                'attention_mask': {0: 'batch', 1: 'sequence'},
+                'embedding': {0: 'batch'},
+            },
+            opset_version=OPSET_VERSION,
+        )
+    pipeline.tokenizer.save_pretrained(model_dir)
+    print('done', flush=True)
+
+
+class TextEncoder(torch.nn.Module):
+    """
+    Computes the same embedding as ModelPipeline.encode_tokens from token ids.
+    """
+    def __init__(self, model, jina_clip: bool):
+        super().__init__()
+        self.model = model
+        self.jina_clip = jina_clip
+
+    def forward(self, input_ids, attention_mask):
+        if self.jina_clip:
+            # jina clip does not use the attention mask and normalizes the embeddings in encode_text
+            embedding = self.model.get_text_features(input_ids=input_ids)
+            return torch.nn.functional.normalize(embedding, p=2, dim=-1)
+        result = self.model(input_ids=input_ids, attention_mask=attention_mask)
+        return result.last_hidden_state.mean(dim=1).to(torch.float32)
+
+
+if __name__ == '__main__':
+    main()
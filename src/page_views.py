@@ -0,0 +1,156 @@
+"""
+Compact, memory mapped lookup of the page id and page views of a title.
+
+The raw pageviews files (one line per title and page with the monthly views) are compiled once into <directory>/:
+- keys.bin: uint64, the sorted 64 bit blake2b hashes of the normalized titles
+- page_id.bin, views.bin: int64, the page id and the total views of the page of every key
+- info.json: the compiled source files and the number of titles
+
+The views of a page are summed over all of its titles and over all source files, so several monthly files can be
+aggregated. A lookup hashes the titles and binary searches the keys, no python objects are kept per title.
+
+Running this file compiles the given pageviews files:
+
+    python src/page_views.py data/input/misc/pageviews-202501-user-de data/input/misc/pageviews-202502-user-de
+"""
+import argparse
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from utils import normalize_title
+
+RAW_PAGE_VIEWS_FILE = 'data/input/misc/pageviews-202501-user-de'
+PAGE_VIEWS_DIR = 'data/input/misc/page_views'
+KEYS_FILE = 'keys.bin'
+PAGE_ID_FILE = 'page_id.bin'
+VIEWS_FILE = 'views.bin'
+INFO_FILE = 'info.json'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compile pageviews files into a compact lookup.')
+    parser.add_argument('inputs', type=str, nargs='+', help='raw pageviews files, the views of all files are summed')
+    parser.add_argument('--output', type=str, default=PAGE_VIEWS_DIR, help='directory of the compiled lookup')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    page_views = compile_page_views(args.inputs, args.output)
+    print('compiled {} titles of {} files to {}'.format(len(page_views), len(args.inputs), args.output))
+
+
+def title_key(title: str) -> Optional[int]:
+    """
+    Returns the lookup key of a title, or None if the title is invalid.
+    """
+    title = normalize_title(title)
+    if title is None:
+        return None
+    return int.from_bytes(hashlib.blake2b(title.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def parse_page_views(path: str, page_views: Dict[int, int], title_pages: Dict[int, int], conflicts: Dict[int, set]):
+    """
+    Adds the views of every page in path to page_views and maps the keys of its titles to the page id.
+    """
+    from tqdm import tqdm
+    with open(path) as f:
+        for line in tqdm(f, desc='parsing {}'.format(os.path.basename(path))):
+            _, title, page_id, _, total_views, _ = line.strip().split(' ')
+            if page_id == 'null':
+                continue
+            page_id = int(page_id)
+            if title.startswith('Diskussion:'):
+                continue
+            page_views[page_id] = page_views.get(page_id, 0) + int(total_views)
+
+            key = title_key(title)
+            if key is None:
+                continue
+            previous = title_pages.setdefault(key, page_id)
+            if previous != page_id:
+                conflicts.setdefault(key, {previous}).add(page_id)
+
+
+def compile_page_views(paths: List[str], outdir: str) -> 'PageViews':
+    """
+    Compiles the raw pageviews files in paths into outdir. A title, that belongs to several pages, is mapped to the page
+    with the most views.
+    """
+    page_views = {}
+    title_pages = {}
+    conflicts = {}
+    for path in paths:
+        parse_page_views(path, page_views, title_pages, conflicts)
+    for key, page_ids in conflicts.items():
+        title_pages[key] = max(sorted(page_ids), key=lambda page_id: page_views[page_id])
+
+    keys = np.fromiter(title_pages.keys(), dtype=np.uint64, count=len(title_pages))
+    page_ids = np.fromiter(title_pages.values(), dtype=np.int64, count=len(title_pages))
+    views = np.fromiter((page_views[page_id] for page_id in title_pages.values()), dtype=np.int64, count=len(keys))
+    del title_pages, page_views
+    order = np.argsort(keys)
+
+    os.makedirs(outdir, exist_ok=True)
+    keys[order].tofile(os.path.join(outdir, KEYS_FILE))
+    page_ids[order].tofile(os.path.join(outdir, PAGE_ID_FILE))
+    views[order].tofile(os.path.join(outdir, VIEWS_FILE))
+    with open(os.path.join(outdir, INFO_FILE), 'w') as f:
+        json.dump({'sources': [os.path.abspath(path) for path in paths], 'num_titles': len(keys)}, f, indent=2)
+    return PageViews(outdir)
+
+
+class PageViews:
+    """
+    Read only access to a compiled lookup.
+    """
+    def __init__(self, directory: str):
+        self.keys = _map(os.path.join(directory, KEYS_FILE), np.uint64)
+        self.page_id = _map(os.path.join(directory, PAGE_ID_FILE), np.int64)
+        self.views = _map(os.path.join(directory, VIEWS_FILE), np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, titles: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the page ids and the views of titles. Unknown titles have page id -1 and 0 views.
+        """
+        keys = [title_key(title) for title in titles]
+        valid = np.array([key is not None for key in keys], dtype=bool)
+        keys = np.array([key or 0 for key in keys], dtype=np.uint64)
+
+        page_ids = np.full(len(titles), -1, dtype=np.int64)
+        views = np.zeros(len(titles), dtype=np.int64)
+        if len(self) == 0:
+            return page_ids, views
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self) - 1)
+        found = valid & (self.keys[positions] == keys)
+        page_ids[found] = self.page_id[positions[found]]
+        views[found] = self.views[positions[found]]
+        return page_ids, views
+
+
+def load_page_views(directory: str = PAGE_VIEWS_DIR, raw_file: str = RAW_PAGE_VIEWS_FILE) -> PageViews:
+    """
+    Returns the compiled lookup in directory. If it does not exist yet, it is compiled from raw_file first.
+    """
+    if not os.path.exists(os.path.join(directory, INFO_FILE)):
+        print('no compiled page views found in {}, compiling {}'.format(directory, raw_file), flush=True)
+        return compile_page_views([raw_file], directory)
+    return PageViews(directory)
+
+
+def _map(path: str, dtype) -> np.ndarray:
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""
+A minimal threaded pipeline with bounded queues.
+
+Each stage runs in its own thread and passes its results to the next stage through a queue of limited size, so a slow
+stage blocks its producers instead of letting items pile up in memory. The last stage is the consumer of Pipeline.run()
+in the calling thread. For every stage the time spent working, waiting for input and waiting for the next stage is
+recorded, which shows the bottleneck of the pipeline.
+"""
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+
+from metrics import METRICS
+from tables import Table
+
+
+class _Stop:
+    pass
+
+
+STOP = _Stop()
+
+
+class _Error:
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+class StageStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.metric = 'pipeline.{}'.format(name)
+        self.items = 0
+        self.busy = 0.0
+        self.waiting_input = 0.0
+        self.waiting_output = 0.0
+
+
+class Pipeline:
+    def __init__(self, queue_size: int = 4, consumer_name: str = 'consume'):
+        self.queue_size = queue_size
+        self.consumer_name = consumer_name
+        self._source = None
+        self._stages = []
+        self.stats: List[StageStats] = []
+        self.wall_time = 0.0
+
+    def source(self, name: str, iterable: Iterable):
+        self._source = (name, iterable)
+        return self
+
+    def stage(self, name: str, func: Callable[[Any], Any], flush: Optional[Callable[[], Any]] = None):
+        """
+        Adds a stage, that calls func for every item. If func returns None, the item is dropped. flush is called after
+        the last item and can return a final item, which allows stages to aggregate items.
+        """
+        self._stages.append((name, func, flush))
+        return self
+
+    def run(self) -> Iterator[Any]:
+        start_time = time.perf_counter()
+        source_name, iterable = self._source
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self._stages) + 1)]
+
+        source_stats = StageStats(source_name)
+        self.stats = [source_stats]
+        threads = [threading.Thread(target=_run_source, args=(iterable, queues[0], source_stats), daemon=True)]
+        for (name, func, flush), in_queue, out_queue in zip(self._stages, queues, queues[1:]):
+            stats = StageStats(name)
+            self.stats.append(stats)
+            threads.append(threading.Thread(
+                target=_run_stage, args=(func, flush, in_queue, out_queue, stats), daemon=True
+            ))
+        consumer_stats = StageStats(self.consumer_name)
+        self.stats.append(consumer_stats)
+
+        for thread in threads:
+            thread.start()
+
+        in_queue = queues[-1]
+        while True:
+            wait_start = time.perf_counter()
+            item = in_queue.get()
+            consumer_stats.waiting_input += time.perf_counter() - wait_start
+            if item is STOP:
+                break
+            if isinstance(item, _Error):
+                raise item.exception
+            busy_start = time.perf_counter()
+            yield item
+            busy = time.perf_counter() - busy_start
+            consumer_stats.busy += busy
+            METRICS.observe(consumer_stats.metric, busy)
+            consumer_stats.items += 1
+
+        self.wall_time = time.perf_counter() - start_time
+
+    def report(self) -> Table:
+        table = Table(('Stage', 'Items', 'Busy', 'Utilization', 'Waiting for input', 'Waiting for output'))
+        for stats in self.stats:
+            table.line(
+                stage=stats.name, items=stats.items, busy=stats.busy,
+                utilization=stats.busy / self.wall_time if self.wall_time else 0.0,
+                waiting_for_input=stats.waiting_input, waiting_for_output=stats.waiting_output
+            )
+        return table
+
+
+def _put(out_queue: queue.Queue, item, stats: StageStats):
+    wait_start = time.perf_counter()
+    out_queue.put(item)
+    stats.waiting_output += time.perf_counter() - wait_start
+
+
+def _run_source(iterable: Iterable, out_queue: queue.Queue, stats: StageStats):
+    try:
+        iterator = iter(iterable)
+        while True:
+            busy_start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            busy = time.perf_counter() - busy_start
+            stats.busy += busy
+            METRICS.observe(stats.metric, busy)
+            _put(out_queue, item, stats)
+            stats.items += 1
+        out_queue.put(STOP)
+    except BaseException as e:
+        out_queue.put(_Error(e))
+
+
+def _run_stage(func, flush, in_queue: queue.Queue, out_queue: queue.Queue, stats: StageStats):
+    try:
+        while True:
+            wait_start = time.perf_counter()
+            item = in_queue.get()
+            stats.waiting_input += time.perf_counter() - wait_start
+            if isinstance(item, _Error):
+                out_queue.put(item)
+                return
+            if item is STOP:
+                if flush is not None:
+                    result = flush()
+                    if result is not None:
+                        _put(out_queue, result, stats)
+                out_queue.put(STOP)
+                return
+
+            busy_start = time.perf_counter()
+            result = func(item)
+            busy = time.perf_counter() - busy_start
+            stats.busy += busy
+            METRICS.observe(stats.metric, busy)
+            stats.items += 1
+            if result is not None:
+                _put(out_queue, result, stats)
+    except BaseException as e:
+        out_queue.put(_Error(e))
@@ -0,0 +1,189 @@
+"""
+Product quantization index.
+
+Every row is split into num_subspaces parts and every part is replaced by the index of its nearest centroid in a
+codebook of 256 centroids, so a row only needs num_subspaces bytes. A query computes a table with the distances of its
+parts to all centroids once, the distance to a row is then the sum of num_subspaces table lookups. The best rerank
+candidates of this scan are re-ranked with the full vectors, which are read on demand from features.bin. The rows
+deleted by merged deltas are skipped by the scan.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+from feature_store import FeatureStore, read_description
+from flat_index import mask_deleted, top_k
+from incremental import load_deleted_rows
+from utils import l2_normalize
+
+PQ_CODES_FILE = 'index.pq'
+PQ_CODEBOOKS_FILE = 'pq_codebooks.npy'
+NUM_CENTROIDS = 256
+DEFAULT_SUBSPACES = 64
+DEFAULT_RERANK = 1000
+TRAIN_SAMPLE_SIZE = 65536
+KMEANS_ITERATIONS = 20
+BLOCK_SIZE = 1024
+
+
+def kmeans(points: np.ndarray, num_centroids: int, iterations: int, rng: np.random.Generator) -> np.ndarray:
+    centroids = points[rng.choice(len(points), size=num_centroids, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest_centroids(points, centroids)
+        counts = np.bincount(assignment, minlength=num_centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, points)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # empty clusters restart at random points
+        empty = np.flatnonzero(~filled)
+        centroids[empty] = points[rng.choice(len(points), size=len(empty), replace=False)]
+    return centroids
+
+
+def nearest_centroids(points: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    distances = (centroids ** 2).sum(axis=1) - 2 * points @ centroids.T
+    return np.argmin(distances, axis=1)
+
+
+def train_codebooks(
+        data: np.ndarray, normalize: bool, num_subspaces: int = DEFAULT_SUBSPACES,
+        sample_size: int = TRAIN_SAMPLE_SIZE, iterations: int = KMEANS_ITERATIONS, seed: int = 0
+) -> np.ndarray:
+    """
+    Trains one codebook per subspace on a random sample of the rows of data. With less than NUM_CENTROIDS rows, every
+    codebook has one centroid per row.
+
+    :returns: The codebooks with shape (num_subspaces, number of centroids, dim / num_subspaces)
+    """
+    dim = data.shape[1]
+    if dim % num_subspaces != 0:
+        raise ValueError('dim {} is not divisible by the number of subspaces {}'.format(dim, num_subspaces))
+    if len(data) == 0:
+        raise ValueError('the pq codebooks can not be trained without rows')
+    num_centroids = min(NUM_CENTROIDS, len(data))
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(data), size=min(max(sample_size, NUM_CENTROIDS), len(data)), replace=False))
+    sample = np.asarray(data[rows], dtype=np.float32)
+    if normalize:
+        l2_normalize(sample, out=sample)
+    sub_dim = dim // num_subspaces
+    return np.stack([
+        kmeans(sample[:, m * sub_dim:(m + 1) * sub_dim], num_centroids, iterations, rng)
+        for m in range(num_subspaces)
+    ])
+
+
+def encode(codebooks: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+    num_subspaces, _, sub_dim = codebooks.shape
+    codes = np.empty((len(vectors), num_subspaces), dtype=np.uint8)
+    for m in range(num_subspaces):
+        codes[:, m] = nearest_centroids(vectors[:, m * sub_dim:(m + 1) * sub_dim], codebooks[m])
+    return codes
+
+
+class PQIndex:
+    def __init__(
+            self, codebooks: np.ndarray, codes: np.ndarray, store: FeatureStore, normalize: bool,
+            rerank: int = DEFAULT_RERANK, num_threads: Optional[int] = None, deleted: Sequence[int] = ()
+    ):
+        """
+        :param codebooks: The codebooks returned by train_codebooks
+        :param codes: The uint8 codes of all rows, usually memory mapped
+        :param store: The full vectors, used for re-ranking
+        :param normalize: Whether the full vectors are l2 normalized before re-ranking
+        :param rerank: Number of candidates per query, that are re-ranked with the full vectors
+        :param num_threads: Number of threads, that scan the codes. Defaults to the number of cpus.
+        :param deleted: Rows, that are never returned
+        """
+        self.codebooks = codebooks
+        self.codes = codes
+        self.store = store
+        self.normalize = normalize
+        self.rerank = rerank
+        self.num_threads = num_threads or os.cpu_count()
+        self.deleted = np.unique(np.asarray(deleted, dtype=np.int64))
+
+    @staticmethod
+    def from_dir(indir: str, description: Optional[dict] = None) -> 'PQIndex':
+        if description is None:
+            description = read_description(indir)
+        codebooks = np.load(os.path.join(indir, PQ_CODEBOOKS_FILE))
+        codes = np.memmap(
+            os.path.join(indir, PQ_CODES_FILE), dtype=np.uint8, mode='r',
+            shape=(description['num_samples'], codebooks.shape[0])
+        )
+        return PQIndex(
+            codebooks, codes, FeatureStore.from_dir(indir, description), description['normalize'],
+            deleted=load_deleted_rows(indir)
+        )
+
+    def __len__(self):
+        return len(self.codes)
+
+    def distance_tables(self, queries: np.ndarray) -> np.ndarray:
+        """
+        Returns the squared distances of every query part to every centroid with shape
+        (num_queries, num_subspaces, number of centroids).
+        """
+        num_subspaces, _, sub_dim = self.codebooks.shape
+        parts = queries.reshape(len(queries), num_subspaces, 1, sub_dim)
+        return ((parts - self.codebooks[None]) ** 2).sum(axis=-1)
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the indices and the exact squared l2 distances of the k nearest rows of every query, sorted by distance.
+        """
+        queries = np.atleast_2d(queries).astype(np.float32)
+        k = min(k, len(self) - len(self.deleted))
+        num_candidates = min(max(self.rerank, k), len(self) - len(self.deleted))
+        tables = self.distance_tables(queries)
+
+        num_blocks = (len(self) + BLOCK_SIZE - 1) // BLOCK_SIZE
+        blocks_per_thread = max(1, (num_blocks + self.num_threads - 1) // self.num_threads)
+        ranges = [
+            (block * BLOCK_SIZE, min((block + blocks_per_thread) * BLOCK_SIZE, len(self)))
+            for block in range(0, num_blocks, blocks_per_thread)
+        ]
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            results = list(executor.map(lambda r: self._scan_range(tables, num_candidates, *r), ranges))
+        candidates, _ = top_k(
+            np.concatenate([r[0] for r in results], axis=1), np.concatenate([r[1] for r in results], axis=1),
+            num_candidates
+        )
+        return self._rerank(queries, candidates, k)
+
+    def _scan_range(self, tables: np.ndarray, k: int, start: int, end: int) -> Tuple[np.ndarray, np.ndarray]:
+        subspaces = np.arange(self.codebooks.shape[0])
+        best_indices = np.zeros((len(tables), 0), dtype=np.int64)
+        best_distances = np.zeros((len(tables), 0), dtype=np.float32)
+        for block_start in range(start, end, BLOCK_SIZE):
+            block_end = min(block_start + BLOCK_SIZE, end)
+            codes = np.asarray(self.codes[block_start:block_end])
+            distances = tables[:, subspaces, codes].sum(axis=-1)
+            mask_deleted(distances, self.deleted, block_start, block_end)
+            indices = np.broadcast_to(np.arange(block_start, block_end, dtype=np.int64), distances.shape)
+            best_indices, best_distances = top_k(
+                np.concatenate([best_indices, indices], axis=1),
+                np.concatenate([best_distances, distances.astype(np.float32, copy=False)], axis=1), k
+            )
+        return best_indices, best_distances
+
+    def _rerank(self, queries: np.ndarray, candidates: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        # every candidate row is read once, in file order
+        rows, inverse = np.unique(candidates, return_inverse=True)
+        vectors = np.asarray(self.store.data[rows], dtype=np.float32)
+        if self.normalize:
+            l2_normalize(vectors, out=vectors)
+        inverse = inverse.reshape(candidates.shape)
+
+        indices = np.empty((len(queries), k), dtype=np.int64)
+        distances = np.empty((len(queries), k), dtype=np.float32)
+        for q, query in enumerate(queries):
+            query_distances = ((vectors[inverse[q]] - query) ** 2).sum(axis=1)
+            order = np.argsort(query_distances)[:k]
+            indices[q] = candidates[q, order]
+            distances[q] = query_distances[order]
+        return indices, distances
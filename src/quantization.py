@@ -0,0 +1,169 @@
+"""
+Quantization of features to uint8.
+
+The fixed scheme maps [-0.4, 0.4] to [0, 255] for every dimension. A calibrated quantizer uses its own offset and scale
+per dimension, computed from a sample of features.bin. It is stored in quantization.npz next to the index and referenced
+by "quantization" in description.json, so that the index and the queries are quantized the same way.
+
+Running this file compares the recall of the fixed and of a calibrated quantization. Both are measured with the same
+exact uint8 scan, so they have the same search cost.
+"""
+import argparse
+import os
+from typing import Optional
+
+import numpy as np
+
+from tables import Table
+from utils import l2_normalize
+
+QUANTIZATION_FILE = 'quantization.npz'
+DEFAULT_MAX_VAL = 0.4
+METHODS = ['minmax', 'percentile']
+DEFAULT_PERCENTILE = 0.1
+DEFAULT_SAMPLE_SIZE = 50000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare the fixed and the calibrated quantization.')
+    parser.add_argument('indir', type=str)
+    parser.add_argument('--method', type=str, choices=METHODS, default='percentile')
+    parser.add_argument(
+        '--percentile', type=float, default=DEFAULT_PERCENTILE,
+        help='lower percentile of every dimension, that is mapped to 0 (the upper one is 100 - percentile)'
+    )
+    parser.add_argument('--sample', type=int, default=DEFAULT_SAMPLE_SIZE, help='number of rows used for calibration')
+    parser.add_argument('--queries', type=int, default=200, help='number of random rows used as queries')
+    parser.add_argument('-k', type=int, default=10)
+    return parser.parse_args()
+
+
+def main():
+    # imported here, because feature_store imports this module
+    from feature_store import FeatureStore, read_description
+    from flat_index import FlatIndex
+
+    args = parse_args()
+    description = read_description(args.indir)
+    normalize = description.get('normalize', False)
+    store = FeatureStore.from_dir(args.indir, description)
+
+    print('calibrating on {} rows... '.format(min(args.sample, len(store))), end='', flush=True)
+    calibrated = calibrate(store.data, normalize, args.method, args.percentile, args.sample)
+    print('done', flush=True)
+
+    rng = np.random.default_rng(1)
+    query_rows = np.sort(rng.choice(len(store), size=min(args.queries, len(store)), replace=False))
+    queries = np.asarray(store.data[query_rows], dtype=np.float32)
+    if normalize:
+        l2_normalize(queries, out=queries)
+
+    print('computing ground truth', flush=True)
+    ground_truth = FlatIndex(store, normalize=normalize).search(queries, args.k + 1)[0]
+    ground_truth = without_queries(ground_truth, query_rows, args.k)
+
+    table = Table(('Scheme', 'Recall', 'Clipped', 'Mean error'))
+    for name, quantizer in [('fixed {}'.format(DEFAULT_MAX_VAL), Quantizer.fixed()), (args.method, calibrated)]:
+        print('scanning with {} quantization'.format(name), flush=True)
+        store.quantizer = quantizer
+        flat_index = FlatIndex(store, normalize=normalize, quantize=True)
+        indices = flat_index.search(quantizer(queries), args.k + 1)[0]
+        indices = without_queries(indices, query_rows, args.k)
+        hits = [len(np.intersect1d(found, truth)) for found, truth in zip(indices, ground_truth)]
+        codes = quantizer(queries)
+        table.line(
+            scheme=name, recall=float(np.mean(hits)) / args.k,
+            clipped=float(np.mean((codes == 0) | (codes == 255))),
+            mean_error=float(np.abs(quantizer.decode(codes) - queries).mean()),
+        )
+    print('recall@{} of an exact uint8 scan against the float32 scan:'.format(args.k))
+    print(table)
+
+
+def without_queries(indices: np.ndarray, query_rows: np.ndarray, k: int) -> np.ndarray:
+    """
+    Removes the query rows themselves from the results.
+    """
+    return np.array([row_indices[row_indices != row][:k] for row_indices, row in zip(indices, query_rows)])
+
+
+class Quantizer:
+    """
+    Maps every dimension d from [offset[d], offset[d] + 255 / scale[d]] to uint8.
+    """
+    def __init__(self, offset, scale):
+        self.offset = np.asarray(offset, dtype=np.float32)
+        self.scale = np.asarray(scale, dtype=np.float32)
+
+    @staticmethod
+    def fixed(max_val: float = DEFAULT_MAX_VAL) -> 'Quantizer':
+        return Quantizer(-max_val, 255 / (max_val * 2))
+
+    def __call__(self, data: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Quantizes data. If out is given, it has to be an uint8 array with the shape of data. Note that data is modified
+        in place, if out is given.
+        """
+        if out is None:
+            quantized = np.clip((data - self.offset) * self.scale, 0, 255)
+            return np.rint(quantized).astype(np.uint8)
+        data -= self.offset
+        data *= self.scale
+        np.clip(data, 0, 255, out=data)
+        np.rint(data, out=data)
+        out[...] = data
+        return out
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32) / self.scale + self.offset
+
+    def save(self, path: str):
+        with open(path, 'wb') as f:
+            np.savez(f, offset=self.offset, scale=self.scale)
+
+    @staticmethod
+    def load(path: str) -> 'Quantizer':
+        with np.load(path) as data:
+            return Quantizer(data['offset'], data['scale'])
+
+
+def calibrate(
+        data: np.ndarray, normalize: bool, method: str = 'percentile', percentile: float = DEFAULT_PERCENTILE,
+        sample_size: int = DEFAULT_SAMPLE_SIZE, seed: int = 0
+) -> Quantizer:
+    """
+    Computes the offset and scale of every dimension from a random sample of the rows of data.
+
+    :param data: The features, usually the memory map of a FeatureStore
+    :param normalize: Whether the rows are l2 normalized before quantization
+    :param method: "minmax" uses the range of the sample, "percentile" clips the outer percentiles
+    :param percentile: The lower percentile for method "percentile"
+    :param sample_size: Number of rows to read
+    :param seed: Seed of the row sampling
+    """
+    if method not in METHODS:
+        raise ValueError('Unknown calibration method: {}'.format(method))
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(data), size=min(sample_size, len(data)), replace=False))
+    sample = np.asarray(data[rows], dtype=np.float32)
+    if normalize:
+        l2_normalize(sample, out=sample)
+    if method == 'minmax':
+        low, high = sample.min(axis=0), sample.max(axis=0)
+    else:
+        low, high = np.percentile(sample, [percentile, 100 - percentile], axis=0)
+    return Quantizer(low, 255 / np.maximum(high - low, 1e-6))
+
+
+def load_quantizer(indir: str, description: dict) -> Quantizer:
+    """
+    Returns the quantizer referenced by description.json, or the fixed one for indexes without calibration.
+    """
+    filename = description.get('quantization')
+    if filename is None:
+        return Quantizer.fixed()
+    return Quantizer.load(os.path.join(indir, filename))
+
+
+if __name__ == '__main__':
+    main()
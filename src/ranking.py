@@ -0,0 +1,109 @@
+"""
+Re-ranking of search results by distance and popularity.
+
+All scorers work on arrays of shape (num_queries, k) and return scores, where lower scores are better. The scorer and
+its parameters are configured with a dict like {"scorer": "log_popularity", "params": {"weight": 0.1}}, which can be
+set under "ranking" in description.json.
+"""
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+DEFAULT_SCORER = 'view_factor'
+
+
+def distance_scores(distances: np.ndarray, _views: np.ndarray) -> np.ndarray:
+    return distances
+
+
+def view_factor_scores(distances: np.ndarray, views: np.ndarray, weight: float = 0.6, scale: float = 1000.0):
+    """
+    Scales the distance by a factor between 1 (no views) and 1 - weight (infinite views). Pages with scale views are
+    halfway.
+    """
+    view_factor = ((scale / (scale + views)) - 1) * weight + 1
+    return distances * view_factor
+
+
+def log_popularity_scores(distances: np.ndarray, views: np.ndarray, weight: float = 0.05):
+    """
+    Divides the distance by 1 + weight * log(1 + views).
+    """
+    return distances / (1 + weight * np.log1p(views))
+
+
+SCORERS: Dict[str, Callable[..., np.ndarray]] = {
+    'distance': distance_scores,
+    'view_factor': view_factor_scores,
+    'log_popularity': log_popularity_scores,
+}
+
+
+class Ranker:
+    def __init__(self, views: np.ndarray, scorer: str = DEFAULT_SCORER, params: Optional[dict] = None):
+        """
+        :param views: The page views of every row of the index
+        :param scorer: The name of a scorer in SCORERS
+        :param params: Keyword arguments of the scorer
+        """
+        if scorer not in SCORERS:
+            raise ValueError('Unknown scorer "{}". Valid scorers are: {}'.format(scorer, ', '.join(SCORERS)))
+        self.views = np.asarray(views, dtype=np.float32)
+        self.scorer = SCORERS[scorer]
+        self.params = params or {}
+
+    @staticmethod
+    def from_config(views: np.ndarray, config: Optional[dict]) -> 'Ranker':
+        config = config or {}
+        return Ranker(views, config.get('scorer', DEFAULT_SCORER), config.get('params'))
+
+    def rerank(
+            self, indices: np.ndarray, distances: np.ndarray, top_k: int
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Sorts the candidates of every query by their score and keeps the best top_k. Invalid indices (negative or out of
+        range, as returned by some indexes for missing results) are sorted last.
+
+        :returns: indices, distances and scores of shape (num_queries, min(top_k, k))
+        """
+        indices = np.asarray(indices).astype(np.int64, copy=False)
+        distances = np.asarray(distances, dtype=np.float32)
+        valid = (indices >= 0) & (indices < len(self.views))
+        views = self.views[np.where(valid, indices, 0)]
+        scores = np.where(valid, self.scorer(distances, views, **self.params), np.inf)
+
+        top_k = min(top_k, scores.shape[1])
+        if top_k < scores.shape[1]:
+            candidates = np.argpartition(scores, top_k - 1, axis=1)[:, :top_k]
+        else:
+            candidates = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+        candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+        order = np.take_along_axis(candidates, np.argsort(candidate_scores, axis=1, kind='stable'), axis=1)
+        return (
+            np.take_along_axis(indices, order, axis=1),
+            np.take_along_axis(distances, order, axis=1),
+            np.take_along_axis(scores, order, axis=1),
+        )
+
+
+def collapse_pages(
+        indices: np.ndarray, distances: np.ndarray, scores: np.ndarray, row_page: np.ndarray, top_k: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Keeps only the best scored row of every page. The candidates have to be sorted by score (as returned by
+    Ranker.rerank). Missing results are padded with index -1 and score inf.
+
+    :returns: indices, distances and scores of shape (num_queries, top_k)
+    """
+    num_queries = indices.shape[0]
+    out_indices = np.full((num_queries, top_k), -1, dtype=np.int64)
+    out_distances = np.full((num_queries, top_k), np.inf, dtype=np.float32)
+    out_scores = np.full((num_queries, top_k), np.inf, dtype=np.float32)
+    for q in range(num_queries):
+        valid = np.flatnonzero(np.isfinite(scores[q]))
+        _, first = np.unique(row_page[indices[q, valid]], return_index=True)
+        keep = valid[np.sort(first)[:top_k]]
+        out_indices[q, :len(keep)] = indices[q, keep]
+        out_distances[q, :len(keep)] = distances[q, keep]
+        out_scores[q, :len(keep)] = scores[q, keep]
+    return out_indices, out_distances, out_scores
@@ -3,108 +3,465 @@ import dataclasses
 import json
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 
-import deglib
-import hnswlib
 import numpy as np
 
-from models import load_model
+from feature_store import read_description
+from flat_index import FlatIndex
+from index_files import INDEX_FILES, SHARDED_INDEX_TYPES
+from meta_store import MetaStore, load_meta
+from metrics import METRICS, add_arguments, instrument
+from models import BACKENDS, load_model, close_model
+from pq_index import DEFAULT_RERANK, PQIndex
+from quantization import Quantizer, load_quantizer
+from ranking import Ranker, collapse_pages
 from tables import Table
-from utils import l2_normalize, quantize_data
+from utils import l2_normalize, rss_mb
+
+SEARCH_MODES = ['fixed', 'pages']
+# in pages mode, the first search asks for the k rows of fixed mode, but at least OVERFETCH * top_k, then k is doubled
+# up to MAX_K until enough distinct pages are found
+OVERFETCH = 3
+MAX_K = 1600
+DEFAULT_SEARCH_PARAMS = {'hnsw': 1200, 'deglib': 0.2, 'pq': DEFAULT_RERANK}
+WARMUP_QUERIES = [
+    'geschichte der stadt',
+    'bekannter deutscher schriftsteller',
+    'chemisches element mit hoher dichte',
+    'fluss in europa',
+    'olympische sommerspiele',
+    'erfindung des zwanzigsten jahrhunderts',
+    'krankheit der atemwege',
+    'politische partei',
+]
+DEFAULT_WARMUP = 3
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('indir', type=str)
+    parser.add_argument('--backend', type=str, choices=BACKENDS, default='torch', help='inference backend of the model')
+    parser.add_argument('--cache-dir', type=str, default=None, help='directory of the persistent embedding cache')
+    parser.add_argument(
+        '--ranking', type=str, default=None,
+        help='ranking configuration as json, e.g. \'{"scorer": "log_popularity", "params": {"weight": 0.1}}\'. '
+             'Overrides "ranking" in description.json.'
+    )
+    parser.add_argument(
+        '--search-mode', type=str, choices=SEARCH_MODES, default='fixed',
+        help='"pages" returns distinct pages and fetches more candidates only if needed, '
+             '"fixed" always fetches 200 rows'
+    )
+    parser.add_argument(
+        '--warmup', type=int, default=DEFAULT_WARMUP, help='number of warm up queries after loading'
+    )
+    add_arguments(parser)
     return parser.parse_args()
 
 
 class Index:
-    def __init__(self, indir, index_type, dim: int, normalize: bool):
+    """
+    One index, or several shards of an index built by "create_graph.py --shards". The shards are searched concurrently
+    and their results are merged by distance.
+    """
+    def __init__(
+            self, indir, index_type, dim: int, normalize: bool, shards: Optional[List[dict]] = None,
+            num_deleted: int = 0
+    ):
         self.index_type = index_type
+        # hnswlib only marks deleted rows, they are still counted by get_current_count. deglib removes them, flat and pq
+        # skip them while searching.
+        self.num_deleted = num_deleted if index_type == 'hnsw' else 0
         self.dim = dim
-        if index_type == 'deglib':
-            index = deglib.graph.load_readonly_graph(os.path.join(indir, 'index.deg'))
+        self.metric = 'cosine' if normalize and index_type == 'hnsw' else 'l2'
+        if shards:
+            if index_type not in SHARDED_INDEX_TYPES:
+                raise ValueError('Index type {} can not be sharded'.format(index_type))
+            self.shards = [
+                (shard['offset'], self._load_backend(indir, shard['file'])) for shard in shards
+            ]
         else:
-            metric = 'cosine' if normalize else 'l2'
-            index = hnswlib.Index(space=metric, dim=dim)
-            index.load_index(os.path.join(indir, 'index.hnsw'))
-            index.set_ef(1200)
-        self.index = index
+            self.shards = [(0, self._load_backend(indir, INDEX_FILES.get(index_type)))]
+        self.executor = ThreadPoolExecutor(max_workers=len(self.shards)) if len(self.shards) > 1 else None
+        self.search_param = None
+        self.set_search_param(DEFAULT_SEARCH_PARAMS.get(index_type))
+
+    def _load_backend(self, indir: str, filename: Optional[str]):
+        if self.index_type not in INDEX_LOADERS:
+            raise ValueError('Unknown index type: {}'.format(self.index_type))
+        return INDEX_LOADERS[self.index_type](indir, filename, self.dim, self.metric)
+
+    def set_search_param(self, value):
+        """
+        Sets the parameter, that trades recall against speed: ef for hnsw, eps for deglib and the number of re-ranked
+        candidates for pq.
+        """
+        self.search_param = value
+        for _, backend in self.shards:
+            if self.index_type == 'hnsw':
+                backend.set_ef(int(value))
+            elif self.index_type == 'pq':
+                backend.rerank = int(value)
+
+    @property
+    def size(self) -> int:
+        """
+        Returns the number of rows, that can be found.
+        """
+        return sum(self._backend_size(backend) for _, backend in self.shards) - self.num_deleted
+
+    def _backend_size(self, backend) -> int:
+        if self.index_type == 'deglib':
+            return backend.size()
+        if self.index_type in ('flat', 'pq'):
+            return len(backend) - len(backend.deleted)
+        return backend.get_current_count()
 
     def search_query(self, query: np.ndarray, k: int = 20):
+        with METRICS.timer('search.index'):
+            return self._search_query(query, k)
+
+    def _search_query(self, query: np.ndarray, k: int):
+        if self.executor is None:
+            return self._search_backend(self.shards[0][1], query, k)
+        results = list(self.executor.map(lambda shard: self._search_shard(*shard, query, k), self.shards))
+        indices = np.concatenate([shard_indices for shard_indices, _ in results], axis=1)
+        diffs = np.concatenate([shard_diffs for _, shard_diffs in results], axis=1)
+        order = np.argsort(diffs, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(indices, order, axis=1), np.take_along_axis(diffs, order, axis=1)
+
+    def _search_shard(self, offset: int, backend, query: np.ndarray, k: int):
+        indices, diffs = self._search_backend(backend, query, min(k, self._backend_size(backend)))
+        return np.asarray(indices, dtype=np.int64) + offset, np.asarray(diffs, dtype=np.float32)
+
+    def _search_backend(self, backend, query: np.ndarray, k: int):
         if self.index_type == 'deglib':
-            indices, diffs = self.index.search(query, 0.2, k)
+            indices, diffs = backend.search(query, self.search_param, k)
         elif self.index_type == 'hnsw':
-            indices, diffs = self.index.knn_query(query, k=k, filter=None)
+            indices, diffs = backend.knn_query(query, k=k, filter=None)
+        elif self.index_type in ('flat', 'pq'):
+            indices, diffs = backend.search(query, k)
         else:
             raise ValueError('Unknown index type: {}'.format(self.index_type))
         return indices, diffs
 
 
+def load_hnsw(indir: str, filename: str, dim: int, metric: str):
+    import hnswlib
+    index = hnswlib.Index(space=metric, dim=dim)
+    index.load_index(os.path.join(indir, filename))
+    return index
+
+
+def load_deglib(indir: str, filename: str, _dim: int, _metric: str):
+    import deglib
+    return deglib.graph.load_readonly_graph(os.path.join(indir, filename))
+
+
+def load_flat(indir: str, _filename: Optional[str], _dim: int, _metric: str):
+    return FlatIndex.from_dir(indir)
+
+
+def load_pq(indir: str, _filename: Optional[str], _dim: int, _metric: str):
+    return PQIndex.from_dir(indir)
+
+
+# index types and their loaders, the ann libraries are only imported, when their index type is loaded
+INDEX_LOADERS = {
+    'hnsw': load_hnsw,
+    'deglib': load_deglib,
+    'flat': load_flat,
+    'pq': load_pq,
+}
+
+
+@dataclasses.dataclass
+class StartupPhase:
+    name: str
+    seconds: float
+    rss_mb: float
+
+
+class StartupProfile:
+    """
+    Records the duration of every startup phase and the resident memory of the process after it. Phases can run
+    concurrently, so the rss of a phase also contains the memory of the phases, that finished before it.
+    """
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.phases: List[StartupPhase] = []
+
+    def run(self, name: str, func, *args, **kwargs):
+        start_time = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.phases.append(StartupPhase(name, time.perf_counter() - start_time, rss_mb()))
+        return result
+
+    @property
+    def total_seconds(self) -> float:
+        return time.perf_counter() - self.start_time
+
+    def as_dict(self) -> dict:
+        return {
+            'phases': [dataclasses.asdict(phase) for phase in self.phases],
+            'total_seconds': self.total_seconds,
+        }
+
+    def report(self) -> Table:
+        table = Table(('Phase', 'Seconds', 'RSS MB'))
+        for phase in self.phases:
+            table.line(phase=phase.name, seconds=phase.seconds, rss_mb=phase.rss_mb)
+        table.line(phase='total', seconds=self.total_seconds, rss_mb=rss_mb())
+        return table
+
+
+@dataclasses.dataclass
+class ExpansionStats:
+    """
+    Counts, how often the page search had to fetch more candidates.
+    """
+    queries: int = 0
+    expanded_queries: int = 0
+    searches: int = 0
+    max_k: int = 0
+
+    def record(self, num_queries: int, expanded: int, searches: int, k: int):
+        self.queries += num_queries
+        self.expanded_queries += expanded
+        self.searches += searches
+        self.max_k = max(self.max_k, k)
+
+    def as_dict(self) -> dict:
+        stats = dataclasses.asdict(self)
+        stats['expansion_rate'] = self.expanded_queries / self.queries if self.queries else 0.0
+        return stats
+
+
 @dataclasses.dataclass
 class ResultEntry:
     title: str
     link: str
     distance: float
     views: int
+    score: float
 
-    def sort_key(self):
-        # return self.distance / 200 - np.sqrt(self.views)
-        view_factor = ((1000 / (1000 + self.views)) - 1) * 0.6 + 1
-        return self.distance * view_factor
 
+class Searcher:
+    """
+    Holds everything, that is needed to answer queries: the model, the index and the meta information.
+    """
+    def __init__(
+            self, model, index: Index, meta_info, ranker: Ranker, normalize: bool, quantizer: Optional[Quantizer],
+            search_mode: str = 'fixed'
+    ):
+        self.model = model
+        self.index = index
+        self.meta_info = meta_info
+        self.ranker = ranker
+        self.normalize = normalize
+        self.quantizer = quantizer
+        self.search_mode = search_mode
+        self.row_page = row_pages(meta_info)
+        self.expansion_stats = ExpansionStats()
+        self.startup: Optional[StartupProfile] = None
 
-def main():
-    args = parse_args()
+    @staticmethod
+    def load(
+            indir: str, cache_dir: Optional[str] = None, backend: str = 'torch', ranking: Optional[dict] = None,
+            search_mode: str = 'fixed', warmup: int = DEFAULT_WARMUP
+    ) -> 'Searcher':
+        """
+        Loads the model, the index and the meta information of an output directory concurrently and runs warmup
+        queries. ranking overrides the ranking configuration of description.json. The startup profile is printed and
+        kept in searcher.startup.
+        """
+        description = read_description(indir)
+        profile = StartupProfile()
 
-    # read description
-    with open(os.path.join(args.indir, 'description.json'), 'r') as f:
-        description = json.load(f)
+        print('loading model, index and meta information... ', end='', flush=True)
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            model_future = executor.submit(
+                profile.run, 'model', load_model, description['model'], verbose=False, cache_dir=cache_dir,
+                backend=backend
+            )
+            index_future = executor.submit(
+                profile.run, 'index', Index, indir, description['index_type'], description['dim'],
+                description['normalize'], description.get('shards'), description.get('num_deleted', 0)
+            )
+            meta_future = executor.submit(profile.run, 'meta', load_meta, indir)
+            model, index, meta_info = model_future.result(), index_future.result(), meta_future.result()
+        print('done', flush=True)
 
-    dim = description['dim']
-    model_name = description['model']
-    quantize = description['quantize']
-    normalize = description['normalize']
-    index_type = description['index_type']
+        def create_searcher():
+            ranker = Ranker.from_config(row_views(meta_info), ranking or description.get('ranking'))
+            quantizer = load_quantizer(indir, description) if description['quantize'] else None
+            return Searcher(model, index, meta_info, ranker, description['normalize'], quantizer, search_mode)
 
-    # loading model
-    model = load_model(model_name)
+        searcher = profile.run('ranking', create_searcher)
+        if warmup > 0:
+            profile.run('warm up', searcher.warm_up, warmup)
+        searcher.startup = profile
+        print(profile.report(), flush=True)
+        return searcher
 
-    # loading index
-    print('loading graph... ', end='', flush=True)
-    index = Index(args.indir, index_type, dim, normalize)
-    print('done', flush=True)
+    def warm_up(self, num_queries: int):
+        """
+        Runs some queries through the whole search path, so that the pages of the index are loaded and lazy
+        initializations are done before the first real query.
+        """
+        queries = [WARMUP_QUERIES[i % len(WARMUP_QUERIES)] for i in range(num_queries)]
+        for query in queries:
+            self.search([query])
+        self.search(queries)
+        self.expansion_stats = ExpansionStats()
+        # the warm up queries are not part of the metrics and their rates
+        METRICS.reset()
+
+    def encode(self, search_texts: List[str]) -> np.ndarray:
+        METRICS.count('search.queries', len(search_texts))
+        METRICS.observe('search.batch_size', len(search_texts))
+        with METRICS.timer('search.encode'):
+            return prepare_queries(self.model(search_texts), self.normalize, self.quantizer)
+
+    def search_features(self, search_features: np.ndarray, k: int = 200, top_k: int = 20) -> List[List[ResultEntry]]:
+        """
+        Returns the top_k best entries of every query after re-ranking. In "fixed" mode, the k nearest neighbours are
+        searched and the result may contain the title and the summary of the same page. In "pages" mode, the search
+        starts with k rows and every page is returned at most once.
+        """
+        with METRICS.timer('search.search'):
+            if self.search_mode == 'pages':
+                indices, diffs, scores = self.search_pages(search_features, top_k, k)
+            else:
+                indices, diffs = self.index.search_query(search_features, k=k)
+                with METRICS.timer('search.rank'):
+                    indices, diffs, scores = self.ranker.rerank(indices, diffs, top_k)
+            with METRICS.timer('search.results'):
+                return [
+                    self.result_entries(query_indices, query_diffs, query_scores)
+                    for query_indices, query_diffs, query_scores in zip(indices, diffs, scores)
+                ]
+
+    def search_pages(
+            self, search_features: np.ndarray, top_k: int, k: int = 200
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Collapses the hits to distinct pages. The first search ranks the same k rows as fixed mode, so the best pages do
+        not change. Queries with less than top_k distinct pages are searched again with twice the k, until k reaches
+        MAX_K or the size of the index.
+        """
+        num_queries = len(search_features)
+        max_k = min(max(MAX_K, top_k), self.index.size)
+        k = min(max(k, OVERFETCH * top_k), max_k)
+        indices = np.full((num_queries, top_k), -1, dtype=np.int64)
+        diffs = np.full((num_queries, top_k), np.inf, dtype=np.float32)
+        scores = np.full((num_queries, top_k), np.inf, dtype=np.float32)
+
+        pending = np.arange(num_queries)
+        expanded = np.zeros(num_queries, dtype=bool)
+        searches = 0
+        while True:
+            query_indices, query_diffs = self.index.search_query(search_features[pending], k=k)
+            with METRICS.timer('search.rank'):
+                query_indices, query_diffs, query_scores = self.ranker.rerank(query_indices, query_diffs, k)
+                query_indices, query_diffs, query_scores = collapse_pages(
+                    query_indices, query_diffs, query_scores, self.row_page, top_k
+                )
+            indices[pending], diffs[pending], scores[pending] = query_indices, query_diffs, query_scores
+            searches += len(pending)
+
+            pending = pending[np.isfinite(query_scores).sum(axis=1) < top_k]
+            if len(pending) == 0 or k >= max_k:
+                break
+            expanded[pending] = True
+            k = min(k * 2, max_k)
+
+        self.expansion_stats.record(num_queries, int(expanded.sum()), searches, k)
+        return indices, diffs, scores
+
+    def result_entries(self, indices: np.ndarray, diffs: np.ndarray, scores: np.ndarray) -> List[ResultEntry]:
+        result_entries = []
+        for i, d, s in zip(indices, diffs, scores):
+            if not np.isfinite(s):
+                continue
+            meta_entry = self.meta_info[int(i)]
+            result_entries.append(ResultEntry(meta_entry['title'], meta_entry['link'], d, meta_entry['views'], s))
+        return result_entries
 
-    # loading links
-    print('loading links... ', end='', flush=True)
-    with open(os.path.join(args.indir, 'meta.json'), 'r') as f:
-        meta_info = json.load(f)
-    print('done', flush=True)
+    def search(self, search_texts: List[str], k: int = 200, top_k: int = 20) -> List[List[ResultEntry]]:
+        return self.search_features(self.encode(search_texts), k=k, top_k=top_k)
+
+    def close(self):
+        close_model(self.model)
+
+
+def prepare_queries(search_features: np.ndarray, normalize: bool, quantizer: Optional[Quantizer]) -> np.ndarray:
+    """
+    Applies the same processing to the query features, that was applied to the features of the index.
+    """
+    if normalize:
+        search_features = l2_normalize(search_features)
+    if quantizer is not None:
+        search_features = quantizer(search_features)
+    return search_features
+
+
+def row_pages(meta_info) -> np.ndarray:
+    """
+    Returns the page of every row. Consecutive rows with the same title and link belong to the same page.
+    """
+    if isinstance(meta_info, MetaStore):
+        return meta_info.row_page
+    pages = np.empty(len(meta_info), dtype=np.uint32)
+    last_page = None
+    page = -1
+    for row, meta_entry in enumerate(meta_info):
+        if (meta_entry['title'], meta_entry['link']) != last_page:
+            last_page = (meta_entry['title'], meta_entry['link'])
+            page += 1
+        pages[row] = page
+    return pages
+
+
+def row_views(meta_info) -> np.ndarray:
+    if isinstance(meta_info, MetaStore):
+        return meta_info.row_views()
+    return np.array([meta_entry['views'] for meta_entry in meta_info], dtype=np.int64)
+
+
+def main():
+    args = parse_args()
+    with instrument(args):
+        interactive_search(args)
+
+
+def interactive_search(args):
+    ranking = json.loads(args.ranking) if args.ranking is not None else None
+    searcher = Searcher.load(
+        args.indir, cache_dir=args.cache_dir, backend=args.backend, ranking=ranking, search_mode=args.search_mode,
+        warmup=args.warmup
+    )
 
     while True:
         search_text = input('Enter search text: ')
         start_time = time.perf_counter()
         if not search_text:
+            searcher.close()
             break
-        search_feature = model(search_text)
-        if normalize:
-            search_feature = l2_normalize(search_feature)
-        if quantize:
-            search_feature = quantize_data(search_feature, max_val=0.4)
-        indices, diffs = index.search_query(search_feature, k=200)
-        result_entries = []
-        for i, d in zip(indices[0], diffs[0]):
-            meta_entry = meta_info[i]
-            result_entries.append(ResultEntry(meta_entry['title'], meta_entry['link'], d, meta_entry['views']))
-
-        result_entries.sort(key=lambda en: en.sort_key())
+        result_entries = searcher.search([search_text])[0]
         end_time = time.perf_counter()
 
         table = Table(('Title', 'Link', 'Views', 'Distance', 'Value'))
-        for e in result_entries[:20]:
-            table.line(title=e.title, link=e.link, views=e.views, distance=int(e.distance), value=e.sort_key())
+        for e in result_entries:
+            table.line(title=e.title, link=e.link, views=e.views, distance=int(e.distance), value=e.score)
         print(table)
+        if args.search_mode == 'pages':
+            stats = searcher.expansion_stats
+            print('expanded {} of {} queries, largest k: {}'.format(
+                stats.expanded_queries, stats.queries, stats.max_k
+            ))
         print('results in {:.3f}s\n'.format(end_time - start_time), flush=True)
 
 
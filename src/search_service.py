@@ -0,0 +1,299 @@
+"""
+HTTP/JSON search service.
+
+Loads the model, the index and the meta information once and answers queries over HTTP. Concurrent queries are collected
+into micro batches: the first query of a batch waits at most --max-wait-ms for further queries, then the whole batch is
+encoded with one forward pass and searched with one batched knn query.
+
+Endpoints:
+- GET /search?q=<query>&n=<number of results>
+- POST /search with a json body {"query": "...", "n": 20}
+- GET /stats: latency percentiles, queries per second, how often the page search fetched more candidates, the
+  startup profile and, with --metrics, the timings of the search stages
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+from metrics import METRICS, add_arguments, instrument
+from models import BACKENDS
+from search_graph import DEFAULT_WARMUP, SEARCH_MODES, Searcher
+
+MAX_RESULTS = 100
+LATENCY_WINDOW = 10000
+HTTP_STATUS = {
+    200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+    500: 'Internal Server Error'
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('indir', type=str)
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch', type=int, default=32, help='maximal number of queries per batch')
+    parser.add_argument(
+        '--max-wait-ms', type=float, default=5.0, help='time the first query of a batch waits for more queries'
+    )
+    parser.add_argument('--backend', type=str, choices=BACKENDS, default='torch', help='inference backend of the model')
+    parser.add_argument('--cache-dir', type=str, default=None, help='directory of the persistent embedding cache')
+    parser.add_argument(
+        '--ranking', type=str, default=None, help='ranking configuration as json, see search_graph.py'
+    )
+    parser.add_argument('--search-mode', type=str, choices=SEARCH_MODES, default='fixed')
+    parser.add_argument(
+        '--warmup', type=int, default=DEFAULT_WARMUP, help='number of warm up queries before the service is ready'
+    )
+    add_arguments(parser)
+    return parser.parse_args()
+
+
+class LatencyTracker:
+    """
+    Keeps the latencies of the last LATENCY_WINDOW requests.
+    """
+    def __init__(self):
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.finish_times = deque(maxlen=LATENCY_WINDOW)
+        self.batch_sizes = deque(maxlen=LATENCY_WINDOW)
+        self.num_requests = 0
+        self.start_time = time.perf_counter()
+
+    def record(self, latency: float):
+        self.latencies.append(latency)
+        self.finish_times.append(time.perf_counter())
+        self.num_requests += 1
+
+    def stats(self) -> dict:
+        stats = {
+            'requests': self.num_requests,
+            'uptime_s': time.perf_counter() - self.start_time,
+            'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+        }
+        if self.latencies:
+            latencies = np.array(self.latencies) * 1000
+            stats['p50_ms'] = float(np.percentile(latencies, 50))
+            stats['p99_ms'] = float(np.percentile(latencies, 99))
+            stats['mean_ms'] = float(latencies.mean())
+        if len(self.finish_times) > 1:
+            duration = self.finish_times[-1] - self.finish_times[0]
+            stats['qps'] = (len(self.finish_times) - 1) / duration if duration > 0 else 0.0
+        return stats
+
+
+class MicroBatcher:
+    def __init__(self, searcher: Searcher, max_batch: int, max_wait: float, tracker: LatencyTracker):
+        self.searcher = searcher
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.tracker = tracker
+        self.queue: asyncio.Queue = asyncio.Queue()
+        # the model and the index are used by one batch at a time
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def search(self, query: str, n: int) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((query, n, future, time.perf_counter()))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(requests) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                responses = await loop.run_in_executor(self.executor, self._search_batch, requests)
+            except Exception as e:
+                for _, _, future, _ in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.tracker.batch_sizes.append(len(requests))
+            for (_, _, future, _), response in zip(requests, responses):
+                self.tracker.record(response['timing_ms']['total'] / 1000)
+                if not future.done():
+                    future.set_result(response)
+
+    def _search_batch(self, requests: List[Tuple[str, int, asyncio.Future, float]]) -> List[dict]:
+        batch_start = time.perf_counter()
+        search_features = self.searcher.encode([query for query, _, _, _ in requests])
+        encode_end = time.perf_counter()
+        top_k = max(n for _, n, _, _ in requests)
+        results = self.searcher.search_features(search_features, top_k=top_k)
+        search_end = time.perf_counter()
+
+        responses = []
+        for (query, n, _, enqueue_time), result_entries in zip(requests, results):
+            responses.append({
+                'query': query,
+                'results': [
+                    {
+                        'title': e.title, 'link': e.link, 'views': int(e.views), 'distance': float(e.distance),
+                        'score': float(e.score),
+                    }
+                    for e in result_entries[:n]
+                ],
+                'timing_ms': {
+                    'queue': (batch_start - enqueue_time) * 1000,
+                    'encode': (encode_end - batch_start) * 1000,
+                    'search': (search_end - encode_end) * 1000,
+                    'total': (search_end - enqueue_time) * 1000,
+                },
+                'batch_size': len(requests),
+            })
+        return responses
+
+
+class SearchService:
+    def __init__(self, batcher: MicroBatcher, tracker: LatencyTracker):
+        self.batcher = batcher
+        self.tracker = tracker
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                try:
+                    status, response = await self.handle_request(method, target, body)
+                except Exception as e:
+                    status, response = 500, {'error': repr(e)}
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                write_response(writer, status, response, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, method: str, target: str, body: bytes) -> Tuple[int, dict]:
+        url = urlsplit(target)
+        if url.path == '/stats':
+            stats = self.tracker.stats()
+            if self.batcher.searcher.search_mode == 'pages':
+                stats['expansion'] = self.batcher.searcher.expansion_stats.as_dict()
+            if self.batcher.searcher.startup is not None:
+                stats['startup'] = self.batcher.searcher.startup.as_dict()
+            if METRICS.enabled:
+                stats['metrics'] = METRICS.snapshot()
+            return 200, stats
+        if url.path != '/search':
+            return 404, {'error': 'unknown path {}'.format(url.path)}
+
+        if method == 'GET':
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        elif method == 'POST':
+            try:
+                params = json.loads(body or b'{}')
+            except json.JSONDecodeError:
+                return 400, {'error': 'invalid json'}
+        else:
+            return 405, {'error': 'method {} not allowed'.format(method)}
+
+        query = params.get('q', params.get('query'))
+        if not query:
+            return 400, {'error': 'missing query'}
+        n = parse_result_count(params.get('n', 20))
+        if n is None:
+            return 400, {'error': 'n has to be an integer between 1 and {}'.format(MAX_RESULTS)}
+        return 200, await self.batcher.search(query, n)
+
+
+def parse_result_count(value) -> Optional[int]:
+    """
+    Returns the number of results given as string (GET) or json value (POST), or None, if it is not an integer between 1
+    and MAX_RESULTS.
+    """
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        return None
+    try:
+        n = int(value)
+    except (TypeError, ValueError):
+        return None
+    return n if 1 <= n <= MAX_RESULTS else None
+
+
+async def read_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, dict, bytes]]:
+    """
+    Reads one HTTP/1.1 request. Returns None, if the connection was closed.
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, target, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, value = line.decode('latin-1').split(':', 1)
+        headers[key.strip().lower()] = value.strip()
+    body = b''
+    if 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    return method, target, headers, body
+
+
+def write_response(writer: asyncio.StreamWriter, status: int, response: dict, keep_alive: bool):
+    body = json.dumps(response).encode('utf-8')
+    header = (
+        'HTTP/1.1 {} {}\r\n'
+        'Content-Type: application/json\r\n'
+        'Content-Length: {}\r\n'
+        'Connection: {}\r\n\r\n'
+    ).format(status, HTTP_STATUS.get(status, ''), len(body), 'keep-alive' if keep_alive else 'close')
+    writer.write(header.encode('latin-1') + body)
+
+
+async def serve(args):
+    ranking = json.loads(args.ranking) if args.ranking is not None else None
+    searcher = Searcher.load(
+        args.indir, cache_dir=args.cache_dir, backend=args.backend, ranking=ranking, search_mode=args.search_mode,
+        warmup=args.warmup
+    )
+    tracker = LatencyTracker()
+    batcher = MicroBatcher(searcher, args.max_batch, args.max_wait_ms / 1000, tracker)
+    service = SearchService(batcher, tracker)
+
+    batcher_task = asyncio.create_task(batcher.run())
+    server = await asyncio.start_server(service.handle_connection, args.host, args.port)
+    print('serving on http://{}:{}'.format(args.host, args.port), flush=True)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batcher_task.cancel()
+        searcher.close()
+
+
+def main():
+    args = parse_args()
+    try:
+        with instrument(args):
+            asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+"""
+Reads the articles of a directory of wp2txt summary files.
+
+Every article starts with a "[[Title]]" line, followed by the lines of its summary. A manifest of the directory stores
+the byte offset of every title line, so that articles can be counted without reading the files, a resumed run can
+seek directly to its first article and the corpus can be split into ranges of about the same number of bytes, which
+are read by a pool of processes. The manifest is cached in the summary directory:
+- summary_manifest.json: name, size, modification time, first article and number of articles of every .txt file
+- summary_offsets.bin: int64, the byte offset of every article in its file, for all files in order
+
+It is rebuilt automatically, if a .txt file was added, removed or changed since it was written.
+"""
+import contextlib
+import json
+import multiprocessing
+import os
+from dataclasses import dataclass
+from multiprocessing.pool import Pool
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from metrics import METRICS, init_worker
+
+MANIFEST_FILE = 'summary_manifest.json'
+OFFSETS_FILE = 'summary_offsets.bin'
+# manifests of an older version are rebuilt
+MANIFEST_VERSION = 2
+DEFAULT_NUM_WORKERS = 4
+# target size of the ranges, that are read by one worker task
+RANGE_BYTES = 4 * 2 ** 20
+
+# (file name, byte offset of the first article, number of articles)
+Segment = Tuple[str, int, int]
+
+
+@dataclass
+class ArticleSummary:
+    title: str
+    summary: List[str]
+
+
+def _is_title(line: str) -> bool:
+    return line.startswith('[[') and line.endswith(']]')
+
+
+def list_summary_files(summary_dir: str) -> List[dict]:
+    files = []
+    for filename in sorted(os.listdir(summary_dir)):
+        if not filename.endswith('.txt'):
+            continue
+        stat = os.stat(os.path.join(summary_dir, filename))
+        files.append({'name': filename, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+    return files
+
+
+def scan_offsets(path: str) -> List[int]:
+    """
+    Returns the byte offsets of all articles in a summary file. An article without any summary lines at the end of a
+    file is not counted. Lines are decoded before they are stripped, so that lines of unicode whitespace like
+    non-breaking spaces are empty, as in read_segments.
+    """
+    offsets = []
+    has_content = False
+    position = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            stripped = line.decode('utf-8').strip()
+            if _is_title(stripped):
+                offsets.append(position)
+                has_content = False
+            elif stripped:
+                has_content = True
+            position += len(line)
+    if offsets and not has_content:
+        offsets.pop()
+    return offsets
+
+
+class SummaryManifest:
+    def __init__(self, summary_dir: str, files: List[dict], offsets: np.ndarray):
+        """
+        :param summary_dir: The directory containing the .txt files
+        :param files: The entries of list_summary_files with the additional keys first_article and num_articles
+        :param offsets: The byte offset of every article in its file
+        """
+        self.summary_dir = summary_dir
+        self.files = files
+        self.offsets = offsets
+        self.first_articles = np.array([f['first_article'] for f in files], dtype=np.int64)
+        self.file_starts = np.cumsum([0] + [f['size'] for f in files], dtype=np.int64)
+
+    @property
+    def num_articles(self) -> int:
+        return len(self.offsets)
+
+    @property
+    def num_bytes(self) -> int:
+        return int(self.file_starts[-1])
+
+    @staticmethod
+    def build(summary_dir: str) -> 'SummaryManifest':
+        from tqdm import tqdm
+        files = list_summary_files(summary_dir)
+        all_offsets = []
+        for entry in tqdm(files, desc='indexing summary files'):
+            offsets = scan_offsets(os.path.join(summary_dir, entry['name']))
+            entry['first_article'] = sum(len(o) for o in all_offsets)
+            entry['num_articles'] = len(offsets)
+            all_offsets.append(offsets)
+        offsets = np.array([offset for file_offsets in all_offsets for offset in file_offsets], dtype=np.int64)
+        return SummaryManifest(summary_dir, files, offsets)
+
+    def save(self):
+        self.offsets.tofile(os.path.join(self.summary_dir, OFFSETS_FILE))
+        with open(os.path.join(self.summary_dir, MANIFEST_FILE), 'w') as f:
+            json.dump(
+                {'version': MANIFEST_VERSION, 'files': self.files, 'num_articles': self.num_articles}, f, indent=2
+            )
+
+    @staticmethod
+    def load(summary_dir: str) -> Optional['SummaryManifest']:
+        """
+        Returns the cached manifest of summary_dir, or None if there is none or the files changed since it was written.
+        """
+        manifest_path = os.path.join(summary_dir, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != MANIFEST_VERSION:
+            return None
+        keys = ('name', 'size', 'mtime_ns')
+        cached_files = [tuple(f[key] for key in keys) for f in manifest['files']]
+        if cached_files != [tuple(f[key] for key in keys) for f in list_summary_files(summary_dir)]:
+            return None
+        offsets = np.fromfile(os.path.join(summary_dir, OFFSETS_FILE), dtype=np.int64)
+        if len(offsets) != manifest['num_articles']:
+            return None
+        return SummaryManifest(summary_dir, manifest['files'], offsets)
+
+    def file_of(self, article: int) -> int:
+        return int(np.searchsorted(self.first_articles, article, side='right')) - 1
+
+    def segments(self, start: int, end: int) -> List[Segment]:
+        """
+        Returns the parts of the files, that contain the articles start to end (exclusive).
+        """
+        segments = []
+        article = start
+        while article < end:
+            entry = self.files[self.file_of(article)]
+            file_end = min(entry['first_article'] + entry['num_articles'], end)
+            segments.append((entry['name'], int(self.offsets[article]), file_end - article))
+            article = file_end
+        return segments
+
+    def split(self, num_parts: int) -> List[Tuple[int, int]]:
+        """
+        Splits the articles into at most num_parts consecutive (start, end) ranges of about the same number of bytes.
+        """
+        if self.num_articles == 0:
+            return []
+        file_indices = np.searchsorted(self.first_articles, np.arange(self.num_articles), side='right') - 1
+        positions = self.file_starts[file_indices] + self.offsets
+        targets = np.arange(1, num_parts) * (self.num_bytes / num_parts)
+        bounds = np.unique(np.concatenate([[0], np.searchsorted(positions, targets), [self.num_articles]]))
+        return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def load_manifest(summary_dir: str) -> SummaryManifest:
+    """
+    Returns the manifest of summary_dir and builds it, if it is missing or outdated. If the directory is not writable,
+    the manifest is only kept in memory.
+    """
+    manifest = SummaryManifest.load(summary_dir)
+    if manifest is not None:
+        return manifest
+    manifest = SummaryManifest.build(summary_dir)
+    try:
+        manifest.save()
+    except OSError as e:
+        print('could not save the summary manifest: {}'.format(e), flush=True)
+    return manifest
+
+
+def read_segments(summary_dir: str, segments: List[Segment], fast: bool = False) -> Iterator[ArticleSummary]:
+    """
+    Yields the articles of all segments. The files are read line by line starting at the offset of a segment.
+
+    :param fast: If set, lines are not split into sentences
+    """
+    import blingfire
+
+    for filename, offset, num_articles in segments:
+        with open(os.path.join(summary_dir, filename), 'rb') as f:
+            f.seek(offset)
+            remaining = num_articles
+            current_title = None
+            current_content = []
+            for line in f:
+                line = line.decode('utf-8').strip()
+                if not line:
+                    continue
+                if _is_title(line):
+                    if current_title is not None:
+                        yield ArticleSummary(current_title, current_content)
+                        remaining -= 1
+                        current_content = []
+                        if remaining == 0:
+                            break
+                    current_title = line[2:-2]
+                elif fast:
+                    current_content.append(line)
+                else:
+                    with METRICS.timer('summary.sentence_split'):
+                        sentences = blingfire.text_to_sentences(line).split('\n')
+                    current_content.extend(sentences)
+            else:
+                if current_title is not None and current_content and remaining > 0:
+                    yield ArticleSummary(current_title, current_content)
+
+
+def _read_segments(args: Tuple[str, List[Segment], bool]) -> Tuple[List[ArticleSummary], dict]:
+    summary_dir, segments, fast = args
+    articles = list(read_segments(summary_dir, segments, fast))
+    # the metrics of the worker are sent back with the articles
+    return articles, METRICS.take()
+
+
+@contextlib.contextmanager
+def reader_pool(num_workers: int, metrics_enabled: Optional[bool] = None) -> Iterator[Optional[Pool]]:
+    """
+    Returns the pool of reader processes for iterate_articles, or None for a single worker. The processes are forked,
+    so the pool should be created before a model is loaded and before other threads are started.
+
+    :param metrics_enabled: Whether the workers record metrics. Defaults to METRICS.enabled.
+    """
+    if num_workers <= 1:
+        yield None
+        return
+    if metrics_enabled is None:
+        metrics_enabled = METRICS.enabled
+    with multiprocessing.Pool(num_workers, initializer=init_worker, initargs=(metrics_enabled,)) as pool:
+        yield pool
+
+
+def iterate_articles(
+        manifest: SummaryManifest, start: int = 0, end: Optional[int] = None, fast: bool = False, num_workers: int = 1,
+        pool: Optional[Pool] = None
+) -> Iterator[ArticleSummary]:
+    """
+    Yields the articles start to end (exclusive) in order. With more than one worker, the articles are split into
+    ranges of about RANGE_BYTES bytes, that are read and split into sentences by a pool of num_workers processes.
+    At most two ranges per worker are read ahead of the consumer.
+
+    :param pool: The pool of reader_pool(num_workers). If it is not given, a pool is created for this iteration.
+    """
+    end = manifest.num_articles if end is None else min(end, manifest.num_articles)
+    if start >= end:
+        return
+    if num_workers <= 1:
+        yield from read_segments(manifest.summary_dir, manifest.segments(start, end), fast)
+        return
+    if pool is None:
+        with reader_pool(num_workers) as pool:
+            yield from iterate_articles(manifest, start, end, fast, num_workers, pool)
+        return
+
+    num_ranges = max(num_workers, manifest.num_bytes // RANGE_BYTES)
+    tasks = (
+        (manifest.summary_dir, manifest.segments(max(range_start, start), min(range_end, end)), fast)
+        for range_start, range_end in manifest.split(num_ranges) if range_end > start and range_start < end
+    )
+    pending = []
+    for task in tasks:
+        pending.append(pool.apply_async(_read_segments, (task,)))
+        if len(pending) >= 2 * num_workers:
+            yield from _collect(pending.pop(0).get())
+    for result in pending:
+        yield from _collect(result.get())
+
+
+def _collect(result: Tuple[List[ArticleSummary], dict]) -> List[ArticleSummary]:
+    articles, metrics = result
+    METRICS.merge(metrics)
+    return articles
@@ -1,10 +1,11 @@
-import bz2
-import wiki_parser
+import os
 
-import mwxml
 from tqdm import tqdm
 
+from dump_reader import iterate_parsed_pages
+
 DATA_PATH = 'data/dewiki-latest-pages-articles-multistream1.xml-p1p297012.bz2'
+INDEX_PATH = 'data/dewiki-latest-pages-articles-multistream-index1.txt-p1p297012.bz2'
 
 
 def get_link(title, section) -> str:
@@ -17,12 +18,8 @@ def get_link(title, section) -> str:
 
 def main():
     sentence_counter = 0
-    with bz2.open(DATA_PATH, 'rt') as f:
-        dump = mwxml.Dump.from_file(f)
-        for site_index, site in tqdm(enumerate(dump)):
-            revision = next(site)
-            result = wiki_parser.parse_wiki(revision.text)
-            sentence_counter += len(result)
+    for _title, result in tqdm(iterate_parsed_pages(DATA_PATH, INDEX_PATH, os.cpu_count())):
+        sentence_counter += len(result)
 
     print('{} parts found'.format(sentence_counter))
 
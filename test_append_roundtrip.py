@@ -0,0 +1,142 @@
+"""
+Builds small hnsw and deglib indexes from random features, merges a delta into them with "create_graph.py append" and
+checks the search results: every appended row is its own nearest neighbour, no tombstone is returned and the size of
+the index counts only the rows, that can be found. A second merge of the same delta has to be refused. The same checks
+are repeated after full builds of every index type, with and without shards, which have to leave out the tombstones of
+the merged delta.
+
+Needs hnswlib and deglib, exits with a non zero status if a check fails. Run it from anywhere with
+"python3 test_append_roundtrip.py", the modules are imported from src/.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+from typing import Optional
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+
+from create_graph import INDEX_TYPES, append_to_index, build_index
+from feature_store import FEATURE_FILE, FeatureStore, read_description, write_description
+from incremental import DELTA_FILE, HASH_FILE, TOMBSTONE_FILE, format_hash_line, merge_delta
+from index_files import INDEX_FILES, SHARDED_INDEX_TYPES
+from meta_store import MetaWriter
+from search_graph import Index
+
+DIM = 16
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=2000, help='number of rows of the first build')
+    parser.add_argument('--new-rows', type=int, default=300, help='number of rows of the delta')
+    parser.add_argument('--tombstones', type=int, default=100, help='number of rows of the first build to delete')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def write_build(outdir: str, features: np.ndarray, first_row: int = 0):
+    """
+    Writes features.bin, the meta information, hashes.tsv and description.json of a build with one row per article.
+    """
+    os.makedirs(outdir)
+    features.tofile(os.path.join(outdir, FEATURE_FILE))
+    writer = MetaWriter(outdir)
+    with open(os.path.join(outdir, HASH_FILE), 'w', encoding='utf-8') as f:
+        for row in range(len(features)):
+            title = 'Article {}'.format(first_row + row)
+            writer.append([{'title': title, 'link': title, 'page_id': first_row + row, 'views': 1}])
+            f.write(format_hash_line(title, '0', row, 1))
+    writer.close()
+    write_description(outdir, {'num_samples': len(features), 'dim': DIM, 'dtype': 'float32', 'model': 'random'})
+
+
+def write_delta(delta_dir: str, base_dir: str, features: np.ndarray, first_row: int, tombstones: list):
+    write_build(delta_dir, features, first_row)
+    with open(os.path.join(delta_dir, TOMBSTONE_FILE), 'w') as f:
+        json.dump(tombstones, f)
+    with open(os.path.join(delta_dir, DELTA_FILE), 'w') as f:
+        json.dump({'id': 'roundtrip', 'base': os.path.abspath(base_dir)}, f)
+
+
+def rebuild(indir: str, index_type: str, shards: Optional[int] = None):
+    args = argparse.Namespace(
+        indir=indir, index_type=index_type, normalize=False, quantize=False, calibrate=None, shards=shards,
+        shard_workers=1, threads=1, pq_subspaces=4
+    )
+    description = read_description(indir)
+    build_index(args, description, FeatureStore.from_dir(indir, description))
+
+
+def check_index(indir: str, index_type: str, features: np.ndarray, new_rows: range, tombstones: list) -> list:
+    description = read_description(indir)
+    index = Index(indir, index_type, DIM, False, description.get('shards'), description.get('num_deleted', 0))
+    if index_type == 'hnsw':
+        index.set_search_param(100)
+    elif index_type == 'deglib':
+        index.set_search_param(0.2)
+    errors = []
+    expected_size = len(features) - len(tombstones)
+    if index.size != expected_size:
+        errors.append('size is {}, expected {}'.format(index.size, expected_size))
+    indices, _ = index.search_query(features[new_rows.start:new_rows.stop], k=10)
+    indices = np.asarray(indices)
+    misses = int((indices[:, 0] != np.arange(new_rows.start, new_rows.stop)).sum())
+    if misses > len(new_rows) // 100:
+        errors.append('{} of {} appended rows are not their own nearest neighbour'.format(misses, len(new_rows)))
+    indices, _ = index.search_query(features[tombstones], k=10)
+    found = np.intersect1d(np.asarray(indices), tombstones)
+    if len(found):
+        errors.append('{} tombstones were returned'.format(len(found)))
+    return errors
+
+
+def run(index_type: str, args, workdir: str) -> list:
+    rng = np.random.default_rng(args.seed)
+    features = rng.standard_normal((args.rows + args.new_rows, DIM)).astype(np.float32)
+    tombstones = sorted(rng.choice(args.rows, args.tombstones, replace=False).tolist())
+    base_dir = os.path.join(workdir, index_type)
+    delta_dir = os.path.join(workdir, index_type + '-delta')
+    write_build(base_dir, features[:args.rows])
+    write_delta(delta_dir, base_dir, features[args.rows:], args.rows, tombstones)
+    rebuild(base_dir, index_type)
+
+    append_to_index(
+        argparse.Namespace(indir=base_dir, delta=delta_dir, threads=1), read_description(base_dir)
+    )
+    new_rows = range(args.rows, len(features))
+    errors = check_index(base_dir, index_type, features, new_rows, tombstones)
+    try:
+        merge_delta(base_dir, delta_dir)
+        errors.append('the delta was merged twice')
+    except ValueError:
+        pass
+
+    for rebuilt_type in INDEX_TYPES:
+        for shards in [None, 2] if rebuilt_type in SHARDED_INDEX_TYPES else [None]:
+            rebuild(base_dir, rebuilt_type, shards)
+            errors.extend(
+                'full {} build{}: {}'.format(rebuilt_type, ' with {} shards'.format(shards) if shards else '', error)
+                for error in check_index(base_dir, rebuilt_type, features, new_rows, tombstones)
+            )
+    return errors
+
+
+def main():
+    args = parse_args()
+    failed = False
+    with tempfile.TemporaryDirectory() as workdir:
+        for index_type in INDEX_FILES:
+            errors = run(index_type, args, workdir)
+            for error in errors:
+                print('{}: {}'.format(index_type, error), flush=True)
+            print('{}: {}'.format(index_type, 'failed' if errors else 'ok'), flush=True)
+            failed = failed or bool(errors)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,11 @@
 mod parser_wiki_de;
 
+use std::collections::HashMap;
+use std::sync::{Arc, Mutex, OnceLock};
+
 use pyo3::exceptions::PyValueError;
 use pyo3::prelude::*;
+use rayon::prelude::*;
 use crate::parser_wiki_de::{tokenize, Token};
 
 fn tokens_to_vec(tokens: &Vec<Token>) -> Vec<(u8, String)> {
@@ -67,15 +71,70 @@ fn parse_wiki(text: &str) -> PyResult<Vec<(u8, String)>> {
         Ok(result) => {
             Ok(tokens_to_vec(&result))
         }
-        Err(_) => {
-            Err(PyValueError::new_err("Failed to tokenize text"))
+        Err(e) => {
+            Err(PyValueError::new_err(format!("Failed to tokenize text: {}", e)))
         }
     }
 }
 
+/// The parts of a text, or None and the error message of the tokenizer.
+type ParseResult = (Option<Vec<(u8, String)>>, Option<String>);
+
+fn parse_wiki_result(text: &str) -> ParseResult {
+    match tokenize(text) {
+        Ok(tokens) => (Some(tokens_to_vec(&tokens)), None),
+        Err(e) => (None, Some(e)),
+    }
+}
+
+/// Thread pools of parse_wiki_batch by number of threads, created on first use.
+static THREAD_POOLS: OnceLock<Mutex<HashMap<usize, Arc<rayon::ThreadPool>>>> = OnceLock::new();
+
+fn thread_pool(num_threads: usize) -> PyResult<Arc<rayon::ThreadPool>> {
+    let mut pools = THREAD_POOLS.get_or_init(|| Mutex::new(HashMap::new())).lock().unwrap();
+    if let Some(pool) = pools.get(&num_threads) {
+        return Ok(pool.clone());
+    }
+    let pool = Arc::new(
+        rayon::ThreadPoolBuilder::new()
+            .num_threads(num_threads)
+            .build()
+            .map_err(|e| PyValueError::new_err(format!("Failed to create thread pool: {}", e)))?
+    );
+    pools.insert(num_threads, pool.clone());
+    Ok(pool)
+}
+
+/// Parses a list of articles in parallel without holding the GIL.
+/// Returns one (parts, error) tuple per text. Texts that could not be tokenized result in (None, error message) instead
+/// of raising an error.
+/// If num_threads is not given, the global rayon thread pool is used. Otherwise a pool with num_threads threads is
+/// created on the first call and reused by later calls, with a single thread the texts are parsed on the calling
+/// thread.
+#[pyfunction]
+#[pyo3(signature = (texts, num_threads=None))]
+fn parse_wiki_batch(py: Python<'_>, texts: Vec<String>, num_threads: Option<usize>) -> PyResult<Vec<ParseResult>> {
+    let pool = match num_threads {
+        Some(num_threads) if num_threads > 1 => Some(thread_pool(num_threads)?),
+        _ => None,
+    };
+    let results = py.allow_threads(|| {
+        let parse = || -> Vec<ParseResult> {
+            texts.par_iter().map(|text| parse_wiki_result(text)).collect()
+        };
+        match (&pool, num_threads) {
+            (Some(pool), _) => pool.install(parse),
+            (None, Some(_)) => texts.iter().map(|text| parse_wiki_result(text)).collect(),
+            (None, None) => parse(),
+        }
+    });
+    Ok(results)
+}
+
 /// A Python module implemented in Rust.
 #[pymodule]
 fn wiki_parser(m: &Bound<'_, PyModule>) -> PyResult<()> {
     m.add_function(wrap_pyfunction!(parse_wiki, m)?)?;
+    m.add_function(wrap_pyfunction!(parse_wiki_batch, m)?)?;
     Ok(())
 }